@@ -0,0 +1,1750 @@
+""" an alternative to the bytecode VM (interpreter.py) that runs programs by
+walking their syntax tree, rather than CPython's bytecode. The tree is only
+walked once: each node is compiled into a Python closure, eg a + b becomes
+    def binary(scope):
+        return add(left(scope), right(scope))
+so hot loops just call the closures, and the engine works the same way on
+every Python version, since the ast module changes far less than bytecode.
+
+Statements are compiled into generators that yield once before each
+statement runs. That makes a statement the unit of stepping: update() runs
+a budget of statements each frame, and the program can pause between any
+two of them to wait for BIT to move or for the user to type an input.
+Expressions always run to completion, so a function called from inside an
+expression, eg x = f(1) + 1, runs synchronously (like a native function
+calling back into the VM), while a call that makes up a whole statement,
+eg f(1) or x = f(1), is stepped like the rest of the program.
+
+It has the same interface as VirtualMachine, so a Robot can use either
+(see Robot.set_engine).
+"""
+import ast
+import builtins
+import operator
+import time
+
+from console_messages import console_msg
+from constants import INSTRUCTION_BUDGET, INSTRUCTION_TIME_SLICE, \
+    STEPPED_EXECUTION, WATCHDOG_MAX_SECONDS, WATCHDOG_MAX_FRAMES, \
+    WATCHDOG_CHECK_INTERVAL, AST_MAX_STEPS, AST_NO_PROGRESS_STEPS
+from module_registry import import_module, module_attribute, star_names
+from quotas import ResourceQuotas, QuotaExceeded
+from trace_engine import ProgramHalted
+
+PROGRAM_FILE_NAME = '<program>'
+
+
+class UnsupportedSyntax(Exception):
+    """ raised by the compiler for parts of Python the engine can't run """
+    def __init__(self, node, description):
+        super().__init__(description + " are not supported",
+                         ('', getattr(node, 'lineno', 0)))
+
+
+# control flow inside the program is signalled with exceptions. These are
+# not Exceptions, so a student's try/except can't catch them
+class BreakLoop(BaseException):
+    pass
+
+
+class ContinueLoop(BaseException):
+    pass
+
+
+class ReturnValue(BaseException):
+    def __init__(self, value):
+        self.value = value
+
+
+# friendly names for the error message when a node isn't supported
+UNSUPPORTED_DESCRIPTIONS = {
+    'ClassDef': 'classes',
+    'With': 'with statements',
+    'AsyncFunctionDef': 'async functions',
+    'AsyncFor': 'async loops',
+    'AsyncWith': 'with statements',
+    'Nonlocal': 'nonlocal statements',
+    'AnnAssign': 'annotated assignments',
+    'Yield': 'generators',
+    'YieldFrom': 'generators',
+    'Await': 'async functions',
+    'NamedExpr': 'assignment expressions (:=)',
+    'Starred': 'starred assignments',
+    'Match': 'match statements',
+}
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: pow,
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+    ast.BitOr: operator.or_,
+    ast.BitXor: operator.xor,
+    ast.BitAnd: operator.and_,
+    ast.MatMult: operator.matmul,
+}
+
+INPLACE_OPERATORS = {
+    ast.Add: operator.iadd,
+    ast.Sub: operator.isub,
+    ast.Mult: operator.imul,
+    ast.Div: operator.itruediv,
+    ast.FloorDiv: operator.ifloordiv,
+    ast.Mod: operator.imod,
+    ast.Pow: operator.ipow,
+    ast.LShift: operator.ilshift,
+    ast.RShift: operator.irshift,
+    ast.BitOr: operator.ior,
+    ast.BitXor: operator.ixor,
+    ast.BitAnd: operator.iand,
+    ast.MatMult: operator.imatmul,
+}
+
+# operators that are checked against the resource quotas before they run,
+# with the names quotas.check_operation expects
+GUARDED_OPERATORS = {
+    ast.Add: 'ADD',
+    ast.Mult: 'MULTIPLY',
+    ast.Pow: 'POWER',
+    ast.LShift: 'LSHIFT',
+}
+
+UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    ast.Not: operator.not_,
+    ast.Invert: operator.inv,
+}
+
+COMPARE_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
+# conversions in f-strings, eg f'{x!r}'
+FORMAT_CONVERSIONS = {
+    -1: None,
+    ord('s'): str,
+    ord('r'): repr,
+    ord('a'): ascii,
+}
+
+
+class Scope:
+    """ the variables of the module, or of one call to a function.
+    parent is the scope the function was defined in, for reading the
+    variables of enclosing functions """
+    def __init__(self, engine, global_names, local_names, parent=None):
+        self.engine = engine
+        self.global_names = global_names
+        self.local_names = local_names
+        self.builtin_names = global_names['__builtins__']
+        self.parent = parent
+
+
+class ScopeInfo:
+    """ what the compiler knows about the names in a function """
+    def __init__(self, local_names, global_names=()):
+        self.local_names = frozenset(local_names)
+        self.global_names = frozenset(global_names)
+
+
+class FunctionDefinition:
+    """ the compiled form of a def or lambda, shared by every function
+    object made from it """
+    def __init__(self, name, body, parameters, defaults_count, varargs,
+                 keyword_only, varkeywords):
+        self.name = name
+        self.body = body  # generator function, returns the result
+        self.parameters = parameters  # positional parameter names
+        self.defaults_count = defaults_count
+        self.varargs = varargs
+        self.keyword_only = keyword_only
+        self.varkeywords = varkeywords
+
+
+class ASTFunction:
+    """ a function defined by the program """
+    def __init__(self, definition, defaults, keyword_defaults, scope):
+        self.definition = definition
+        self.__name__ = definition.name
+        self.defaults = defaults
+        self.keyword_defaults = keyword_defaults
+        self.scope = scope  # where the function was defined
+
+    def __repr__(self):
+        return '<function ' + self.__name__ + '>'
+
+    def __call__(self, *args, **kwargs):
+        # called from outside the program, eg by sorted(key=f)
+        return self.scope.engine.run_steps(self.call_steps(args, kwargs))
+
+    def bind_arguments(self, args, kwargs):
+        """ returns the local variables for a call """
+        definition = self.definition
+        parameters = definition.parameters
+        count = len(parameters)
+        if len(args) > count and not definition.varargs:
+            raise TypeError(self.__name__ + "() takes " + str(count)
+                            + " positional arguments but " + str(len(args))
+                            + " were given")
+        local_names = dict(zip(parameters, args))
+        if definition.varargs:
+            local_names[definition.varargs] = tuple(args[count:])
+        extra_keywords = {}
+        if kwargs:
+            for name, value in kwargs.items():
+                if name in local_names:
+                    raise TypeError(self.__name__ + "() got multiple values"
+                                    " for argument '" + name + "'")
+                if name in parameters or name in definition.keyword_only:
+                    local_names[name] = value
+                elif definition.varkeywords:
+                    extra_keywords[name] = value
+                else:
+                    raise TypeError(self.__name__ + "() got an unexpected "
+                                    "keyword argument '" + name + "'")
+        if len(args) < count:
+            first_default = count - definition.defaults_count
+            for i in range(len(args), count):
+                name = parameters[i]
+                if name not in local_names:
+                    if i < first_default:
+                        raise TypeError(self.__name__ + "() missing required"
+                                        " argument: '" + name + "'")
+                    local_names[name] = self.defaults[i - first_default]
+        for name in definition.keyword_only:
+            if name not in local_names:
+                if name not in self.keyword_defaults:
+                    raise TypeError(self.__name__ + "() missing required"
+                                    " keyword argument: '" + name + "'")
+                local_names[name] = self.keyword_defaults[name]
+        if definition.varkeywords:
+            local_names[definition.varkeywords] = extra_keywords
+        return local_names
+
+    def call_steps(self, args, kwargs=None):
+        """ generator that runs the function one statement at a time,
+        and returns its result """
+        scope = self.scope
+        engine = scope.engine
+        local_scope = Scope(engine, scope.global_names,
+                            self.bind_arguments(args, kwargs), scope)
+        engine.call_depth += 1
+        try:
+            engine.quotas.check_call_depth(engine.call_depth)
+            return (yield from self.definition.body(local_scope))
+        except ReturnValue as r:
+            return r.value
+        finally:
+            engine.call_depth -= 1
+
+
+def loop_controls(statements):
+    """ True if break or continue is used by this loop (rather than
+    by a loop nested inside it) """
+    pending = list(statements)
+    while pending:
+        node = pending.pop()
+        if isinstance(node, (ast.Break, ast.Continue)):
+            return True
+        if not isinstance(node, (ast.For, ast.While, ast.FunctionDef,
+                                 ast.Lambda, ast.ClassDef)):
+            pending.extend(ast.iter_child_nodes(node))
+        elif isinstance(node, (ast.For, ast.While)):
+            # the else clause belongs to the outer loop
+            pending.extend(node.orelse)
+    return False
+
+
+class LocalNameFinder(ast.NodeVisitor):
+    """ finds the names assigned to in a function body, and the ones it
+    declares global, without looking inside nested functions """
+    def __init__(self):
+        self.assigned = set()
+        self.declared_global = set()
+
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self.assigned.add(node.id)
+
+    def visit_FunctionDef(self, node):
+        self.assigned.add(node.name)
+        for expression in node.args.defaults + node.decorator_list:
+            self.visit(expression)
+        for expression in node.args.kw_defaults:
+            if expression is not None:
+                self.visit(expression)
+
+    def visit_Lambda(self, node):
+        for expression in node.args.defaults:
+            self.visit(expression)
+
+    def visit_comprehension_node(self, node):
+        # only the first iterable is evaluated in the enclosing scope
+        self.visit(node.generators[0].iter)
+
+    visit_ListComp = visit_comprehension_node
+    visit_SetComp = visit_comprehension_node
+    visit_DictComp = visit_comprehension_node
+    visit_GeneratorExp = visit_comprehension_node
+
+    def visit_Global(self, node):
+        self.declared_global.update(node.names)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.assigned.add((alias.asname or alias.name).split('.')[0])
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            if alias.name != '*':
+                self.assigned.add(alias.asname or alias.name)
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self.assigned.add(node.name)
+        self.generic_visit(node)
+
+
+def argument_names(arguments):
+    names = [a.arg for a in arguments.args + arguments.kwonlyargs]
+    names += [a.arg for a in arguments.posonlyargs]
+    if arguments.vararg:
+        names.append(arguments.vararg.arg)
+    if arguments.kwarg:
+        names.append(arguments.kwarg.arg)
+    return names
+
+
+class CompiledProgram:
+    """ a program compiled into closures. It holds no reference to the
+    engine, so one compiled program can be shared by many engines """
+    def __init__(self, body, names):
+        self.body = body  # generator function for the module's statements
+        self.names = names  # global names used anywhere in the program
+
+
+class ProgramCompiler:
+    """ turns the syntax tree of a program into closures.
+    Expressions compile to functions of a Scope that return their value;
+    statements compile to (simple, function) pairs, where simple statements
+    are plain functions and compound ones are generator functions. """
+    def __init__(self, world_names, live_names):
+        self.world_names = frozenset(world_names)
+        self.live_names = frozenset(live_names)
+        self.scopes = []  # ScopeInfo for each enclosing function
+        self.global_names_used = set()
+
+    def compile_program(self, tree):
+        body = self.block(tree.body)
+        return CompiledProgram(body, frozenset(self.global_names_used))
+
+    def unsupported(self, node):
+        name = type(node).__name__
+        raise UnsupportedSyntax(node, UNSUPPORTED_DESCRIPTIONS.get(
+            name, name + ' statements'))
+
+    ##############################################
+    # names
+
+    def resolve(self, name):
+        """ returns how many scopes up the name is defined,
+        or None for a global name """
+        for depth, info in enumerate(reversed(self.scopes)):
+            if name in info.global_names:
+                return None
+            if name in info.local_names:
+                return depth
+        return None
+
+    def name_loader(self, name):
+        depth = self.resolve(name)
+        if depth is None:
+            self.global_names_used.add(name)
+            if name in self.live_names:
+                # the world changes these by itself (the player runs around)
+                # so they are re-read from the world each time they are used
+                def load_live(scope):
+                    return scope.engine.refresh_world_variable(name)
+                return load_live
+
+            def load_global(scope):
+                global_names = scope.global_names
+                if name in global_names:
+                    return global_names[name]
+                builtin_names = scope.builtin_names
+                if name in builtin_names:
+                    return builtin_names[name]
+                raise NameError("name '" + name + "' is not defined")
+            return load_global
+        if depth == 0:
+            def load_local(scope):
+                try:
+                    return scope.local_names[name]
+                except KeyError:
+                    raise UnboundLocalError(
+                        "'" + name + "' referenced before assignment") \
+                        from None
+            return load_local
+
+        def load_enclosing(scope):
+            for i in range(depth):
+                scope = scope.parent
+            try:
+                return scope.local_names[name]
+            except KeyError:
+                raise NameError("'" + name + "' referenced before "
+                                "assignment") from None
+        return load_enclosing
+
+    def name_storer(self, name):
+        if self.resolve(name) is not None:
+            # the compiler only stores to local names in functions,
+            # since nonlocal is not supported
+            def store_local(scope, value):
+                scope.local_names[name] = value
+            return store_local
+        self.global_names_used.add(name)
+        if name in self.world_names:
+            def store_world(scope, value):
+                scope.global_names[name] = value
+                scope.engine.world_variable_written(name)
+            return store_world
+
+        def store_global(scope, value):
+            scope.global_names[name] = value
+        return store_global
+
+    def name_deleter(self, name):
+        if self.resolve(name) is None:
+            def delete(scope):
+                try:
+                    del scope.global_names[name]
+                except KeyError:
+                    raise NameError("name '" + name + "' is not defined") \
+                        from None
+        else:
+            def delete(scope):
+                try:
+                    del scope.local_names[name]
+                except KeyError:
+                    raise UnboundLocalError(
+                        "'" + name + "' referenced before assignment") \
+                        from None
+        return delete
+
+    ##############################################
+    # assignment targets
+
+    def target(self, node):
+        """ compile an assignment target into store(scope, value) """
+        if isinstance(node, ast.Name):
+            return self.name_storer(node.id)
+        if isinstance(node, ast.Attribute):
+            obj = self.expression(node.value)
+            attr = node.attr
+
+            def store_attribute(scope, value):
+                setattr(obj(scope), attr, value)
+            return store_attribute
+        if isinstance(node, ast.Subscript):
+            container = self.expression(node.value)
+            index = self.expression(node.slice)
+
+            def store_subscript(scope, value):
+                c = container(scope)
+                c[index(scope)] = value
+                # eg a dictionary gaining a new key
+                scope.engine.quotas.check_container(c)
+            return store_subscript
+        if isinstance(node, (ast.Tuple, ast.List)):
+            stores = [self.target(element) for element in node.elts]
+            count = len(stores)
+
+            def store_unpacked(scope, value):
+                values = tuple(value)
+                if len(values) != count:
+                    raise ValueError("expected " + str(count) + " values to"
+                                     " unpack, got " + str(len(values)))
+                for store, v in zip(stores, values):
+                    store(scope, v)
+            return store_unpacked
+        self.unsupported(node)
+
+    ##############################################
+    # expressions
+
+    def expression(self, node):
+        method = getattr(self, 'expression_' + type(node).__name__, None)
+        if method is None:
+            self.unsupported(node)
+        return method(node)
+
+    def expressions(self, nodes):
+        return [self.expression(node) for node in nodes]
+
+    def expression_Constant(self, node):
+        value = node.value
+
+        def constant(scope):
+            return value
+        return constant
+
+    def expression_Name(self, node):
+        return self.name_loader(node.id)
+
+    def expression_BinOp(self, node):
+        left = self.expression(node.left)
+        right = self.expression(node.right)
+        op = BINARY_OPERATORS[type(node.op)]
+        op_name = GUARDED_OPERATORS.get(type(node.op))
+        if op_name:
+            # check the size of the result before it is calculated
+            def guarded_binary(scope):
+                a = left(scope)
+                b = right(scope)
+                scope.engine.quotas.check_operation(op_name, a, b)
+                return op(a, b)
+            return guarded_binary
+
+        def binary(scope):
+            return op(left(scope), right(scope))
+        return binary
+
+    def expression_UnaryOp(self, node):
+        operand = self.expression(node.operand)
+        op = UNARY_OPERATORS[type(node.op)]
+
+        def unary(scope):
+            return op(operand(scope))
+        return unary
+
+    def expression_BoolOp(self, node):
+        values = self.expressions(node.values)
+        if isinstance(node.op, ast.And):
+            def boolean_and(scope):
+                for v in values:
+                    result = v(scope)
+                    if not result:
+                        return result
+                return result
+            return boolean_and
+
+        def boolean_or(scope):
+            for v in values:
+                result = v(scope)
+                if result:
+                    return result
+            return result
+        return boolean_or
+
+    def expression_Compare(self, node):
+        left = self.expression(node.left)
+        comparators = self.expressions(node.comparators)
+        ops = [COMPARE_OPERATORS[type(op)] for op in node.ops]
+        if len(ops) == 1:
+            op = ops[0]
+            right = comparators[0]
+
+            def compare(scope):
+                return op(left(scope), right(scope))
+            return compare
+        pairs = list(zip(ops, comparators))
+
+        def compare_chain(scope):
+            # eg 0 < x <= 10
+            a = left(scope)
+            for op, comparator in pairs:
+                b = comparator(scope)
+                if not op(a, b):
+                    return False
+                a = b
+            return True
+        return compare_chain
+
+    def expression_IfExp(self, node):
+        test = self.expression(node.test)
+        body = self.expression(node.body)
+        orelse = self.expression(node.orelse)
+
+        def if_expression(scope):
+            if test(scope):
+                return body(scope)
+            return orelse(scope)
+        return if_expression
+
+    def expression_Attribute(self, node):
+        obj = self.expression(node.value)
+        attr = node.attr
+
+        def attribute(scope):
+            return getattr(obj(scope), attr)
+        return attribute
+
+    def expression_Subscript(self, node):
+        container = self.expression(node.value)
+        index = self.expression(node.slice)
+
+        def subscript(scope):
+            return container(scope)[index(scope)]
+        return subscript
+
+    def expression_Slice(self, node):
+        parts = [self.expression(part) if part else None
+                 for part in (node.lower, node.upper, node.step)]
+
+        def make_slice(scope):
+            return slice(*[part(scope) if part else None for part in parts])
+        return make_slice
+
+    def expression_List(self, node):
+        elements = self.expressions(node.elts)
+
+        def make_list(scope):
+            return [e(scope) for e in elements]
+        return make_list
+
+    def expression_Tuple(self, node):
+        elements = self.expressions(node.elts)
+
+        def make_tuple(scope):
+            return tuple([e(scope) for e in elements])
+        return make_tuple
+
+    def expression_Set(self, node):
+        elements = self.expressions(node.elts)
+
+        def make_set(scope):
+            return {e(scope) for e in elements}
+        return make_set
+
+    def expression_Dict(self, node):
+        if None in node.keys:  # {**other}
+            self.unsupported(node.values[node.keys.index(None)])
+        items = list(zip(self.expressions(node.keys),
+                         self.expressions(node.values)))
+
+        def make_dict(scope):
+            return {k(scope): v(scope) for k, v in items}
+        return make_dict
+
+    def expression_JoinedStr(self, node):
+        parts = self.expressions(node.values)
+
+        def f_string(scope):
+            return ''.join([part(scope) for part in parts])
+        return f_string
+
+    def expression_FormattedValue(self, node):
+        value = self.expression(node.value)
+        conversion = FORMAT_CONVERSIONS[node.conversion]
+        if node.format_spec:
+            format_spec = self.expression(node.format_spec)
+        else:
+            format_spec = None
+
+        def formatted_value(scope):
+            v = value(scope)
+            if conversion:
+                v = conversion(v)
+            if format_spec:
+                return format(v, format_spec(scope))
+            return format(v)
+        return formatted_value
+
+    def call_arguments(self, node):
+        """ returns a function that evaluates the arguments of a call
+        as an (args, kwargs) pair """
+        args = [(isinstance(a, ast.Starred),
+                 self.expression(a.value if isinstance(a, ast.Starred) else a))
+                for a in node.args]
+        keywords = [(k.arg, self.expression(k.value)) for k in node.keywords]
+        if not keywords and not any(starred for starred, a in args):
+            positional = [a for starred, a in args]
+
+            def arguments(scope):
+                return [a(scope) for a in positional], None
+            return arguments
+
+        def arguments_with_keywords(scope):
+            values = []
+            for starred, a in args:
+                if starred:
+                    values.extend(a(scope))
+                else:
+                    values.append(a(scope))
+            kwargs = {}
+            for name, k in keywords:
+                if name is None:  # f(**options)
+                    kwargs.update(k(scope))
+                else:
+                    kwargs[name] = k(scope)
+            return values, kwargs
+        return arguments_with_keywords
+
+    def expression_Call(self, node):
+        func = self.expression(node.func)
+        arguments = self.call_arguments(node)
+
+        def call(scope):
+            f = func(scope)
+            args, kwargs = arguments(scope)
+            return scope.engine.call_function(f, args, kwargs)
+        return call
+
+    def call_steps(self, node):
+        """ compile a call that makes up a whole statement into a generator
+        function, so calls to the program's own functions can be stepped"""
+        func = self.expression(node.func)
+        arguments = self.call_arguments(node)
+
+        def call_steps(scope):
+            f = func(scope)
+            args, kwargs = arguments(scope)
+            if type(f) is ASTFunction:
+                return (yield from f.call_steps(args, kwargs))
+            engine = scope.engine
+            if (f is engine.overridden_builtins['input'] and
+                    engine.can_suspend()):
+                # open the input window and carry on with the game loop
+                # until the user has finished typing
+                engine.begin_input(*args)
+                yield
+                return engine.input_result
+            return engine.call_function(f, args, kwargs)
+        return call_steps
+
+    def function_definition(self, name, arguments, body_statements,
+                            expression_body=None):
+        """ compile the body of a def or lambda in its own scope """
+        # positional-only parameters are treated as ordinary ones
+        arguments.args[:0] = arguments.posonlyargs
+        arguments.posonlyargs = []
+        finder = LocalNameFinder()
+        for statement in body_statements:
+            finder.visit(statement)
+        local_names = (finder.assigned | set(argument_names(arguments))) \
+            - finder.declared_global
+        self.scopes.append(ScopeInfo(local_names, finder.declared_global))
+        try:
+            if expression_body is not None:
+                result = self.expression(expression_body)
+
+                def body(scope):
+                    return result(scope)
+                    yield  # makes this a generator function
+            else:
+                body = self.block(body_statements)
+        finally:
+            self.scopes.pop()
+        return FunctionDefinition(
+            name, body, [a.arg for a in arguments.args],
+            len(arguments.defaults),
+            arguments.vararg.arg if arguments.vararg else None,
+            [a.arg for a in arguments.kwonlyargs],
+            arguments.kwarg.arg if arguments.kwarg else None)
+
+    def function_maker(self, definition, arguments):
+        """ returns a function that creates the function object,
+        evaluating its default arguments """
+        defaults = self.expressions(arguments.defaults)
+        keyword_defaults = [(a.arg, self.expression(d))
+                            for a, d in zip(arguments.kwonlyargs,
+                                            arguments.kw_defaults)
+                            if d is not None]
+
+        def make_function(scope):
+            return ASTFunction(definition,
+                               tuple([d(scope) for d in defaults]),
+                               {k: d(scope) for k, d in keyword_defaults},
+                               scope)
+        return make_function
+
+    def expression_Lambda(self, node):
+        definition = self.function_definition('<lambda>', node.args, [],
+                                              node.body)
+        return self.function_maker(definition, node.args)
+
+    def comprehension(self, node, element):
+        """ returns a function that makes a generator for the elements of
+        a comprehension, with the comprehension's variables in their own
+        scope """
+        # the first iterable is evaluated in the enclosing scope
+        first_iterable = self.expression(node.generators[0].iter)
+        local_names = set()
+        for generator in node.generators:
+            for target in ast.walk(generator.target):
+                if isinstance(target, ast.Name):
+                    local_names.add(target.id)
+        self.scopes.append(ScopeInfo(local_names))
+        try:
+            loops = []
+            for i, generator in enumerate(node.generators):
+                iterable = self.expression(generator.iter) if i else None
+                loops.append((self.target(generator.target), iterable,
+                              self.expressions(generator.ifs)))
+            element = element()
+        finally:
+            self.scopes.pop()
+        last = len(loops) - 1
+
+        def elements(scope, i, iterable):
+            store, next_iterable, conditions = loops[i]
+            engine = scope.engine
+            for value in iterable:
+                # each item counts as a step, so the watchdog can stop
+                # comprehensions that run forever
+                engine.tick()
+                store(scope, value)
+                for condition in conditions:
+                    if not condition(scope):
+                        break
+                else:
+                    if i == last:
+                        yield element(scope)
+                    else:
+                        yield from elements(scope, i + 1,
+                                            loops[i + 1][1](scope))
+
+        def make_generator(scope):
+            inner = Scope(scope.engine, scope.global_names, {}, scope)
+            return elements(inner, 0, first_iterable(scope))
+        return make_generator
+
+    def expression_ListComp(self, node):
+        generator = self.comprehension(node,
+                                       lambda: self.expression(node.elt))
+
+        def list_comprehension(scope):
+            result = list(generator(scope))
+            scope.engine.quotas.check_container(result)
+            return result
+        return list_comprehension
+
+    def expression_SetComp(self, node):
+        generator = self.comprehension(node,
+                                       lambda: self.expression(node.elt))
+
+        def set_comprehension(scope):
+            return set(generator(scope))
+        return set_comprehension
+
+    def expression_DictComp(self, node):
+        def element():
+            key = self.expression(node.key)
+            value = self.expression(node.value)
+            return lambda scope: (key(scope), value(scope))
+        generator = self.comprehension(node, element)
+
+        def dict_comprehension(scope):
+            return dict(generator(scope))
+        return dict_comprehension
+
+    def expression_GeneratorExp(self, node):
+        return self.comprehension(node, lambda: self.expression(node.elt))
+
+    ##############################################
+    # statements
+
+    def block(self, statements):
+        """ compile a list of statements into a generator function,
+        which yields before each simple statement """
+        steps = [self.statement(s) for s in statements]
+        if len(steps) == 1 and steps[0][0]:
+            # the common case of a loop with a one line body
+            only = steps[0][1]
+
+            def single_statement(scope):
+                yield
+                only(scope)
+            return single_statement
+        if all(simple for simple, s in steps):
+            simple_statements = [s for simple, s in steps]
+
+            def simple_block(scope):
+                for s in simple_statements:
+                    yield
+                    s(scope)
+            return simple_block
+
+        def block(scope):
+            for simple, s in steps:
+                if simple:
+                    yield
+                    s(scope)
+                else:
+                    yield from s(scope)
+        return block
+
+    def statement(self, node):
+        method = getattr(self, 'statement_' + type(node).__name__, None)
+        if method is None:
+            self.unsupported(node)
+        return method(node)
+
+    def simple(self, function):
+        return True, function
+
+    def compound(self, function):
+        return False, function
+
+    def statement_Expr(self, node):
+        if isinstance(node.value, ast.Call):
+            call_steps = self.call_steps(node.value)
+
+            def call_statement(scope):
+                yield
+                yield from call_steps(scope)
+            return self.compound(call_statement)
+        value = self.expression(node.value)
+        return self.simple(value)
+
+    def statement_Assign(self, node):
+        stores = [self.target(t) for t in node.targets]
+        if isinstance(node.value, ast.Call):
+            call_steps = self.call_steps(node.value)
+
+            def assign_call(scope):
+                yield
+                value = yield from call_steps(scope)
+                for store in stores:
+                    store(scope, value)
+            return self.compound(assign_call)
+        value = self.expression(node.value)
+        if len(stores) == 1:
+            store = stores[0]
+
+            def assign(scope):
+                store(scope, value(scope))
+            return self.simple(assign)
+
+        def assign_many(scope):
+            v = value(scope)
+            for store in stores:
+                store(scope, v)
+        return self.simple(assign_many)
+
+    def statement_AugAssign(self, node):
+        op = INPLACE_OPERATORS[type(node.op)]
+        op_name = GUARDED_OPERATORS.get(type(node.op))
+        value = self.expression(node.value)
+        target = node.target
+        if isinstance(target, ast.Name):
+            load = self.name_loader(target.id)
+            store = self.name_storer(target.id)
+
+            def augmented_assign(scope):
+                a = load(scope)
+                b = value(scope)
+                if op_name:
+                    scope.engine.quotas.check_operation(op_name, a, b)
+                store(scope, op(a, b))
+            return self.simple(augmented_assign)
+        if isinstance(target, ast.Attribute):
+            obj = self.expression(target.value)
+            attr = target.attr
+
+            def augmented_assign_attribute(scope):
+                o = obj(scope)
+                a = getattr(o, attr)
+                b = value(scope)
+                if op_name:
+                    scope.engine.quotas.check_operation(op_name, a, b)
+                setattr(o, attr, op(a, b))
+            return self.simple(augmented_assign_attribute)
+        if isinstance(target, ast.Subscript):
+            container = self.expression(target.value)
+            index = self.expression(target.slice)
+
+            def augmented_assign_subscript(scope):
+                c = container(scope)
+                i = index(scope)
+                a = c[i]
+                b = value(scope)
+                if op_name:
+                    scope.engine.quotas.check_operation(op_name, a, b)
+                c[i] = op(a, b)
+            return self.simple(augmented_assign_subscript)
+        self.unsupported(target)
+
+    def statement_Delete(self, node):
+        deletes = []
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                deletes.append(self.name_deleter(target.id))
+            elif isinstance(target, ast.Subscript):
+                deletes.append(self.subscript_deleter(target))
+            elif isinstance(target, ast.Attribute):
+                deletes.append(self.attribute_deleter(target))
+            else:
+                self.unsupported(target)
+
+        def delete(scope):
+            for d in deletes:
+                d(scope)
+        return self.simple(delete)
+
+    def subscript_deleter(self, node):
+        container = self.expression(node.value)
+        index = self.expression(node.slice)
+
+        def delete_subscript(scope):
+            del container(scope)[index(scope)]
+        return delete_subscript
+
+    def attribute_deleter(self, node):
+        obj = self.expression(node.value)
+        attr = node.attr
+
+        def delete_attribute(scope):
+            delattr(obj(scope), attr)
+        return delete_attribute
+
+    def statement_Pass(self, node):
+        def pass_statement(scope):
+            pass
+        return self.simple(pass_statement)
+
+    def statement_Global(self, node):
+        # global names are sorted out by the compiler (see resolve)
+        return self.statement_Pass(node)
+
+    def statement_Break(self, node):
+        def break_statement(scope):
+            raise BreakLoop()
+        return self.simple(break_statement)
+
+    def statement_Continue(self, node):
+        def continue_statement(scope):
+            raise ContinueLoop()
+        return self.simple(continue_statement)
+
+    def statement_Return(self, node):
+        if isinstance(node.value, ast.Call):
+            call_steps = self.call_steps(node.value)
+
+            def return_call(scope):
+                yield
+                raise ReturnValue((yield from call_steps(scope)))
+            return self.compound(return_call)
+        value = self.expression(node.value) if node.value else None
+
+        def return_statement(scope):
+            raise ReturnValue(value(scope) if value else None)
+        return self.simple(return_statement)
+
+    def statement_If(self, node):
+        test = self.expression(node.test)
+        body = self.block(node.body)
+        orelse = self.block(node.orelse) if node.orelse else None
+
+        def if_statement(scope):
+            yield
+            if test(scope):
+                yield from body(scope)
+            elif orelse:
+                yield from orelse(scope)
+        return self.compound(if_statement)
+
+    def statement_While(self, node):
+        test = self.expression(node.test)
+        body = self.block(node.body)
+        orelse = self.block(node.orelse) if node.orelse else None
+        if not loop_controls(node.body):
+            # the body always yields, so each time round the loop is a step
+            def while_loop(scope):
+                yield
+                while test(scope):
+                    yield from body(scope)
+                if orelse:
+                    yield from orelse(scope)
+            return self.compound(while_loop)
+
+        def while_loop_with_break(scope):
+            yield
+            while test(scope):
+                try:
+                    yield from body(scope)
+                except BreakLoop:
+                    return
+                except ContinueLoop:
+                    pass
+            if orelse:
+                yield from orelse(scope)
+        return self.compound(while_loop_with_break)
+
+    def statement_For(self, node):
+        iterable = self.expression(node.iter)
+        store = self.target(node.target)
+        body = self.block(node.body)
+        orelse = self.block(node.orelse) if node.orelse else None
+        if not loop_controls(node.body):
+            def for_loop(scope):
+                yield
+                for value in iterable(scope):
+                    store(scope, value)
+                    yield from body(scope)
+                if orelse:
+                    yield from orelse(scope)
+            return self.compound(for_loop)
+
+        def for_loop_with_break(scope):
+            yield
+            for value in iterable(scope):
+                store(scope, value)
+                try:
+                    yield from body(scope)
+                except BreakLoop:
+                    return
+                except ContinueLoop:
+                    pass
+            if orelse:
+                yield from orelse(scope)
+        return self.compound(for_loop_with_break)
+
+    def statement_FunctionDef(self, node):
+        if node.decorator_list:
+            raise UnsupportedSyntax(node, 'decorators')
+        definition = self.function_definition(node.name, node.args, node.body)
+        make_function = self.function_maker(definition, node.args)
+        store = self.name_storer(node.name)
+
+        def define_function(scope):
+            store(scope, make_function(scope))
+        return self.simple(define_function)
+
+    def statement_Import(self, node):
+        imports = []
+        for alias in node.names:
+            if alias.asname:
+                store = self.name_storer(alias.asname)
+                path = alias.name.split('.')[1:]
+            else:
+                store = self.name_storer(alias.name.split('.')[0])
+                path = []
+            imports.append((alias.name, path, store))
+
+        def import_statement(scope):
+            import_function = scope.builtin_names['__import__']
+            for name, path, store in imports:
+                module = import_function(name, scope.global_names, None,
+                                         None, 0)
+                for attr in path:  # import a.b as c
+                    module = getattr(module, attr)
+                store(scope, module)
+        return self.simple(import_statement)
+
+    def statement_ImportFrom(self, node):
+        if node.level:
+            raise UnsupportedSyntax(node, 'relative imports')
+        names = [alias.name for alias in node.names]
+        if names == ['*']:
+            def import_star(scope):
+                module = scope.builtin_names['__import__'](
+                    node.module, scope.global_names, None, ['*'], 0)
+                # import * is only allowed at module level
+                for name in star_names(module):
+                    scope.global_names[name] = getattr(module, name)
+            return self.simple(import_star)
+        imports = [(alias.name, self.name_storer(alias.asname or alias.name))
+                   for alias in node.names]
+        module_name = node.module
+
+        def import_from(scope):
+            module = scope.builtin_names['__import__'](
+                module_name, scope.global_names, None, names, 0)
+            for name, store in imports:
+                store(scope, module_attribute(module, name))
+        return self.simple(import_from)
+
+    def statement_Assert(self, node):
+        test = self.expression(node.test)
+        msg = self.expression(node.msg) if node.msg else None
+
+        def assert_statement(scope):
+            if not test(scope):
+                if msg:
+                    raise AssertionError(msg(scope))
+                raise AssertionError()
+        return self.simple(assert_statement)
+
+    def statement_Raise(self, node):
+        exception = self.expression(node.exc) if node.exc else None
+        cause = self.expression(node.cause) if node.cause else None
+
+        def raise_statement(scope):
+            if exception is None:
+                raise  # re-raise the exception being handled
+            if cause:
+                raise exception(scope) from cause(scope)
+            raise exception(scope)
+        return self.simple(raise_statement)
+
+    def statement_Try(self, node):
+        body = self.block(node.body)
+        handlers = []
+        for handler in node.handlers:
+            handlers.append((
+                self.expression(handler.type) if handler.type else None,
+                self.name_storer(handler.name) if handler.name else None,
+                self.block(handler.body)))
+        orelse = self.block(node.orelse) if node.orelse else None
+        finalbody = self.block(node.finalbody) if node.finalbody else None
+
+        def try_statement(scope):
+            yield
+            try:
+                try:
+                    yield from body(scope)
+                # a bare except only catches Exceptions, so it can't stop
+                # break, return etc or the watchdog halting the program
+                except Exception as e:
+                    if isinstance(e, QuotaExceeded):
+                        raise
+                    for exception_type, store, handler_body in handlers:
+                        if (exception_type is None or
+                                isinstance(e, exception_type(scope))):
+                            if store:
+                                store(scope, e)
+                            yield from handler_body(scope)
+                            break
+                    else:
+                        raise
+                else:
+                    if orelse:
+                        yield from orelse(scope)
+            finally:
+                if finalbody:
+                    yield from finalbody(scope)
+        return self.compound(try_statement)
+
+
+class ASTEngine:
+    GET = 0  # index into world_variables tuple
+    SET = 1
+    UPDATE_TIMEOUT = 50
+
+    # compiled programs, keyed by source code (see VirtualMachine.code_cache)
+    code_cache = {}
+
+    def __init__(self, robot):
+        self.world = robot.world  # link back to the state of the game world
+        self.run_enabled = True
+        self.robot = robot  # the Robot instance that is running this program
+        self.source = []
+        self.byte_code = None  # the CompiledProgram
+        self.compile_time_error = None
+        self.run_time_error = None
+        self.last_exception = None
+        self.running = False
+        self.global_names = None
+        # functions that replace the standard python functions
+        self.overridden_builtins = {
+            'print': self.print,
+            'input': self.input,
+            '__import__': import_module,
+        }
+        # getters and setters for all the programmable world variables
+        self.world_variables = {
+            'bit_x': (self.world.get_bit_x, self.world.set_bit_x),
+            'bit_y': (self.world.get_bit_y, self.world.set_bit_y),
+            'me_x': (self.world.get_player_x, self.world.set_player_x),
+            'me_y': (self.world.get_player_y, self.world.set_player_y),
+            'data': (self.world.get_data, self.world.set_data),
+            '_secret_data': (self.world.get_secret_data,
+                             self.world.set_secret_data),
+        }
+        self.writable_names = ['bit_x', 'bit_y']
+        self.live_names = frozenset(['me_x', 'me_y'])
+        self.dirty_world_names = set()
+        # scheduler settings, as for the VM but counted in statements
+        self.instruction_budget = INSTRUCTION_BUDGET
+        self.time_slice = INSTRUCTION_TIME_SLICE
+        self.instructions_this_frame = 0
+        self.slice_deadline = 0
+        self.headless = False
+        self.render_frames = True
+        # stepped programs are driven by update() from the game loop
+        self.stepped_execution = STEPPED_EXECUTION
+        self.stepping = False
+        self.steps = None  # the generator for the running program
+        self.on_finish = None
+        self.synchronous_depth = 0  # number of nested run_steps calls
+        self.call_depth = 0
+        self.pending_sync = []  # world variables BIT is still moving towards
+        self.sync_timeout = 0
+        self.sync_previous_value = None
+        self.waiting_for_input = False
+        self.input_result = ''
+        # watchdog limits, counted in statements rather than bytecodes
+        self.max_steps = AST_MAX_STEPS
+        self.max_seconds = WATCHDOG_MAX_SECONDS
+        self.max_frames = WATCHDOG_MAX_FRAMES
+        self.no_progress_limit = AST_NO_PROGRESS_STEPS
+        self.steps_executed = 0
+        self.frames_elapsed = 0
+        self.run_start_time = 0
+        self.watchdog_check_at = WATCHDOG_CHECK_INTERVAL
+        self.world_writes = 0
+        self.last_progress = None
+        self.last_progress_at = 0
+        self.runaway = False
+        self.quotas = ResourceQuotas()
+
+    def load(self, source):
+        # set the source code to interpret
+        self.source = source
+
+    def is_running(self):
+        return self.running
+
+    def halt(self):
+        """ stops the program before its next statement """
+        self.running = False
+
+    def get_code(self):
+        # converts all the source into a single string with carriage returns
+        return chr(13).join(self.source)
+
+    def precompile(self, source):
+        """ compile a program in advance and keep it in the code cache """
+        self.load(source)
+        return self.compile(cache=True)
+
+    def compile(self, cache=False):
+        """ compile the source, returning (success, message) in the same
+        way as VirtualMachine.compile """
+        source = self.get_code()
+        if not source:  # bail immediately if source is empty
+            return False, ''
+        if cache and source in self.code_cache:
+            self.byte_code = self.code_cache[source]
+            return True, "compilation successful"
+        try:
+            tree = ast.parse(source, PROGRAM_FILE_NAME)
+            # CPython's compiler catches errors the parser doesn't,
+            # eg break outside a loop
+            compile(tree, PROGRAM_FILE_NAME, 'exec')
+            compiler = ProgramCompiler(self.world_variables, self.live_names)
+            program = compiler.compile_program(tree)
+        except (SyntaxError, UnsupportedSyntax) as e:
+            console_msg("Compiler error!", 3)
+            self.compile_time_error = {'error': e.args[0],
+                                       'line': e.args[1][1]
+                                       }
+            msg = (self.compile_time_error['error'] + " on line "
+                   + str(self.compile_time_error['line']))
+            self.robot.error(msg, type="Compiler error:")
+            return False, msg
+        self.compile_time_error = None
+        self.byte_code = program
+        if cache:
+            self.code_cache[source] = program
+        return True, "compilation successful"
+
+    def print(self, *t):
+        """ replacement for the built-in print function """
+        self.quotas.check_output(t)
+        self.robot.say(*t)
+
+    def input(self, msg=''):
+        """ replacement for the built-in input function, when the program
+        can't be suspended (see ProgramCompiler.call_steps)"""
+        return self.robot.input(msg)
+
+    def begin_input(self, msg=''):
+        self.robot.begin_input(msg)
+        self.waiting_for_input = True
+
+    def make_globals(self):
+        """ the namespace the program runs in, with its world variables
+        predefined and print/input replaced"""
+        program_builtins = dict(builtins.__dict__)
+        program_builtins.update(self.overridden_builtins)
+        global_names = {
+            '__builtins__': program_builtins,
+            '__name__': '__main__',
+            '__doc__': None,
+            '__package__': None,
+        }
+        for name, (get, set) in self.world_variables.items():
+            global_names[name] = get()
+        return global_names
+
+    ##############################################
+    # running programs
+
+    def prepare_to_run(self, global_names):
+        """ reset the per-run state, ready for a new program """
+        if self.stepping:
+            # a new program replaces one that is still being stepped
+            self.finish(None)
+        console_msg('Executing...', 5)
+        self.running = True
+        self.render_frames = not (
+            self.headless and
+            not self.byte_code.names & set(self.writable_names))
+        if global_names is None:
+            global_names = self.make_globals()
+        self.global_names = global_names
+        self.dirty_world_names.clear()
+        self.pending_sync = []
+        self.waiting_for_input = False
+        self.call_depth = 0
+        self.synchronous_depth = 0
+        self.instructions_this_frame = 0
+        self.slice_deadline = time.perf_counter() + (self.time_slice or 0)
+        self.last_exception = None
+        self.run_time_error = None
+        self.runaway = False
+        self.steps_executed = 0
+        self.frames_elapsed = 0
+        self.run_start_time = time.perf_counter()
+        self.watchdog_check_at = WATCHDOG_CHECK_INTERVAL
+        self.world_writes = 0
+        self.last_progress = None
+        self.last_progress_at = 0
+        self.quotas.start()
+        scope = Scope(self, global_names, global_names)
+        return self.byte_code.body(scope)
+
+    def run(self, global_names=None, local_names=None):
+        """ run the program to completion, returning (success, result)"""
+        # clear the enable flag, so that the puzzle must be reset before
+        # running again.
+        if not self.run_enabled:
+            self.running = False  # execution is disabled
+            return
+        self.run_enabled = False
+        if not self.byte_code:
+            self.running = False  # no bytecode to execute
+            return
+        steps = self.prepare_to_run(global_names)
+        result = None
+        try:
+            self.run_steps(steps)
+            if self.dirty_world_names:
+                self.sync_world_variables()
+        except ProgramHalted:
+            result = 'quit'
+        except Exception as e:
+            self.last_exception = (type(e), e, None)
+            result = 'exception'
+        if self.runaway:
+            result = 'quit'
+        return self.outcome(result)
+
+    def start(self, on_finish, global_names=None, local_names=None):
+        """ begin executing the program, without waiting for it to finish
+        (see VirtualMachine.start) """
+        if not self.stepped_execution:
+            on_finish(*self.run(global_names, local_names))
+        elif self.run_enabled:
+            self.run_enabled = False
+            if self.byte_code:
+                self.steps = self.prepare_to_run(global_names)
+                self.stepping = True
+                self.on_finish = on_finish
+            else:
+                self.running = False  # no bytecode to execute
+
+    def run_steps(self, steps):
+        """ run a generator of steps to completion and return its result.
+        This runs the whole program for run(), and calls to the program's
+        functions that can't be stepped, eg from inside an expression """
+        self.synchronous_depth += 1
+        try:
+            while True:
+                if not self.running:
+                    raise ProgramHalted()
+                # let the game world update once the scheduler budget for
+                # the current frame is used up
+                if self.render_frames and self.frame_due():
+                    self.yield_to_world()
+                if self.dirty_world_names:
+                    self.sync_world_variables()
+                try:
+                    next(steps)
+                except StopIteration as e:
+                    return e.value
+                self.steps_executed += 1
+                if self.steps_executed >= self.watchdog_check_at:
+                    self.check_watchdog()
+        finally:
+            self.synchronous_depth -= 1
+
+    def tick(self):
+        """ count a step that happens inside an expression, eg each item
+        of a list comprehension """
+        self.steps_executed += 1
+        if self.steps_executed >= self.watchdog_check_at:
+            self.check_watchdog()
+        if not self.running:
+            raise ProgramHalted()
+
+    def update(self):
+        """ continue executing the current program
+        this is called once per frame from the main game loop
+        (see VirtualMachine.update) """
+        if not self.stepping:
+            return
+        if not self.running:
+            self.finish('quit' if self.runaway else None)
+            return
+        self.count_frame()
+        if self.pending_sync:
+            self.check_world_sync()
+        if self.waiting_for_input:
+            if self.world.input.is_active():
+                return
+            self.input_result = self.robot.end_input()
+            self.waiting_for_input = False
+        if self.is_waiting() or self.world.busy():
+            return
+        deadline = None
+        if self.time_slice:
+            deadline = time.perf_counter() + self.time_slice
+        self.step(self.instruction_budget, deadline)
+
+    def step(self, n=1, deadline=None):
+        """ execute up to n statements of a stepped program.
+        Stops early if the program finishes, needs to wait for the world,
+        or the deadline (from time.perf_counter) passes.
+        Returns the number of statements executed"""
+        executed = 0
+        while (executed < n and self.stepping and self.running
+               and not self.is_waiting()):
+            try:
+                next(self.steps)
+            except StopIteration:
+                if self.dirty_world_names:
+                    # wait for the last statement's changes to the world
+                    # before finishing
+                    self.request_world_sync()
+                    self.steps = iter(())
+                    continue
+                self.finish(None)
+                break
+            except ProgramHalted:
+                self.finish('quit')
+                break
+            except Exception as e:
+                self.last_exception = (type(e), e, None)
+                self.finish('exception')
+                break
+            executed += 1
+            self.steps_executed += 1
+            if self.steps_executed >= self.watchdog_check_at:
+                self.check_watchdog()
+            if self.dirty_world_names:
+                self.request_world_sync()
+            if deadline and time.perf_counter() >= deadline:
+                break
+        return executed
+
+    def finish(self, result):
+        """ wind up a stepped program and report its result """
+        on_finish = self.on_finish
+        self.stepping = False
+        self.steps = None
+        self.on_finish = None
+        self.pending_sync = []
+        self.waiting_for_input = False
+        on_finish(*self.outcome(result))
+
+    def is_waiting(self):
+        """ True while a stepped program is waiting for
+        BIT to finish moving, or for the user to type an input"""
+        return bool(self.pending_sync) or self.waiting_for_input
+
+    def can_suspend(self):
+        """ stepped programs can only pause between statements that are
+        not inside a synchronous call (see run_steps) """
+        return self.stepping and not self.synchronous_depth
+
+    def call_function(self, func, args, kwargs):
+        """ call a function from inside an expression """
+        if type(func) is ASTFunction:
+            return self.run_steps(func.call_steps(args, kwargs))
+        self.quotas.check_call(func, args)
+        if kwargs:
+            result = func(*args, **kwargs)
+        else:
+            result = func(*args)
+        # methods like append & extend grow their object in place
+        self.quotas.check_container(getattr(func, '__self__', None))
+        return result
+
+    def outcome(self, result):
+        """ converts the result into the (success, result/errors) pair
+        returned by run, and displays any error messages"""
+        self.running = False
+        self.quotas.stop()
+        if result in ('exception', 'quit'):
+            console_msg("RUN ERRORS=" + str(self.run_time_error), 4)
+            errors = []
+            if self.run_time_error:
+                msg = str(self.run_time_error)
+                errors.append(msg)
+                self.robot.error(msg, type="Run-time error:")
+            if self.last_exception:
+                msg = str(self.last_exception[1])
+                errors.append(msg)
+                self.robot.error(msg, type="Run-time error:")
+            return False, errors
+        else:
+            return True, result  # no errors
+
+    ##############################################
+    # the game world
+
+    def frame_due(self):
+        """ returns True when the engine should stop and let the world
+        render (see VirtualMachine.frame_due) """
+        if self.world.busy():
+            return True
+        self.instructions_this_frame += 1
+        if self.instructions_this_frame >= self.instruction_budget:
+            return True
+        if self.time_slice and time.perf_counter() >= self.slice_deadline:
+            return True
+        return False
+
+    def yield_to_world(self):
+        """ hand control back to the game world for (at least) one frame """
+        self.world.update(self.robot)
+        while self.world.busy():
+            self.world.update(self.robot)
+        self.count_frame()
+        self.instructions_this_frame = 0
+        if self.time_slice:
+            self.slice_deadline = time.perf_counter() + self.time_slice
+
+    def count_frame(self):
+        # frames are counted for the watchdog
+        self.frames_elapsed += 1
+        if self.max_frames and self.frames_elapsed > self.max_frames:
+            self.check_watchdog()
+
+    def world_variable_written(self, name):
+        """ called when the program stores to a world variable """
+        self.dirty_world_names.add(name)
+        self.world_writes += 1
+
+    def refresh_world_variable(self, name):
+        """ copy the current value of a read-only world variable
+        into the program, just before the program reads it"""
+        value = self.world_variables[name][self.GET]()
+        self.global_names[name] = value
+        return value
+
+    def sync_world_variables(self):
+        """ pass changed variables to the world, and wait for BIT to
+        catch up (see VirtualMachine.sync_world_variables) """
+        self.request_world_sync()
+        while self.pending_sync and self.running:
+            self.yield_to_world()
+            self.check_world_sync()
+
+    def request_world_sync(self):
+        """ pass any changed variables to the world, and queue up the ones
+        that the program must wait for, without blocking"""
+        names = list(self.dirty_world_names)
+        self.dirty_world_names.clear()
+        for v in names:
+            w = self.world_variables[v]
+            target_value = self.global_names[v]
+            if v in ('data', '_secret_data'):
+                w[self.SET](self.robot, target_value)
+            elif (v in self.writable_names and
+                  w[self.GET]() != target_value):
+                self.pending_sync.append(v)
+        if self.pending_sync:
+            self.start_next_sync()
+
+    def start_next_sync(self):
+        # request a change to the world variable at the head of the queue
+        v = self.pending_sync[0]
+        w = self.world_variables[v]
+        w[self.SET](self.global_names[v])
+        self.sync_timeout = 0
+        self.sync_previous_value = w[self.GET]()
+
+    def check_world_sync(self):
+        """ called after the world has updated, to see whether the
+        variable at the head of the queue has reached its target yet"""
+        if not self.pending_sync or self.world.busy():
+            return
+        v = self.pending_sync[0]
+        target_value = self.global_names[v]
+        current_value = self.world_variables[v][self.GET]()
+        done = False
+        if current_value == target_value:
+            done = True
+        else:
+            # check if movement is blocked
+            if current_value == self.sync_previous_value:
+                self.sync_timeout += 1
+            if self.sync_timeout > self.UPDATE_TIMEOUT:
+                console_msg("world var timeout", 3)
+                # correct the program variable to match the world
+                self.global_names[v] = current_value
+                done = True
+        self.sync_previous_value = current_value
+        if done:
+            self.pending_sync.pop(0)
+            if self.pending_sync:
+                self.start_next_sync()
+
+    ##############################################
+    # watchdog
+
+    def check_watchdog(self):
+        """ stops the program if it has exceeded any of its limits,
+        or has stopped making progress (see VirtualMachine.check_watchdog)"""
+        self.watchdog_check_at = self.steps_executed + WATCHDOG_CHECK_INTERVAL
+        if self.max_steps and self.steps_executed > self.max_steps:
+            self.stop_runaway("program stopped after "
+                              + str(self.max_steps) + " steps.")
+        elif (self.max_seconds and
+              time.perf_counter() - self.run_start_time > self.max_seconds):
+            self.stop_runaway("program stopped after running for "
+                              + str(self.max_seconds) + " seconds.")
+        elif self.max_frames and self.frames_elapsed > self.max_frames:
+            self.stop_runaway("program stopped after "
+                              + str(self.max_frames) + " frames.")
+        else:
+            try:
+                self.quotas.check_memory()
+            except QuotaExceeded as e:
+                self.stop_runaway(str(e))
+                return
+            progress = (len(self.robot.output), self.world_writes)
+            if progress != self.last_progress:
+                self.last_progress = progress
+                self.last_progress_at = self.steps_executed
+            elif (self.no_progress_limit and
+                  self.steps_executed - self.last_progress_at
+                  > self.no_progress_limit):
+                self.stop_runaway("program stopped because it seems "
+                                  "to be stuck in a loop.")
+
+    def stop_runaway(self, msg):
+        console_msg("Watchdog: " + msg, 2)
+        self.run_time_error = msg
+        self.runaway = True
+        self.halt()
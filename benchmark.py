@@ -0,0 +1,383 @@
+"""
+Microbenchmarks for the in-game Python interpreter
+These run headless (no pygame window) against a stub world, so they measure
+the cost of the VM itself rather than the renderer.
+Run with: python benchmark.py
+"""
+import contextlib
+import dis
+import io
+import sys
+import time
+import tracemalloc
+
+import ast_engine
+import file_parser
+import interpreter
+import trace_engine
+from ast_engine import ASTEngine
+from constants import SENTRY_FILE
+from headless import StubRobot
+from interpreter import VirtualMachine
+from trace_engine import TraceEngine
+
+# small programs that are typical of student solutions
+PROGRAMS = {
+    'print loop': [
+        "for i in range(200):",
+        "    print(i)",
+    ],
+    'arithmetic': [
+        "total = 0",
+        "for i in range(2000):",
+        "    total = total + i * 2 - 1",
+        "print(total)",
+    ],
+    'while loop': [
+        "x = 0",
+        "while x < 2000:",
+        "    x += 1",
+        "print(x)",
+    ],
+    'string building': [
+        "s = ''",
+        "for c in 'abcdefghij' * 50:",
+        "    s = s + c.upper()",
+        "print(len(s))",
+    ],
+}
+
+
+# recursive programs, like the factorial and Fibonacci puzzles,
+# which make a new frame for every call
+RECURSIVE_PROGRAMS = {
+    'factorial': [
+        "def factorial(n):",
+        "    if n < 2:",
+        "        return 1",
+        "    return n * factorial(n - 1)",
+        "for i in range(50):",
+        "    f = factorial(90)",
+        "print(f % 1000)",
+    ],
+    'fibonacci': [
+        "def fib(n):",
+        "    if n < 2:",
+        "        return n",
+        "    return fib(n - 1) + fib(n - 2)",
+        "print(fib(16))",
+    ],
+}
+
+
+# the spare frames kept when comparing frame reuse (frame reuse is off
+# in the game, see FRAME_POOL_SIZE)
+REUSED_FRAMES = 100
+
+
+class LegacyDispatchVM(VirtualMachine):
+    """ the original dispatch path, which built the method name as a string
+    and used getattr for every instruction. Kept for comparison only."""
+    def __init__(self, robot):
+        super().__init__(robot)
+        # superinstructions and trace points have no byte_ method
+        self.fuse_instructions = False
+        self.inline_name_caches = False
+        self.record_trace = False
+
+    def dispatch(self, byte_code, argument):
+        byte_name = dis.opname[byte_code]
+        stack_unwind_reason = None
+        try:
+            bytecode_fn = getattr(self, 'byte_%s' % byte_name, None)
+            if bytecode_fn is None:
+                if byte_name.startswith('UNARY_'):
+                    self.unaryOperator(byte_name[6:])
+                elif byte_name.startswith('BINARY_'):
+                    self.binaryOperator(byte_name[7:])
+                elif byte_name.startswith('INPLACE_'):
+                    self.inplaceOperator(byte_name[8:])
+                else:
+                    stack_unwind_reason = 'quit'
+            else:
+                stack_unwind_reason = bytecode_fn(*argument)
+        except:
+            self.last_exception = sys.exc_info()[:2] + (None,)
+            stack_unwind_reason = 'exception'
+        return stack_unwind_reason
+
+
+class CountingVM(VirtualMachine):
+    """ counts the bytecodes executed, so we can report a rate """
+    def __init__(self, robot):
+        super().__init__(robot)
+        self.bytecode_count = 0
+
+    def dispatch(self, byte_code, argument):
+        self.bytecode_count += 1
+        return super().dispatch(byte_code, argument)
+
+
+def run_program(source, vm_class=VirtualMachine, native=False, fuse=False,
+                caches=False, history=False):
+    """ compile and run a program on a fresh VM.
+    Returns the robot (for its output) and the execution time in seconds"""
+    robot = StubRobot(vm_class)
+    vm = robot.python_interpreter
+    # native regions, superinstructions, name caches and trace points
+    # change what the dispatch loop does, so they are off by default
+    vm.native_execution = native
+    vm.fuse_instructions = fuse
+    vm.inline_name_caches = caches
+    vm.record_history = history
+    vm.record_trace = False
+    # we never want to yield to the (stub) renderer during a benchmark
+    vm.instruction_budget = sys.maxsize
+    vm.time_slice = None
+    vm.load(source)
+    # the VM echoes its bytecode and return values to the console,
+    # which would swamp the timings
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm.compile()
+        start = time.perf_counter()
+        vm.run()
+        elapsed = time.perf_counter() - start
+    return robot, elapsed
+
+
+def best_time(source, vm_class, repeats, native=False, fuse=False,
+              caches=False, history=False):
+    return min(run_program(source, vm_class, native, fuse, caches,
+                           history)[1]
+               for _ in range(repeats))
+
+
+def compare_dispatch(repeats=5):
+    """ bytecodes per second for the legacy and table-driven dispatch """
+    print('{0:<18}{1:>10}{2:>14}{3:>14}{4:>9}'.format(
+        'program', 'bytecodes', 'legacy bc/s', 'table bc/s', 'speedup'))
+    for name, source in PROGRAMS.items():
+        robot, _ = run_program(source, CountingVM)
+        count = robot.python_interpreter.bytecode_count
+        legacy = best_time(source, LegacyDispatchVM, repeats)
+        table = best_time(source, VirtualMachine, repeats)
+        print('{0:<18}{1:>10}{2:>14.0f}{3:>14.0f}{4:>8.2f}x'.format(
+            name, count, count / legacy, count / table, legacy / table))
+
+
+def compare_native(repeats=5):
+    """ run time with and without native regions (see native_regions.py) """
+    print('{0:<18}{1:>16}{2:>16}{3:>9}'.format(
+        'program', 'interpreted ms', 'native ms', 'speedup'))
+    for name, source in PROGRAMS.items():
+        interpreted = best_time(source, VirtualMachine, repeats)
+        native = best_time(source, VirtualMachine, repeats, native=True)
+        print('{0:<18}{1:>16.2f}{2:>16.2f}{3:>8.2f}x'.format(
+            name, interpreted * 1000, native * 1000, interpreted / native))
+
+
+def compare_engines(repeats=5):
+    """ run time on the bytecode VM (with native regions) and the
+    trace engine (see trace_engine.py) """
+    print('{0:<18}{1:>16}{2:>16}{3:>9}'.format(
+        'program', 'vm ms', 'trace ms', 'speedup'))
+    for name, source in PROGRAMS.items():
+        vm = best_time(source, VirtualMachine, repeats, native=True)
+        trace = best_time(source, TraceEngine, repeats)
+        print('{0:<18}{1:>16.2f}{2:>16.2f}{3:>8.2f}x'.format(
+            name, vm * 1000, trace * 1000, vm / trace))
+
+
+def sentry_time(programs, vm_class, repeats, fuse=True):
+    """ the best time to run a sentry's programs. A sentry keeps the same
+    VM all through a level, so the first run (which decodes the bytecode)
+    is not counted """
+    robot = StubRobot(vm_class)
+    if run_sentry(robot, programs, fuse) is None:
+        return None
+    return min(run_sentry(robot, programs, fuse) for _ in range(repeats))
+
+
+def run_sentry(robot, programs, fuse=True):
+    """ run a sentry's init, display and validate programs in turn, as the
+    game does. Returns the total execution time in seconds, or None if
+    any of the programs won't compile """
+    vm = robot.python_interpreter
+    vm.fuse_instructions = fuse
+    vm.record_history = False  # as for sentries in the game
+    vm.record_trace = False
+    vm.instruction_budget = sys.maxsize
+    vm.time_slice = None
+    elapsed = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name in ('init', 'display', 'validate'):
+            if not programs.get(name):
+                continue
+            vm.load(programs[name])
+            if not vm.compile(cache=True)[0]:
+                return None
+            vm.run_enabled = True
+            start = time.perf_counter()
+            vm.run()
+            elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def compare_sentries(repeats=50):
+    """ run time for each of the sentry programs in the game, on the
+    bytecode VM and the ast engine (see ast_engine.py) """
+    print('{0:<18}{1:>16}{2:>16}{3:>9}'.format(
+        'sentry', 'vm us', 'ast us', 'speedup'))
+    for sentry in file_parser.parse_file(SENTRY_FILE):
+        vm = sentry_time(sentry, VirtualMachine, repeats)
+        ast = sentry_time(sentry, ASTEngine, repeats)
+        if vm is None or ast is None:
+            print('{0:<18}{1:>16}{2:>16}'.format(
+                sentry['name'], 'n/a' if vm is None else '',
+                'n/a' if ast is None else ''))
+            continue
+        print('{0:<18}{1:>16.1f}{2:>16.1f}{3:>8.2f}x'.format(
+            sentry['name'], vm * 1e6, ast * 1e6, vm / ast))
+
+
+def compare_fusion(repeats=50):
+    """ instructions dispatched with and without superinstructions
+    (see superinstructions.py) for each of the sentry programs """
+    print('{0:<18}{1:>11}{2:>11}{3:>8}{4:>12}{5:>12}{6:>9}'.format(
+        'sentry', 'dispatches', 'fused', 'saved', 'plain us', 'fused us',
+        'speedup'))
+    total_plain = total_fused = 0
+    for sentry in file_parser.parse_file(SENTRY_FILE):
+        counts = []
+        for fuse in (False, True):
+            robot = StubRobot(CountingVM)
+            if run_sentry(robot, sentry, fuse) is None:
+                break
+            counts.append(robot.python_interpreter.bytecode_count)
+        if len(counts) < 2:
+            print('{0:<18}{1:>11}'.format(sentry['name'], 'n/a'))
+            continue
+        plain, fused = counts
+        total_plain += plain
+        total_fused += fused
+        plain_time = sentry_time(sentry, VirtualMachine, repeats, False)
+        fused_time = sentry_time(sentry, VirtualMachine, repeats, True)
+        print('{0:<18}{1:>11}{2:>11}{3:>7.0f}%{4:>12.1f}{5:>12.1f}'
+              '{6:>8.2f}x'.format(sentry['name'], plain, fused,
+                                  100 * (plain - fused) / plain,
+                                  plain_time * 1e6, fused_time * 1e6,
+                                  plain_time / fused_time))
+    print('{0:<18}{1:>11}{2:>11}{3:>7.0f}%'.format(
+        'total', total_plain, total_fused,
+        100 * (total_plain - total_fused) / total_plain))
+
+
+def compare_name_caches(repeats=5):
+    """ run time with and without the inline caches on LOAD_NAME and
+    LOAD_GLOBAL (see interpreter.add_name_caches) """
+    print('{0:<26}{1:>16}{2:>16}{3:>9}'.format(
+        'program', 'uncached ms', 'cached ms', 'speedup'))
+    for name, source in PROGRAMS.items():
+        for fuse in (False, True):
+            uncached = best_time(source, VirtualMachine, repeats, fuse=fuse)
+            cached = best_time(source, VirtualMachine, repeats, fuse=fuse,
+                               caches=True)
+            label = name + (' (fused)' if fuse else '')
+            print('{0:<26}{1:>16.2f}{2:>16.2f}{3:>8.2f}x'.format(
+                label, uncached * 1000, cached * 1000, uncached / cached))
+
+
+def compare_history(repeats=5):
+    """ run time with and without recording snapshots for replaying
+    (see snapshots.py), and the number of snapshots kept """
+    print('{0:<18}{1:>16}{2:>16}{3:>9}{4:>11}'.format(
+        'program', 'plain ms', 'recording ms', 'cost', 'snapshots'))
+    for name, source in PROGRAMS.items():
+        plain = best_time(source, VirtualMachine, repeats, fuse=True,
+                          caches=True)
+        recording = best_time(source, VirtualMachine, repeats, fuse=True,
+                              caches=True, history=True)
+        robot = run_program(source, fuse=True, caches=True, history=True)[0]
+        print('{0:<18}{1:>16.2f}{2:>16.2f}{3:>8.2f}x{4:>11}'.format(
+            name, plain * 1000, recording * 1000, recording / plain,
+            len(robot.python_interpreter.history)))
+
+
+def recursion_run(source, pool_size, trace=False):
+    """ run a program on a fresh VM, keeping up to pool_size spare frames
+    for reuse. Returns the execution time in seconds and, if trace is
+    True, the peak memory allocated during the run (from tracemalloc)"""
+    robot = StubRobot()
+    vm = robot.python_interpreter
+    vm.frame_pool_size = pool_size
+    vm.record_history = False
+    vm.record_trace = False
+    vm.instruction_budget = sys.maxsize
+    vm.time_slice = None
+    vm.load(source)
+    peak = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm.compile()
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        vm.run()
+        elapsed = time.perf_counter() - start
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return elapsed, peak
+
+
+def compare_recursion(repeats=5):
+    """ time and memory for deep recursion, with and without frame reuse.
+    Memory is measured on a separate run, since tracemalloc
+    slows everything down """
+    print('{0:<18}{1:>10}{2:>10}{3:>9}{4:>12}{5:>12}'.format(
+        'program', 'new ms', 'reuse ms', 'speedup', 'new KiB', 'reuse KiB'))
+    for name, source in RECURSIVE_PROGRAMS.items():
+        results = []
+        for pool_size in (0, REUSED_FRAMES):
+            elapsed = min(recursion_run(source, pool_size)[0]
+                          for _ in range(repeats))
+            peak = recursion_run(source, pool_size, trace=True)[1]
+            results.append((elapsed, peak))
+        (new, new_peak), (reuse, reuse_peak) = results
+        print('{0:<18}{1:>10.2f}{2:>10.2f}{3:>8.2f}x{4:>12.1f}{5:>12.1f}'
+              .format(name, new * 1000, reuse * 1000, new / reuse,
+                      new_peak / 1024, reuse_peak / 1024))
+
+
+def compare_ast_engine(repeats=5):
+    """ run time on the bytecode VM and the ast engine """
+    print('{0:<18}{1:>16}{2:>16}{3:>9}'.format(
+        'program', 'vm ms', 'ast ms', 'speedup'))
+    for name, source in PROGRAMS.items():
+        vm = best_time(source, VirtualMachine, repeats)
+        ast = best_time(source, ASTEngine, repeats)
+        print('{0:<18}{1:>16.2f}{2:>16.2f}{3:>8.2f}x'.format(
+            name, vm * 1000, ast * 1000, vm / ast))
+
+
+if __name__ == '__main__':
+    # silence the per-program console chatter from the VM
+    interpreter.console_msg = lambda *args, **kwargs: None
+    trace_engine.console_msg = interpreter.console_msg
+    ast_engine.console_msg = interpreter.console_msg
+    compare_dispatch()
+    print()
+    compare_native()
+    print()
+    compare_engines()
+    print()
+    compare_ast_engine()
+    print()
+    compare_sentries()
+    print()
+    compare_fusion()
+    print()
+    compare_name_caches()
+    print()
+    compare_recursion()
+    print()
+    compare_history()
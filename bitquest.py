@@ -2,6 +2,7 @@
  BitQuest module to handle the game world rendering
  and character movement
 """
+import multiprocessing
 import random
 import time
 import uuid
@@ -17,50 +18,63 @@ from constants import *
 https://wiki.libsdl.org/Installation
 https://github.com/pygame/pygame/issues/1722
 '''
-console_msg('Started. Version ' + VERSION, 0)
 
-# set environment variables to request the window manager to position the top left of the game window
-import os
-DEFAULT = 0, 30  # used for single monitor display - put window in top left
-DEVON_OFFICE = -1250, 780  # centred on laptop display
-position = DEFAULT
-os.environ['SDL_VIDEO_WINDOW_POS'] = str(position[0]) + "," + str(position[1])
 
-pygame.init()
-pygame.display.set_caption("BIT Quest")
+def main():
+    console_msg('Started. Version ' + VERSION, 0)
 
-# the actual game window
-screen = pygame.display.set_mode(WINDOW_SIZE)
-# the rendering surface for the game (heavily scaled)
-display = pygame.Surface(DISPLAY_SIZE)
+    # set environment variables to request the window manager to position the top left of the game window
+    import os
+    DEFAULT = 0, 30  # used for single monitor display - put window in top left
+    DEVON_OFFICE = -1250, 780  # centred on laptop display
+    position = DEFAULT
+    os.environ['SDL_VIDEO_WINDOW_POS'] = str(position[0]) + "," + str(position[1])
 
-game_world = None
-game_menu = menu.Menu(screen, bypass=not SHOW_LOGIN_MENU)
-level = game_menu.display()
-print("level", level)
+    pygame.init()
+    pygame.display.set_caption("BIT Quest")
 
-if not game_menu.quit():
-    # create the world
-    game_world = world.World(screen, display, game_menu.session)
+    # the actual game window
+    screen = pygame.display.set_mode(WINDOW_SIZE)
+    # the rendering surface for the game (heavily scaled)
+    display = pygame.Surface(DISPLAY_SIZE)
 
-    # set it in motion
-    while not game_menu.quit():
-        # when programs are running, the world is updated from the interpreter
-        # so we don't want to do it here as well, because it will just slow the
-        # intepreter down
-        if game_world.playing:
-            if game_menu.level != game_world.level:
-                # recreate the entire world to switch to the new level
-                game_world = world.World(screen, display, game_menu.session, game_menu.level)
-            # keep the camera focussed on BIT while he is doing something
-            if game_world.dog.busy:
-                game_world.update(game_world.dog)
+    game_world = None
+    game_menu = menu.Menu(screen, bypass=not SHOW_LOGIN_MENU)
+    level = game_menu.display()
+    print("level", level)
+
+    if not game_menu.quit():
+        # create the world
+        game_world = world.World(screen, display, game_menu.session)
+
+        # set it in motion
+        while not game_menu.quit():
+            # running programs are advanced a little each frame from here,
+            # so the main loop keeps control of frame pacing and event handling
+            if game_world.playing:
+                if game_menu.level != game_world.level:
+                    # recreate the entire world to switch to the new level
+                    game_world = world.World(screen, display, game_menu.session, game_menu.level)
+                game_world.run_programs()
+                # keep the camera focussed on BIT while he is doing something
+                if (game_world.dog.busy or
+                        game_world.dog.get_interpreter().is_running()):
+                    game_world.update(game_world.dog)
+                else:
+                    game_world.update(game_world.player)
             else:
-                game_world.update(game_world.player)
-        else:
-            # the return value from the menu determines whether
-            # we keep playing or quit
-            game_world.playing = game_menu.display()
+                # the return value from the menu determines whether
+                # we keep playing or quit
+                game_world.playing = game_menu.display()
+                # the menu was drawn over the game
+                game_world.dirty_rects.redraw_all()
+
+    # tidy up and quit
+    pygame.quit()
+
 
-# tidy up and quit
-pygame.quit()
+if __name__ == '__main__':
+    # the worker processes that run programs (see process_engine.py)
+    # import this module too, but mustn't start another game
+    multiprocessing.freeze_support()
+    main()
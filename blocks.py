@@ -934,17 +934,6 @@ class BlockMap:
                                 self.highlight_block(surface, b,
                                                      COLOUR_MOVING_BLOCK)
 
-        # give any moving blocks a chance to update
-        # if any are currently moving, we set busy to true, so that
-        # the player program is paused until the moves are complete
-        # and also tell the camera to shake
-        self.busy = False
-        self.camera.set_shaking(False)
-        for m in self.movers:
-            if self.movers[m].update(self.midground_blocks):
-                self.busy = True
-                self.camera.set_shaking(True)
-
         if self.map_edit_mode:
             # if we are in trigger linking mode, run a line from the
             # cursor to the trigger block
@@ -985,6 +974,35 @@ class BlockMap:
                         pygame.draw.line(surface, COLOUR_NORMAL_LINK,
                                          trigger_pos, mover_pos)
 
+    def update_movers(self):
+        """ give any moving blocks a chance to update, by one tick of the
+        simulation (see World.simulate).
+        If any are currently moving, we set busy to true, so that
+        the player program is paused until the moves are complete
+        and also tell the camera to shake """
+        self.busy = False
+        self.camera.set_shaking(False)
+        for m in self.movers:
+            if self.movers[m].update(self.midground_blocks):
+                self.busy = True
+                self.camera.set_shaking(True)
+
+    def mover_rects(self, scroll):
+        """ where each block that can move is drawn on the display, so
+        that it is presented again whenever it might have moved """
+        return [pygame.Rect(b.x - scroll[X], b.y - scroll[Y],
+                            BLOCK_SIZE, BLOCK_SIZE)
+                for m in self.movers.values() for b in m.blocks if b]
+
+    def trigger_rects(self, scroll):
+        """ where each trigger block is drawn on the display, so that it
+        is presented again whenever its image might have changed (eg a
+        flagpole unfurling, or a pressure plate being pressed) """
+        return [pygame.Rect(b.x - scroll[X], b.y - scroll[Y],
+                            BLOCK_SIZE, BLOCK_SIZE)
+                for t in self.triggers
+                for b in getattr(t, 'blocks', [t.block]) if b]
+
     def highlight_block(self, surface, block, colour):
         left = block.x - self.camera.scroll_x()
         top = block.y - self.camera.scroll_y()
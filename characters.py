@@ -11,6 +11,9 @@ import interpreter
 from constants import *
 import sprite_sheet
 from interpreter import VirtualMachine
+from trace_engine import TraceEngine
+from ast_engine import ASTEngine
+from process_engine import ProcessEngine
 from particles import Jet
 from console_messages import console_msg
 from text_panel import SpeechBubble
@@ -45,6 +48,7 @@ class Character:
         self.moving_down = False;
         self.location = pygame.Rect((0, 0), self.size)
         self.frame_number = 0
+        self.frame = self.standing_right_frame  # the sprite drawn next
         self.run_speed = 2  # default run speed
         self.x_speed = self.run_speed
         self.y_speed = self.run_speed  # x & y speeds default to run speed
@@ -86,8 +90,15 @@ class Character:
                                           * self.frame_count
 
     def update(self, surface, scroll):
+        # move on by one tick, and draw the result
+        self.step()
+        return self.draw(surface, scroll)
+
+    def step(self):
         """movement system & collisions based on daFluffyPotato
-        (https://www.youtube.com/watch?v=abH2MSBdnWc)"""
+        (https://www.youtube.com/watch?v=abH2MSBdnWc)
+        This moves the character on by one tick of the simulation, which
+        can run several times per frame (see World.simulate)"""
 
         if self.subject_to_gravity:
             self.y_momentum += GRAVITY
@@ -118,19 +129,19 @@ class Character:
         f = int(self.frame_number) % self.frame_count
         self.frame_number = self.frame_number + .25
         if self.moving_right:
-            frame = self.move_right_frames[f]
+            self.frame = self.move_right_frames[f]
         elif self.moving_left:
-            frame = self.move_left_frames[f]
+            self.frame = self.move_left_frames[f]
         elif self.moving_up or self.moving_down:
             if self.facing_right:
-                frame = self.move_vertical_right_frames[f]
+                self.frame = self.move_vertical_right_frames[f]
             else:
-                frame = self.move_vertical_left_frames[f]
+                self.frame = self.move_vertical_left_frames[f]
         else:  # standing
             if self.facing_right:
-                frame = self.standing_right_frame
+                self.frame = self.standing_right_frame
             else:
-                frame = self.standing_left_frame
+                self.frame = self.standing_left_frame
 
         # cancel movement if we have collided in that direction
         if self.collisions['up']:
@@ -154,8 +165,10 @@ class Character:
             self.location.bottom = (round(self.location.bottom / BLOCK_SIZE)
                                     * BLOCK_SIZE)
 
-        surface.blit(frame, (self.location.x - scroll[X],
-                         self.location.y - scroll[Y]))
+    def draw(self, surface, scroll):
+        """ returns the rect that was drawn """
+        return surface.blit(self.frame, (self.location.x - scroll[X],
+                                         self.location.y - scroll[Y]))
 
     def move_left(self):
         # request the character to begin moving
@@ -307,6 +320,15 @@ class Ghostly(Character):
         return rectangle, collision_directions
 
 
+# the engines that a robot can use to run its programs
+PYTHON_ENGINES = {
+    'vm': VirtualMachine,
+    'trace': TraceEngine,
+    'ast': ASTEngine,
+    'process': ProcessEngine,
+}
+
+
 class Robot(Character):
     """ Not affected by gravity,
         Has a rocket animation when in the air
@@ -321,9 +343,12 @@ class Robot(Character):
         self.busy = False  # used to block code execution during movement
         self.speaking = False
         self.speech_bubble = None
-        self.python_interpreter = VirtualMachine(self)
+        self.python_interpreter = PYTHON_ENGINES[PYTHON_ENGINE](self)
         console_msg(name + " command interpreter initialised", 2)
         self.source_code = []
+        # programs that are run repeatedly (ie by sentries) keep their
+        # compiled code in the interpreter's cache
+        self.cache_programs = False
         self.output = []
 
         self.jets = []  # the particle streams that appear when flying
@@ -364,6 +389,16 @@ class Robot(Character):
     def get_interpreter(self):
         return self.python_interpreter;
 
+    def set_engine(self, engine_name):
+        """ switch to a different engine for running programs,
+        eg to compare the VM and trace engines on the same level"""
+        if not isinstance(self.python_interpreter, PYTHON_ENGINES[engine_name]):
+            self.python_interpreter.halt()
+            run_enabled = self.python_interpreter.run_enabled
+            self.python_interpreter = PYTHON_ENGINES[engine_name](self)
+            self.python_interpreter.run_enabled = run_enabled
+            console_msg(self.name + " using the " + engine_name + " engine", 2)
+
     def set_position(self, grid_position):
         super().set_position(grid_position)
         self.destination = [grid_position[X], grid_position[Y]]
@@ -397,9 +432,17 @@ class Robot(Character):
 
     def input(self, msg=''):
         # get input from the user in a separate editor window
-        self.world.input.activate('input:' + msg)
+        self.begin_input(msg)
         while self.world.input.is_active():
             self.world.update(self)
+        return self.end_input()
+
+    def begin_input(self, msg=''):
+        # open the input window, without waiting for the user to finish
+        self.world.input.activate('input:' + msg)
+
+    def end_input(self):
+        # collect the text from the input window, once it has closed
         result = self.world.input.convert_to_lines()[0]
         console_msg("input:" + str(result), 8)
         return result
@@ -432,7 +475,7 @@ class Robot(Character):
         position = [self.location.x, self.location.y - self.speech_bubble.get_rendered_text_height() / SCALING_FACTOR - 8]
         return position
 
-    def update(self, surface, scroll):
+    def step(self):
         if self.destination[X] > self.gridX():
             self.moving_right = True
         elif self.destination[X] < self.gridX():
@@ -441,7 +484,7 @@ class Robot(Character):
             self.moving_down = True
         elif self.destination[Y] < self.gridY():
             self.moving_up = True
-        super().update(surface, scroll)
+        super().step()
         if (self.moving_up or
                 self.moving_down or
                 self.moving_right or
@@ -470,20 +513,30 @@ class Robot(Character):
             self.wobble_counter = (self.wobble_counter +1) % len(self.wobble)
             self.jets[0].nozzle[X] = self.location.left + wobble_factor[X] + 4
             self.jets[0].nozzle[Y] = self.location.bottom + wobble_factor[Y] + 2
-            self.jets[0].update(surface, scroll)
+            self.jets[0].step()
             self.jets[1].nozzle[X] = self.location.right + wobble_factor[X] - 4
             self.jets[1].nozzle[Y] = self.location.bottom + wobble_factor[Y] + 2
-            self.jets[1].update(surface, scroll)
+            self.jets[1].step()
 
-    def run_program(self):
-        """ pass the text in the editor to the interpreter"""
+    def draw(self, surface, scroll):
+        rect = super().draw(surface, scroll)
+        if self.jets[0].is_active():
+            rect = rect.unionall([self.jets[0].draw(surface, scroll),
+                                  self.jets[1].draw(surface, scroll)])
+        return rect
+
+    def run_program(self, on_finish=None):
+        """ pass the text in the editor to the interpreter
+        If on_finish is given, the program is stepped by the game loop and
+        on_finish(success, errors) is called when it ends.
+        Otherwise the program runs to completion before this returns"""
         # run_enabled is set false on each run
         # and cleared using the reset button
         if self.python_interpreter.run_enabled:
             self.clear_all_output()
             p = self.python_interpreter  # for brevity
             p.load(self.get_source_code())
-            result, errors = p.compile()
+            result, errors = p.compile(cache=self.cache_programs)
             if result is False:  # check for syntax errors
                 # TODO display these using in-game dialogs
                 if p.compile_time_error:
@@ -492,6 +545,10 @@ class Robot(Character):
                     console_msg(self.name + ' SYNTAX ERROR:', 5)
                     msg = error_msg + " on line " + str(error_line)
                     console_msg(msg, 5)
+                if on_finish:
+                    on_finish(result, errors)
+            elif on_finish:
+                p.start(on_finish)  # set the program going
             else:
                 result, errors = p.run()  # set the program going
             return result, errors
@@ -5,6 +5,7 @@ import interpreter
 from console_messages import console_msg
 from constants import *
 from editor import Editor
+from snapshots import WORLD_PREFIX
 
 
 class CodeWindow(Editor):
@@ -28,22 +29,59 @@ class CodeWindow(Editor):
                            pygame.K_PAGEDOWN: self.page_down,
                            pygame.K_TAB: self.tab,
                            pygame.K_F5: self.run_program,
+                           pygame.K_F6: self.robot.world.cycle_simulation_speed,
+                           pygame.K_F7: self.replay_back,
+                           pygame.K_F8: self.replay_forward,
                            }
         # add 2 new shortcuts for loading and saving programs
         self.ctrl_shortcuts[pygame.K_s] = self.save_program
         self.ctrl_shortcuts[pygame.K_o] = self.load_program
+        # replaying the last run from its history (see snapshots.py)
+        # the replay index is None when the editor isn't replaying
+        self.replay_index = None
+        self.replay_state = None  # (snapshot, names, output) at the index
+        self.replay_history = None  # the history being replayed
+        self.scrubbing = False  # True while the scrub bar is being dragged
+        # the scrub bar runs along the bottom, up to the button tray
+        tray_top = self.buttons.top_left[Y]
+        self.scrub_bar = pygame.Rect(
+            self.left_margin, tray_top,
+            self.buttons.top_left[X] - self.left_margin - self.char_width,
+            self.buttons.tray_size[Y])
+        # variables are listed in a panel on the right while replaying
+        self.replay_panel_left = self.width * 2 // 3
+        # the editor row of each line of the program that is running
+        # (see interpreter.source_rows)
+        self.running_rows = []
 
     def draw(self):
+        history = self.get_history()
+        if history is not self.replay_history:
+            self.end_replay()  # the program has been run again
+        self.highlighted_row = self.executing_row()
         super().draw()
         # draw UI buttons
         self.buttons.draw(self.get_fg_color(), self.get_bg_color())
+        if history:
+            self.draw_scrub_bar()
+        if self.replay_index is not None:
+            self.draw_replay_panel()
+
+    def update(self):
+        super().update()
+        if self.scrubbing:
+            self.scrub_to_mouse()
 
     def left_click(self):
         # check whether to click a button or reposition the cursor
         mouse_pos = (pygame.mouse.get_pos()[X],
                      pygame.mouse.get_pos()[Y] -
                      self.screen.get_size()[Y] + self.height)
-        if self.surface.get_rect().collidepoint(mouse_pos):
+        if self.scrub_bar.collidepoint(mouse_pos) and self.get_history():
+            self.scrubbing = True
+            self.selecting = False
+            self.scrub_to_mouse()
+        elif self.surface.get_rect().collidepoint(mouse_pos):
             button_result = self.buttons.click(mouse_pos)
             if button_result is None:
                 self.cursor_to_mouse_pos()
@@ -66,6 +104,123 @@ class CodeWindow(Editor):
     def mouse_up(self):
         super().mouse_up()
         self.buttons.release()  # also unclick any clicked buttons
+        self.scrubbing = False
+
+    def executing_row(self):
+        """ the editor row of the line BIT's program is running, or of
+        the line being replayed, or None if neither """
+        vm = self.robot.get_interpreter()
+        if self.replay_index is not None:
+            snapshot = self.replay_state[0]
+            if snapshot.code_obj is None:
+                return None
+            line = vm.line_at(snapshot.code_obj, snapshot.offset)
+        else:
+            # only the bytecode VM keeps track of its line
+            current_line = getattr(vm, 'current_line', None)
+            if current_line is None:
+                return None
+            line = current_line()
+        if line and line <= len(self.running_rows):
+            return self.running_rows[line - 1]
+        return None
+
+    def get_history(self):
+        """ the snapshots from BIT's last run, or None if there aren't any.
+        Only the bytecode VM records them"""
+        history = getattr(self.robot.get_interpreter(), 'history', None)
+        if history is None or len(history) == 0:
+            return None
+        return history
+
+    def replay(self, index):
+        """ show the state of the last run at one of its snapshots """
+        history = self.get_history()
+        if history is None:
+            self.end_replay()
+            return
+        index = max(0, min(index, len(history) - 1))
+        if index != self.replay_index or history is not self.replay_history:
+            self.replay_index = index
+            self.replay_state = history.state_at(index)
+            self.replay_history = history
+
+    def end_replay(self):
+        self.replay_index = None
+        self.replay_state = None
+        self.replay_history = None
+
+    def replay_back(self):
+        history = self.get_history()
+        if history is None:
+            return
+        if self.replay_index is None:
+            # start from the end of the run
+            self.replay(len(history) - 1)
+        else:
+            self.replay(self.replay_index - 1)
+
+    def replay_forward(self):
+        if self.replay_index is not None:
+            self.replay(self.replay_index + 1)
+
+    def scrub_to_mouse(self):
+        """ move the replay to the snapshot under the mouse pointer """
+        history = self.get_history()
+        if history is None:
+            return
+        x = pygame.mouse.get_pos()[X] - self.scrub_bar.left
+        fraction = max(0.0, min(1.0, x / self.scrub_bar.width))
+        self.replay(round(fraction * (len(history) - 1)))
+
+    def draw_scrub_bar(self):
+        history = self.get_history()
+        pygame.draw.rect(self.surface, self.get_fg_color(), self.scrub_bar, 1)
+        if self.replay_index is not None:
+            if len(history) > 1:
+                fraction = self.replay_index / (len(history) - 1)
+            else:
+                fraction = 1.0
+            marker_width = 4
+            marker_x = (self.scrub_bar.left + fraction *
+                        (self.scrub_bar.width - marker_width))
+            marker = pygame.Rect(marker_x, self.scrub_bar.top,
+                                 marker_width, self.scrub_bar.height)
+            pygame.draw.rect(self.surface, self.get_fg_color(), marker)
+
+    def draw_replay_panel(self):
+        """ list the program's variables and output at the current snapshot,
+        over the right hand side of the editor """
+        history = self.get_history()
+        snapshot, names, output = self.replay_state
+        panel = pygame.Rect(self.replay_panel_left, self.top_margin,
+                            self.width - self.replay_panel_left
+                            - self.side_gutter,
+                            self.scrub_bar.top - self.top_margin)
+        pygame.draw.rect(self.surface, self.get_bg_color(), panel)
+        pygame.draw.rect(self.surface, self.get_fg_color(), panel, 1)
+        lines = ['step {0}/{1} (instruction {2})'.format(
+            self.replay_index + 1 + history.dropped,
+            len(history) + history.dropped, snapshot.instruction)]
+        # the program's own variables first, then the world's
+        program_names = sorted(n for n in names
+                               if not n.startswith(WORLD_PREFIX))
+        world_names = sorted(n for n in names if n.startswith(WORLD_PREFIX))
+        for name in program_names + world_names:
+            lines.append(name + ' = ' + names[name])
+        if output:
+            lines.append('output:')
+            lines.extend(output)
+        max_chars = max(1, (panel.width - 4) // self.char_width)
+        max_rows = panel.height // self.line_height
+        # the most recent output is the most useful, so keep the end
+        if len(lines) > max_rows:
+            lines = lines[:1] + lines[len(lines) - max_rows + 1:]
+        for row, line in enumerate(lines):
+            rendered = self.code_font.render(line[:max_chars], True,
+                                             self.get_fg_color())
+            self.surface.blit(rendered, (panel.left + 2,
+                                         panel.top + row * self.line_height))
 
     def save_program(self):
         """save source code to a default filename"""
@@ -89,13 +244,21 @@ class CodeWindow(Editor):
                 self.text.append(line)
 
     def run_program(self):
+        self.end_replay()  # the new run replaces the history
         self.robot.set_source_code(self.text)
-        success, errors = self.robot.run_program()
+        # keep a copy of the code, since the editor may change while it runs
+        self.running_source = interpreter.convert_to_lines(self.text)
+        self.running_rows = interpreter.source_rows(self.text)
+        self.robot.run_program(on_finish=self.program_finished)
+
+    def program_finished(self, success, errors):
         # if the code compiled ok, we check next that output matched expected
         if success:
             self.robot.world.validate_attempt()
         # save this attempt, regardless of whether it had errors or not
-        self.session.save_run(interpreter.convert_to_lines(self.text), errors)
+        trace = getattr(self.robot.get_interpreter(), 'trace', None)
+        self.session.save_run(self.running_source, errors,
+                              trace.entries() if trace else None)
 
     # def run_program(self):
     #     """ pass the text in the editor to the interpreter"""
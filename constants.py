@@ -46,6 +46,92 @@ SENTRY_END = '</SENTRY>'
 # Robot Sentry constants
 SENTRY_LISTENING_RANGE = 15
 
+# interpreter scheduling constants
+# the VM runs up to this many bytecodes between rendered frames
+# setting it to 1 restores the old behaviour of one frame per bytecode
+INSTRUCTION_BUDGET = 500
+# maximum time (in seconds) the VM may run before yielding to the renderer
+# this keeps the framerate smooth when individual bytecodes are slow
+INSTRUCTION_TIME_SLICE = 0.008
+# when True, programs are advanced a little each frame by the main loop
+# rather than running to completion inside the interpreter
+STEPPED_EXECUTION = True
+# when True, runs of simple bytecodes are dispatched together as one
+# superinstruction (see superinstructions.py)
+FUSE_INSTRUCTIONS = True
+# when True, each LOAD_NAME/LOAD_GLOBAL instruction remembers where it last
+# found its name, so repeated lookups (eg in loops) skip the dict search.
+# Off, because the benchmark (compare_name_caches) shows no reliable gain
+INLINE_NAME_CACHES = False
+# spare call frames each interpreter keeps for reuse, so recursive
+# functions don't allocate a new frame for every call. 0 turns this off,
+# which it is, because the benchmark (compare_recursion) shows no gain
+FRAME_POOL_SIZE = 0
+# when True, BIT's programs keep a history of snapshots that the player can
+# scrub through afterwards (see snapshots.py)
+RECORD_HISTORY = True
+HISTORY_INTERVAL = 50  # instructions between snapshots
+HISTORY_CAPACITY = 500  # snapshots kept, the oldest are merged away
+HISTORY_MAX_OUTPUT_LINES = 50  # lines of output shown with a snapshot
+# when True, each attempt saved in the session log has a trace of the lines
+# the program ran (see line_trace.py)
+RECORD_TRACE = True
+TRACE_MAX_ENTRIES = 200  # entries kept, from the start and end of the run
+TRACE_MAX_SPAN = 8  # longest run of entries (eg a loop body) merged on repeat
+# when True, the interpreter records time spent per opcode and source line
+PROFILE_INTERPRETER = False
+PROFILE_OUTPUT_FILE = None  # file to append profiles to, None for the console
+# watchdog limits for each program run, to stop runaway programs
+# setting any of these to None disables that limit
+WATCHDOG_MAX_BYTECODES = 5000000
+WATCHDOG_MAX_SECONDS = 300
+WATCHDOG_MAX_FRAMES = 60 * 300  # ie 5 minutes at 60fps
+# bytecodes allowed without any output or change to a world variable
+WATCHDOG_NO_PROGRESS_BYTECODES = 1000000
+WATCHDOG_CHECK_INTERVAL = 1000  # bytecodes between watchdog checks
+# resource quotas for each program run (see quotas.py)
+# setting any of these to None disables that limit
+QUOTA_MAX_CALL_DEPTH = 100  # nested function calls, eg recursion
+QUOTA_MAX_OUTPUT_LINES = 1000
+QUOTA_MAX_OUTPUT_CHARS = 100000
+QUOTA_MAX_INT_BITS = 100000  # about 30,000 decimal digits
+QUOTA_MAX_CONTAINER_LENGTH = 1000000  # items in a list/string/dict etc
+# tracing memory with tracemalloc catches everything, but slows programs down
+QUOTA_TRACE_MEMORY = False
+QUOTA_MAX_MEMORY = 256 * 1024 * 1024  # bytes, only checked when tracing
+# limits for marking logged attempts with grader.py. Students' programs
+# get much less time than in the game, so a few stuck ones can't hold up
+# the whole class
+GRADER_MAX_SECONDS = 5
+GRADER_MAX_BYTECODES = 200000
+# when True, for loops that never touch the world or print (see
+# native_regions.py) run as native python instead of on the interpreter
+NATIVE_EXECUTION = True
+# longer loops are left to the interpreter, so the watchdog can see them
+NATIVE_MAX_ITERATIONS = 100000
+# the engine robots use to run programs: 'vm' for the bytecode interpreter,
+# 'trace' to run them natively with line events (see trace_engine.py)
+# or 'ast' to walk their syntax tree (see ast_engine.py)
+PYTHON_ENGINE = 'vm'
+# watchdog limits for the trace engine, which counts lines, not bytecodes
+TRACE_MAX_LINES = 1000000
+TRACE_NO_PROGRESS_LINES = 200000
+# watchdog limits for the ast engine, which counts statements
+AST_MAX_STEPS = 2000000
+AST_NO_PROGRESS_STEPS = 400000
+# when True, BIT's programs run on the VM in a separate worker process
+# (see process_engine.py), so they can't freeze or crash the game
+ISOLATED_EXECUTION = False
+# a worker that sends nothing for this many seconds has hung, and is killed
+WORKER_TIMEOUT = 2
+# the only modules programs can import (see module_registry.py). They are
+# imported when the game starts. Modules that are slow to load, or that a
+# puzzle has no use for (eg time, os) are left out. This only controls what
+# an import statement loads, it isn't a sandbox
+ALLOWED_MODULES = ('random', 'math', 'cmath', 'string', 'itertools',
+                   'functools', 'operator', 'collections', 'statistics',
+                   'fractions', 'decimal', 'datetime', 'copy')
+
 # editor constants
 DEBUG = False  # when true enables extra debug messages in the console
 MSG_VERBOSITY = 8  # 0-9, 0= no console messages, 9 = max
@@ -63,6 +149,9 @@ SCALING_FACTOR = 4
 DISPLAY_SIZE = (WINDOW_SIZE[X] // SCALING_FACTOR,
                 WINDOW_SIZE[Y] // SCALING_FACTOR)
 EDITOR_POPUP_SPEED = 25  # how fast the editor scrolls into view
+# when True, only the parts of the window that have changed are presented
+# each frame, unless the camera is moving (see dirty_rects.py)
+DIRTY_RECTS = True
 EDITOR_UNDO_HISTORY = 100  # how many keystrokes can be undone
 BLOCK_SIZE = 16  # size in pixels of a the block 'grid'
 GRAVITY = .2
@@ -72,6 +161,14 @@ COLLIDER_WIDTH = 16
 COLLIDER_HEIGHT = 16
 REWIND_ICON_POS = (WINDOW_SIZE[X] - 72, 8)
 PLAY_ICON_POS = (REWIND_ICON_POS[X] - 70, REWIND_ICON_POS[Y])
+# the simulation speeds that F6 cycles through, as ticks per frame.
+# Each tick moves everything as far as one frame does at normal speed,
+# so collisions, grid snapping and triggers work the same at any speed.
+# INSTANT runs as many ticks as it takes for BIT and the blocks to stop
+INSTANT = 'instant'
+SIMULATION_SPEEDS = (1, 2, 4, INSTANT)
+SIMULATION_SPEED = 1  # the speed the game starts at
+INSTANT_MAX_TICKS = 3600  # per frame, in case something never stops
 
 # puzzle definition constants
 PUZZLE_NAME = 0
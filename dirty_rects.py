@@ -0,0 +1,108 @@
+""" presents each frame of the game in the window, copying across only the
+parts that have changed since the last frame.
+
+The whole game is still drawn to the small display surface every frame,
+which is cheap. What costs is scaling the display up to the window, and
+passing the whole window to the screen. While the camera is settled, the
+scenery and blocks stay put, and the only things that change are the
+sprites (the characters, BIT's jets and any moving blocks) and the overlays
+drawn straight onto the window (speech bubbles, signs, buttons etc).
+The world reports where it drew each of them, and only those parts of the
+display are scaled and presented, along with wherever they were in the
+last frame, so nothing is left behind when they move. The overlays are
+drawn again every frame, so the game underneath them is presented first.
+
+While the camera is scrolling (or shaking), or the editor is sliding in or
+out, the whole picture moves, and the frame is presented in full.
+"""
+import pygame
+
+from constants import *
+
+
+def merge(rects):
+    """ combine any rects that overlap, so no part is presented twice """
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        overlapping = rect.collidelist(merged)
+        while overlapping != -1:
+            rect.union_ip(merged.pop(overlapping))
+            overlapping = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+
+class DirtyRects:
+    def __init__(self, screen, display):
+        self.screen = screen
+        self.display = display
+        self.enabled = DIRTY_RECTS
+        self.sprites = []  # where sprites were drawn on the display
+        self.overlays = []  # where overlays were drawn on the window
+        self.last_sprites = []  # the same, for the last frame
+        self.last_overlays = []
+        self.presented = []  # the parts of the window presented this frame
+        self.view = None  # the camera scroll and game origin last frame
+        self.full_frame = True  # the next frame is presented in full
+
+    def redraw_all(self):
+        """ present the next frame in full, eg after the menu has been
+        drawn over the window """
+        self.full_frame = True
+
+    def add_sprite(self, rect):
+        if rect:
+            self.sprites.append(rect)
+
+    def add_overlay(self, rect):
+        if rect:
+            self.overlays.append(rect)
+
+    def display_rect(self, rect, origin):
+        """ the part of the display under a rect on the window """
+        left = (rect.left - origin[X]) // SCALING_FACTOR
+        top = (rect.top - origin[Y]) // SCALING_FACTOR
+        right = -((origin[X] - rect.right) // SCALING_FACTOR)  # rounded up
+        bottom = -((origin[Y] - rect.bottom) // SCALING_FACTOR)
+        return pygame.Rect(left, top, right - left, bottom - top)
+
+    def present_game(self, scroll, origin, full_frame=False):
+        """ scale the display up to the window, at origin. This is done
+        before the overlays are drawn. If full_frame is True, or the view
+        has moved, the whole display is scaled """
+        view = (tuple(scroll), tuple(origin))
+        if view != self.view or full_frame or not self.enabled:
+            self.full_frame = True
+        self.view = view
+        if self.full_frame:
+            self.screen.blit(pygame.transform.scale(self.display,
+                                                    WINDOW_SIZE),
+                             origin)
+            return
+        regions = (self.sprites + self.last_sprites +
+                   [self.display_rect(rect, origin)
+                    for rect in self.last_overlays])
+        bounds = self.display.get_rect()
+        for rect in merge(regions):
+            rect = rect.clip(bounds)
+            if rect:
+                position = (origin[X] + rect.x * SCALING_FACTOR,
+                            origin[Y] + rect.y * SCALING_FACTOR)
+                self.presented.append(self.screen.blit(
+                    pygame.transform.scale(
+                        self.display.subsurface(rect),
+                        (rect.width * SCALING_FACTOR,
+                         rect.height * SCALING_FACTOR)),
+                    position))
+
+    def end_frame(self):
+        """ show the frame, once the overlays have been drawn """
+        if self.full_frame:
+            pygame.display.update()
+        else:
+            pygame.display.update(self.presented + self.overlays)
+        self.last_sprites, self.sprites = self.sprites, []
+        self.last_overlays, self.overlays = self.overlays, []
+        self.presented = []
+        self.full_frame = False
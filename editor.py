@@ -60,6 +60,8 @@ class Editor:
         self.selection_end = (0, 0)
         self.deleting_block = False
         self.v_scroll = 0  # line offset to allow text to be scrolled
+        # row of the text marked by a box, eg the line a program is running
+        self.highlighted_row = None
         self.active = False
         self.run_enabled = False
         self.key_action = {}
@@ -651,6 +653,16 @@ class Editor:
                              LINE_WIDTH, CORNER_RADIUS // 2)
             self.print(self.title, (1, -1))
 
+        # box the highlighted row, if it is on screen
+        if self.highlighted_row is not None:
+            row = self.highlighted_row - self.v_scroll
+            if 0 <= row < self.max_lines:
+                highlight = pygame.Rect(
+                    self.side_gutter, self.top_margin + row * self.line_height,
+                    self.width - self.side_gutter * 2, self.line_height)
+                pygame.draw.rect(self.surface, self.get_fg_color(),
+                                 highlight, 1)
+
         # render each line of text from the current v_scroll position
         # to the bottom of the window
         for line in range(self.max_lines):
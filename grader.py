@@ -0,0 +1,252 @@
+"""
+Marks students' attempts at the sentry puzzles, without opening the game.
+Every program in the session logs (see session.py) is run against the
+sentry for the puzzle it was written for, in the same way as
+Sentry.is_challenge_complete: the sentry's init program sets up its data,
+then the student's program runs, and its output must match the output of
+the sentry's validate program.
+The attempts are spread across a pool of processes, and the results are
+printed as a table with a row per student and a column per puzzle.
+Run with: python grader.py [log files or folders]
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import random
+
+import file_parser
+import interpreter
+import session
+from console_messages import console_msg
+from constants import SAVE_FILES_FOLDER, SAVE_FILE_EXTENSION, SENTRY_FILE, \
+    LEVEL_MAP_FILE_STEM, LEVEL_MAP_FILE_EXTENSION, GRADER_MAX_SECONDS, \
+    GRADER_MAX_BYTECODES
+from headless import StubRobot, run_headless
+
+PUZZLE_INFO_HEADING = '# puzzle start positions'
+
+
+def read_puzzle_starts(level):
+    """ returns (name, player_start_x) for each puzzle in a level map,
+    in the order they are played. Returns an empty list if there is no
+    map for this level"""
+    file_name = LEVEL_MAP_FILE_STEM + str(level) + LEVEL_MAP_FILE_EXTENSION
+    if not os.path.exists(file_name):
+        return []
+    with open(file_name, 'r') as file:
+        lines = [line.rstrip('\n') for line in file]
+    if PUZZLE_INFO_HEADING not in lines:
+        return []
+    puzzles = []
+    i = lines.index(PUZZLE_INFO_HEADING) + 1
+    while i < len(lines) and lines[i] != '###':
+        if lines[i] and lines[i][0] != '#':
+            # number, name, player start, dog start (see blocks.py)
+            values = eval(lines[i])
+            puzzles.append((values[0], values[1], values[2][0]))
+        i += 1
+    return [(name, x) for number, name, x in sorted(puzzles)]
+
+
+def load_puzzle_sentries():
+    """ returns a dict of {puzzle name: sentry} for every puzzle that has
+    a sentry. The logs only record the name of the puzzle, so each sentry
+    is matched to the puzzle whose part of the level it stands in"""
+    puzzle_sentries = {}
+    for sentry in file_parser.parse_file(SENTRY_FILE):
+        level = sentry.get('level')
+        if not isinstance(level, int) or 'position' not in sentry:
+            continue
+        x = sentry['position'][0]
+        name = None
+        # each puzzle runs from its start position to the next one's
+        for puzzle_name, start_x in read_puzzle_starts(level):
+            if start_x <= x:
+                name = puzzle_name
+        if name is None:
+            console_msg("no puzzle found for sentry " + sentry['name'], 2)
+        elif name in puzzle_sentries:
+            console_msg("puzzle " + name + " already has a sentry, so "
+                        + sentry['name'] + " is ignored", 2)
+        else:
+            puzzle_sentries[name] = sentry
+    return puzzle_sentries
+
+
+def find_log_files(paths):
+    """ the log files named in paths, including all the logs in any
+    folders, or in the game's log folder if paths is empty """
+    if not paths:
+        paths = [SAVE_FILES_FOLDER]
+    log_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            log_files.extend(sorted(glob.glob(
+                os.path.join(path, '*' + SAVE_FILE_EXTENSION))))
+        elif os.path.exists(path):
+            log_files.append(path)
+        else:
+            console_msg("can't find log file " + path, 0)
+    return log_files
+
+
+def read_attempts(log_file):
+    """ returns (student, puzzle name, program) for every program
+    run in a session log. student is a (user name, class name) tuple"""
+    sections = session.read_log(log_file)
+    student = ('unknown', '')
+    attempts = []
+    for section in sections:
+        if section.get('SECTION') == 'HEADER':
+            student = (section.get('USER_NAME', 'unknown'),
+                       section.get('CLASS_NAME', ''))
+        elif section.get('SECTION') == 'ATTEMPT' and \
+                section.get('USER_PROGRAM'):
+            attempts.append((student, section.get('LEVEL'),
+                             section['USER_PROGRAM']))
+    return attempts
+
+
+def quiet_worker():
+    """ runs at the start of each worker process, to stop the VM filling
+    the console with its progress messages """
+    interpreter.console_msg = lambda *args, **kwargs: None
+
+
+def limit_run(robot):
+    vm = robot.python_interpreter
+    vm.max_seconds = GRADER_MAX_SECONDS
+    vm.max_bytecodes = GRADER_MAX_BYTECODES
+
+
+def grade_attempt(job):
+    """ run one program against a sentry. Returns (passed, reason), where
+    reason says why a program failed, or is None if it passed.
+    job is a (program, sentry, seed) tuple. The seed is used for the
+    random numbers in the sentry's init program, so that every attempt at
+    a puzzle is marked against the same data"""
+    program, sentry, seed = job
+    random.seed(seed)
+    examiner = StubRobot(name=sentry['name'])
+    limit_run(examiner)
+    if sentry.get('init'):
+        success, errors = run_headless(examiner, sentry['init'], cache=True)
+        if not success:
+            return False, "sentry init failed: " + '; '.join(errors)
+    student = StubRobot(name='BIT')
+    limit_run(student)
+    # BIT reads the data of the sentry it is trying to pass
+    student.world.data = examiner.world.data
+    success, errors = run_headless(student, program)
+    if not success:
+        return False, '; '.join(str(e) for e in errors) or 'error'
+    examiner.output = []
+    success, errors = run_headless(examiner, sentry.get('validate', []),
+                                   cache=True)
+    if not success:
+        return False, "sentry validate failed: " + '; '.join(errors)
+    if examiner.output != [line.rstrip() for line in student.output]:
+        return False, 'wrong output'
+    return True, None
+
+
+def grade_all(attempts, puzzle_sentries, processes=None, seed=0):
+    """ marks every attempt that has a sentry, in a process pool.
+    Returns a list of (student, puzzle name, passed, reason),
+    in the same order as the attempts"""
+    graded = [a for a in attempts if a[1] in puzzle_sentries]
+    jobs = [(program, puzzle_sentries[puzzle], seed)
+            for student, puzzle, program in graded]
+    if not jobs:
+        return []
+    processes = processes or os.cpu_count() or 1
+    # big enough chunks to keep the overhead down,
+    # but small enough to share out the slow programs
+    chunk_size = max(1, len(jobs) // (processes * 4))
+    with multiprocessing.Pool(processes, initializer=quiet_worker) as pool:
+        results = pool.map(grade_attempt, jobs, chunk_size)
+    return [(student, puzzle, passed, reason)
+            for (student, puzzle, program), (passed, reason)
+            in zip(graded, results)]
+
+
+def results_table(results, puzzle_order):
+    """ the rows of the pass/fail table: one per student, with a cell for
+    each puzzle showing the passing attempts out of the total, eg PASS 1/3,
+    or fail 0/2, or - if the student didn't attempt it """
+    counts = {}
+    for student, puzzle, passed, reason in results:
+        passes, total = counts.get((student, puzzle), (0, 0))
+        counts[(student, puzzle)] = (passes + passed, total + 1)
+    puzzles = [p for p in puzzle_order
+               if any(key[1] == p for key in counts)]
+    students = sorted(set(student for student, puzzle in counts),
+                      key=lambda s: (s[1], s[0]))
+    header = ['student', 'class'] + puzzles
+    rows = [header]
+    for student in students:
+        row = [student[0], student[1]]
+        for puzzle in puzzles:
+            if (student, puzzle) not in counts:
+                row.append('-')
+            else:
+                passes, total = counts[(student, puzzle)]
+                row.append('{0} {1}/{2}'.format(
+                    'PASS' if passes else 'fail', passes, total))
+        rows.append(row)
+    return rows
+
+
+def print_table(rows):
+    widths = [max(len(str(row[i])) for row in rows)
+              for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(str(cell).ljust(width)
+                        for cell, width in zip(row, widths)).rstrip())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Mark the programs in BitQuest session logs "
+                    "against the sentry puzzles")
+    parser.add_argument('paths', nargs='*',
+                        help="log files, or folders of them (default: "
+                             + SAVE_FILES_FOLDER + ")")
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help="seed for the sentries' random data")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="list every failed attempt and the reason")
+    args = parser.parse_args()
+    quiet_worker()
+
+    puzzle_sentries = load_puzzle_sentries()
+    attempts = []
+    for log_file in find_log_files(args.paths):
+        attempts.extend(read_attempts(log_file))
+    results = grade_all(attempts, puzzle_sentries, args.processes,
+                        args.seed)
+    if not results:
+        print("No attempts at sentry puzzles found")
+        return
+    puzzle_order = []
+    for level in sorted(set(s['level'] for s in puzzle_sentries.values())):
+        puzzle_order.extend(name for name, x in read_puzzle_starts(level)
+                            if name in puzzle_sentries)
+    print_table(results_table(results, puzzle_order))
+    if args.verbose:
+        print()
+        for student, puzzle, passed, reason in results:
+            if not passed:
+                print('{0} ({1}), {2}: {3}'.format(
+                    student[0], student[1], puzzle, reason))
+    skipped = len(attempts) - len(results)
+    if skipped:
+        print()
+        print(skipped, "attempts at puzzles without a sentry were skipped")
+
+
+if __name__ == '__main__':
+    main()
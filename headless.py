@@ -0,0 +1,112 @@
+"""
+Stand-ins for the game world and its robots, so that programs can run on
+the interpreter without a pygame window, eg for benchmarking (benchmark.py)
+or marking students' attempts (grader.py)
+"""
+import contextlib
+import io
+import sys
+
+from interpreter import VirtualMachine
+
+
+class StubWorld:
+    """ just enough of the World interface for the VM to run a program
+    without any rendering. BIT moves instantly to any requested position."""
+    def __init__(self):
+        self.bit_x = 0
+        self.bit_y = 0
+        self.player_x = 0
+        self.player_y = 0
+        self.data = 0
+        self._secret_data = 0
+        self.updates = 0
+
+    def get_bit_x(self):
+        return self.bit_x
+
+    def set_bit_x(self, value):
+        self.bit_x = int(value)
+
+    def get_bit_y(self):
+        return self.bit_y
+
+    def set_bit_y(self, value):
+        self.bit_y = int(value)
+
+    def get_player_x(self):
+        return self.player_x
+
+    def get_player_y(self):
+        return self.player_y
+
+    def set_player_x(self, dummy):
+        pass
+
+    def set_player_y(self, dummy):
+        pass
+
+    def get_data(self):
+        return self.data
+
+    def set_data(self, robot, value):
+        robot.set_data(value)
+
+    def get_secret_data(self):
+        return self._secret_data
+
+    def set_secret_data(self, robot, value):
+        robot.set_secret_data(value)
+
+    def busy(self):
+        return False
+
+    def update(self, focus):
+        self.updates += 1
+
+
+class StubRobot:
+    """ stands in for characters.Robot, collecting output in a list """
+    def __init__(self, vm_class=VirtualMachine, name='headless'):
+        self.name = name
+        self.world = StubWorld()
+        self.output = []
+        self.errors = []
+        self.python_interpreter = vm_class(self)
+
+    def say(self, *t):
+        self.output.append(' '.join(str(x) for x in t))
+
+    def input(self, msg=''):
+        return ''
+
+    def error(self, msg, type=''):
+        self.errors.append(type + msg)
+
+    def set_data(self, value):
+        # so the data chosen by a sentry's init program reaches the others
+        self.world.data = value
+
+    def set_secret_data(self, value):
+        pass
+
+
+def run_headless(robot, source, cache=False):
+    """ compile a program and run it to completion on the robot's VM,
+    without the game loop. Returns the (success, result/errors) pair from
+    VirtualMachine.run, or (False, [message]) if it won't compile.
+    If cache is True, the compiled program is kept for next time"""
+    vm = robot.python_interpreter
+    vm.headless = True
+    vm.record_history = False  # nobody will replay it
+    vm.record_trace = False
+    vm.instruction_budget = sys.maxsize
+    vm.time_slice = None
+    vm.load(source)
+    # the VM echoes its bytecode and return values to the console
+    with contextlib.redirect_stdout(io.StringIO()):
+        success, message = vm.compile(cache=cache)
+        if not success:
+            return False, [message]
+        vm.run_enabled = True
+        return vm.run()
@@ -1,12 +1,30 @@
+import ast
+import builtins
 import collections
 import dis  # built-in python disassembler - used for tokenising
 import inspect
 import operator
 import sys
+import time
 import types
 
 from console_messages import console_msg
-from constants import CONSOLE_VERBOSE
+from constants import CONSOLE_VERBOSE, INSTRUCTION_BUDGET, \
+    INSTRUCTION_TIME_SLICE, STEPPED_EXECUTION, PROFILE_INTERPRETER, \
+    PROFILE_OUTPUT_FILE, WATCHDOG_MAX_BYTECODES, WATCHDOG_MAX_SECONDS, \
+    WATCHDOG_MAX_FRAMES, WATCHDOG_NO_PROGRESS_BYTECODES, \
+    WATCHDOG_CHECK_INTERVAL, NATIVE_EXECUTION, NATIVE_MAX_ITERATIONS, \
+    FUSE_INSTRUCTIONS, INLINE_NAME_CACHES, FRAME_POOL_SIZE, RECORD_HISTORY, \
+    RECORD_TRACE
+from line_trace import LineTrace, add_trace_points, trace_line, \
+    trace_loop, LINE_OPCODE, LOOP_OPCODE
+from module_registry import import_module, module_attribute, star_names
+from native_regions import extract_native_regions, is_plain_value, \
+    region_error_line, NATIVE_CALL, ITERABLE_NAME, GUARD_NAME, TICK_NAME
+from profiler import Profiler
+from quotas import ResourceQuotas, QuotaExceeded
+from snapshots import ExecutionHistory
+from superinstructions import fuse_instructions, run_fused, FUSED_OPCODE
 
 def convert_to_lines(text):
     """ convert the raw editor characters into lines of source code
@@ -30,6 +48,164 @@ def convert_to_lines(text):
     console_msg("...done", 8)
     return source
 
+
+def source_rows(text):
+    """ returns the row of the editor text that each line of
+    convert_to_lines(text) starts on, so that line numbers from the
+    compiler can be found in the editor, despite continuation lines"""
+    rows = []
+    line_number = 0
+    while line_number < len(text):
+        rows.append(line_number)
+        line = ''.join(text[line_number]).rstrip()
+        while line and line.rstrip()[-1] == '\\':
+            line_number += 1
+            line = line.rstrip('\\') + \
+                ''.join(text[line_number]).lstrip()
+        line_number += 1
+    return rows
+
+
+# the version of Python running the game, which decides the instruction set
+# the VM has to handle. Jump arguments count instructions rather than bytes
+# from 3.10, calls and binary operators were reworked in 3.11, and 3.12/3.13
+# changed how loops end and added several combined instructions
+PY_VERSION = sys.version_info[:2]
+
+# the dis module stores the argument categories as lists, so these are
+# converted to sets once, to make the membership tests in
+# decode_instructions cheap
+HAS_CONST = frozenset(dis.hasconst)
+HAS_NAME = frozenset(dis.hasname)
+HAS_LOCAL = frozenset(dis.haslocal)
+HAS_JUMP = frozenset(dis.hasjrel + dis.hasjabs + getattr(dis, 'hasjump', []))
+
+# instructions that use the lowest bit of their argument to say whether
+# a NULL is pushed with the value, ready for a following CALL
+NULL_FLAG_NAMES = frozenset(
+    (['LOAD_GLOBAL'] if PY_VERSION >= (3, 11) else []) +
+    (['LOAD_ATTR'] if PY_VERSION >= (3, 12) else []))
+
+
+def decode_instructions(code_obj):
+    """ decode the bytecode of a code object into a table of
+    (opcode, byte_name, argument, next_offset) tuples, one per instruction.
+    The table is indexed by offset // 2, so jumps can go straight to their
+    target and the VM never needs to look at co_code again.
+    From Python 3.11 many instructions are followed by inline cache entries,
+    so each entry gives the offset of the next real instruction, and the
+    slots for the cache entries are left empty. dis takes care of the
+    other differences between versions, eg EXTENDED_ARG and jump targets."""
+    code_size = len(code_obj.co_code)
+    table = [None] * (code_size // 2)
+    instructions = list(dis.get_instructions(code_obj))
+    for i, instruction in enumerate(instructions):
+        byte_code = instruction.opcode
+        byte_name = instruction.opname
+        # EXTENDED_ARG is decoded as a separate instruction that does
+        # nothing, since its argument is already included in the next one
+        if i + 1 < len(instructions):
+            next_offset = instructions[i + 1].offset
+        else:
+            next_offset = code_size
+        # this uses the lists included in the dis module to check the meaning
+        # of the arguments for each instruction. There are only a few
+        # different possibilities and this approach is much more concise
+        # than exhaustively testing for each individual instruction
+        if instruction.arg is None:
+            argument = ()
+        elif byte_code in HAS_JUMP:  # the offset of the jump target
+            argument = (instruction.argval,)
+        elif byte_code in HAS_CONST:  # look up a constant
+            argument = (instruction.argval,)
+        elif byte_code in HAS_NAME:  # look up a name
+            if byte_name in NULL_FLAG_NAMES:
+                argument = (instruction.argval, bool(instruction.arg & 1))
+            else:
+                argument = (instruction.argval,)
+        elif byte_code in HAS_LOCAL:  # look up a local name
+            if isinstance(instruction.argval, tuple):
+                # 3.13 combines pairs of loads/stores into one instruction
+                argument = instruction.argval
+            else:
+                argument = (instruction.argval,)
+        elif byte_name == 'COMPARE_OP':
+            # the argument also holds flags from 3.12, so use the operator
+            argument = (dis.cmp_op.index(instruction.argval),)
+        else:
+            argument = (instruction.arg,)
+        table[instruction.offset // 2] = (byte_code, byte_name, argument,
+                                          next_offset)
+    return table
+
+
+def decode_lines(code_obj):
+    """ returns a list giving the source line of every instruction in a
+    code object, indexed by offset // 2 like the instruction table.
+    Inline cache entries get the line of the instruction they belong to,
+    and instructions that don't come from any line (eg RESUME) get 0"""
+    code_size = len(code_obj.co_code)
+    table = [0] * (code_size // 2)
+    starts = sorted(dis.findlinestarts(code_obj))
+    for i, (offset, line) in enumerate(starts):
+        if i + 1 < len(starts):
+            end = starts[i + 1][0]
+        else:
+            end = code_size
+        table[offset // 2:end // 2] = [line or 0] * (end // 2 - offset // 2)
+    return table
+
+
+# instructions that get an inline cache (see add_name_caches)
+CACHED_NAME_LOADS = frozenset(['LOAD_NAME', 'LOAD_GLOBAL'])
+# a program that uses any of these can change its namespaces behind the VM's
+# back (eg globals()['x'] = 1), so its name lookups are never cached
+UNCACHEABLE_NAMES = frozenset(['globals', 'locals', 'vars', 'exec', 'eval',
+                               'builtins', '__builtins__', '__import__'])
+
+
+def add_name_caches(table, uncached_names):
+    """ returns a copy of an instruction table with a cache cell added to
+    the argument of each LOAD_NAME and LOAD_GLOBAL instruction.
+    The cell holds [generation, names], where names is the dict the name was
+    found in when the VM's names_generation was last equal to generation.
+    The generation only changes when a name is added to or removed from
+    one of the program's namespaces, so a lookup in a loop that stores to
+    existing variables stays a single check. Names in uncached_names (eg
+    world variables that have to be refreshed) are always looked up."""
+    table = list(table)
+    for i, entry in enumerate(table):
+        if entry and entry[1] in CACHED_NAME_LOADS:
+            byte_code, byte_name, argument, next_offset = entry
+            if argument[0] in uncached_names:
+                continue
+            if byte_name == 'LOAD_GLOBAL' and len(argument) == 1:
+                argument += (False,)  # no push_null flag before 3.11
+            table[i] = (byte_code, byte_name, argument + ([-1, None],),
+                        next_offset)
+    return table
+
+
+def referenced_names(code_obj):
+    """ returns the set of all global/attribute names used by a code object,
+    including those in any functions or comprehensions defined inside it"""
+    names = set(code_obj.co_names)
+    for const in code_obj.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= referenced_names(const)
+    return names
+
+
+def all_instructions(code_obj):
+    """ returns a list of the instructions in a code object, and in any
+    functions or comprehensions defined inside it"""
+    instructions = list(dis.get_instructions(code_obj))
+    for const in code_obj.co_consts:
+        if isinstance(const, types.CodeType):
+            instructions += all_instructions(const)
+    return instructions
+
+
 def is_a_number(p):
     # check for numeric parameters
     try:
@@ -39,38 +215,75 @@ def is_a_number(p):
         return False
 
 
+def on_line(msg, line):
+    """ add the line an error happened on to its message, if known,
+    eg "'x' is not defined." -> "'x' is not defined on line 3." """
+    if not line:
+        return msg
+    if msg.endswith('.'):
+        return msg[:-1] + " on line " + str(line) + '.'
+    return msg + " on line " + str(line)
+
+
+# top level frames share the builtins module's namespace, rather than each
+# one finding it again from __builtins__
+BUILTIN_NAMES = builtins.__dict__
+
+
 class Frame(object):
     # data structure to represent the call frames
+    # frames are slotted, since recursive programs make a lot of them.
+    # The values they operate on are all kept on the VM's data stack
+    __slots__ = [
+        'code_obj', 'global_names', 'local_names', 'prev_frame',
+        'builtin_names', 'last_instruction', 'block_stack', 'instructions',
+    ]
+
     def __init__(self, code_obj, global_names, local_names, prev_frame):
+        self.block_stack = []
+        self.reset(code_obj, global_names, local_names, prev_frame)
+
+    def reset(self, code_obj, global_names, local_names, prev_frame):
+        """ set the frame up for a new call. Frames are reused
+        (see VirtualMachine.make_frame), so this does everything
+        except creating the block stack"""
         self.code_obj = code_obj
         self.global_names = global_names
         self.local_names = local_names
         self.prev_frame = prev_frame
-        self.stack = []
         if prev_frame:
             self.builtin_names = prev_frame.builtin_names
         else:
-            self.builtin_names = local_names['__builtins__']
+            self.builtin_names = local_names.get('__builtins__',
+                                                 BUILTIN_NAMES)
             if hasattr(self.builtin_names, '__dict__'):
                 self.builtin_names = self.builtin_names.__dict__
 
         self.last_instruction = 0
-        self.block_stack = []
+        # the pre-decoded instruction table for code_obj (see VirtualMachine.decode)
+        self.instructions = None
+
+    def release(self):
+        """ drop the references held by a finished frame, so a spare frame
+        doesn't keep the program's values alive"""
+        self.code_obj = self.global_names = self.local_names = None
+        self.prev_frame = self.builtin_names = self.instructions = None
+        self.block_stack.clear()
+
+
+# code flags for functions taking *args or **kwargs
+VARIABLE_ARGUMENTS = inspect.CO_VARARGS | inspect.CO_VARKEYWORDS
 
 
 class Function(object):
-    """ calling a function creates a new frame on the call stack"""
-    '''
-    this doesn't work, so I've commented it out for now.
-    from what I understand, __slots__ is just a performance optimisation
-    
+    # calling a function creates a new frame on the call stack
+    # (this is a comment rather than a docstring, because a class
+    # docstring would clash with the __doc__ slot)
     __slots__ = [
         'func_code', 'func_name', 'func_defaults', 'func_globals',
-        'func_locals', 'func_dict', 'func_closure',
-        '__name__', '__dict__', '__doc__',
+        'func_locals', 'func_closure', '__name__', '__doc__',
         '_vm', '_func',
     ]
-'''
 
     def __init__(self, name, code, globs, defaults, closure, vm):
         """ opaque stuff copied directly from Allison Kaptur"""
@@ -80,9 +293,6 @@ class Function(object):
         self.func_defaults = tuple(defaults)
         self.func_globals = globs
         self.func_locals = self._vm.frame.local_names
-        # crashes if uncommented
-        # may be due to new function call types since 3.7
-        # self.__dict__ = {}
         self.func_closure = closure
         self.__doc__ = code.co_consts[0] if code.co_consts else None
 
@@ -94,14 +304,45 @@ class Function(object):
             kw['closure'] = tuple(make_cell(0) for _ in closure)
         self._func = types.FunctionType(code, globs, **kw)
 
-    def __call__(self, *args, **kwargs):
-        """ constructs and runs the call frame """
+    def __repr__(self):
+        return '<function ' + self.func_name + '>'
+
+    def set_defaults(self, defaults):
+        """ from 3.13 the default argument values are added after
+        the function is made, by SET_FUNCTION_ATTRIBUTE"""
+        self.func_defaults = tuple(defaults)
+        self._func.__defaults__ = self.func_defaults
+
+    def make_call_frame(self, *args, **kwargs):
+        """ constructs the call frame, without running it """
+        code = self.func_code
+        if not kwargs and len(args) == code.co_argcount and \
+                not code.co_flags & VARIABLE_ARGUMENTS and \
+                not code.co_kwonlyargcount:
+            # the usual case of a call with all the positional arguments
+            # needs none of the checks in getcallargs
+            callargs = dict(zip(code.co_varnames, args))
+            return self._vm.make_frame(code, None, self.func_globals,
+                                       callargs)
         callargs = inspect.getcallargs(self._func, *args, **kwargs)
-        # callargs provides a mapping of arguments to pass into the frame
-        frame = self._vm.make_frame(
-            self.func_code, callargs, self.func_globals, {}
+        # inspect renames the hidden argument of comprehensions from .0
+        if 'implicit0' in callargs and '.0' in self.func_code.co_varnames:
+            callargs['.0'] = callargs.pop('implicit0')
+        # callargs maps the arguments to their values,
+        # so it becomes the new frame's local variables
+        return self._vm.make_frame(
+            self.func_code, None, self.func_globals, callargs
         )
-        return self._vm.run_frame(frame)
+
+    def __call__(self, *args, **kwargs):
+        """ constructs and runs the call frame """
+        frame = self.make_call_frame(*args, **kwargs)
+        result = self._vm.run_frame(frame)
+        if result == 'exception':
+            # pass the error on to the caller, rather than returning it
+            # as if it were a value
+            raise self._vm.last_exception[1]
+        return result
 
 
 def make_cell(value):
@@ -113,9 +354,56 @@ def make_cell(value):
     return fn.__closure__[0]
 
 
+def unary_handler(op):
+    """ build a dispatch table entry for an operation of the form '[op] a'
+    with the operator function already bound"""
+    def handler(vm):
+        vm.push(op(vm.pop()))
+    return handler
+
+
+# operators whose results can be enormous, so they are checked
+# against the resource quotas before they are calculated
+GUARDED_OPERATORS = frozenset(['POWER', 'MULTIPLY', 'LSHIFT', 'ADD'])
+
+
+def guarded_binary_handler(op_name, op):
+    """ like binary_handler, but checks the size of the result first """
+    def handler(vm):
+        a, b = vm.popn(2)
+        vm.quotas.check_operation(op_name, a, b)
+        vm.push(op(a, b))
+    return handler
+
+
+def binary_handler(op):
+    """ build a dispatch table entry for an operation of the form
+    'a [op] b' (or the in-place 'a [op]= b')"""
+    def handler(vm):
+        a, b = vm.popn(2)
+        vm.push(op(a, b))
+    return handler
+
+
 # data structure to handle loop and exception blocks
 Block = collections.namedtuple('Block', ['type', 'handler', 'stack_height'])
 
+# from 3.11, CPython pushes a NULL alongside each function it is about to
+# call, which CALL uses to tell methods from plain functions. The VM pushes
+# this marker instead, since None is a perfectly good stack value
+NULL = object()
+# the qualified name is on the stack for MAKE_FUNCTION before 3.11
+MAKE_FUNCTION_POPS_NAME = PY_VERSION < (3, 11)
+# LOAD_METHOD is followed by CALL_METHOD before 3.11, and by CALL after
+METHODS_USE_CALL = PY_VERSION >= (3, 11)
+# the NULL goes below the function until 3.12, and above it from 3.13
+NULL_ABOVE_CALLABLE = PY_VERSION >= (3, 13)
+# from 3.12, an exhausted FOR_ITER leaves the iterator for END_FOR to pop
+FOR_ITER_KEEPS_ITERATOR = PY_VERSION >= (3, 12)
+# END_FOR pops the iterator and the last value in 3.12,
+# but is followed by a separate POP_TOP for the iterator from 3.13
+END_FOR_POPS = 2 if PY_VERSION == (3, 12) else 1
+
 class VirtualMachineError(Exception):
     pass
 
@@ -133,12 +421,28 @@ class VirtualMachine:
         self.compile_time_error = None
         self.run_time_error = None
         self.byte_code = None
+        # instruction tables for every code object run so far, so that
+        # loops and repeated function calls never decode the same bytecode twice
+        self.decoded_instructions = {}
+        # the source line of each instruction, for every code object decoded
+        # (see decode_lines), used to show which line is running
+        self.line_tables = {}
+        # where the run-time errors happened, so they can be reported
+        # with their line. Exceptions are kept as (exception, line)
+        self.run_time_error_line = None
+        self.exception_line = None
+        # the data stack, shared by all the frames of a program
         self.stack = []
+        # finished frames, ready to be reused by the next call
+        self.frame_pool = []
+        self.frame_pool_size = FRAME_POOL_SIZE
         self.running = False  # true when a program is executing
         # functions that replace the standard python functions
         self.overridden_builtins = {
-            'print': self.robot.say,
-            'input': self.robot.input,
+            'print': self.print,
+            'input': self.input,
+            '__import__': import_module,
+            NATIVE_CALL: self.run_native,
         }
         # getters and setters for all the programmable world variables
         self.world_variables = {
@@ -152,6 +456,76 @@ class VirtualMachine:
         # read/write variables need special treatment,
         # so we track them separately
         self.writable_names = ['bit_x', 'bit_y']#, 'data']
+        # read-only variables that the world changes by itself (the player
+        # runs around while programs execute), so they are re-read from the
+        # world each time the program loads them
+        self.live_names = frozenset(['me_x', 'me_y'])
+        # when tracking is on, world variables are only synced after the
+        # program stores to them, rather than polling them all every bytecode
+        self.track_world_writes = True
+        self.dirty_world_names = set()
+        # opcode -> handler function, shared by all VMs of the same class
+        self.dispatch_table = self.get_dispatch_table()
+        # scheduler settings: how much work the VM can do between frames
+        self.instruction_budget = INSTRUCTION_BUDGET
+        self.time_slice = INSTRUCTION_TIME_SLICE
+        self.instructions_this_frame = 0
+        self.slice_deadline = 0
+        # headless programs never hand control back to the renderer,
+        # unless they need the world to animate (ie they move BIT)
+        self.headless = False
+        self.render_frames = True
+        # stepped programs are driven by update() from the game loop
+        # instead of running to completion inside run()
+        self.stepped_execution = STEPPED_EXECUTION
+        self.stepping = False
+        self.on_finish = None  # called with the result of a stepped program
+        self.synchronous_depth = 0  # number of nested run_frame calls
+        self.pending_sync = []  # world variables BIT is still moving towards
+        self.sync_timeout = 0
+        self.sync_previous_value = None
+        self.waiting_for_input = False
+        # optional per-opcode/per-line profiling (see profiler.py)
+        self.profiler = None
+        if PROFILE_INTERPRETER:
+            self.enable_profiling()
+        # snapshots of the last run, for replaying it (see snapshots.py)
+        self.record_history = RECORD_HISTORY
+        self.history = None
+        # the lines the last run went through, for the session log
+        # (see line_trace.py)
+        self.record_trace = RECORD_TRACE
+        self.trace = None
+        # watchdog limits, to stop programs that run forever
+        self.max_bytecodes = WATCHDOG_MAX_BYTECODES
+        self.max_seconds = WATCHDOG_MAX_SECONDS
+        self.max_frames = WATCHDOG_MAX_FRAMES
+        self.no_progress_limit = WATCHDOG_NO_PROGRESS_BYTECODES
+        self.bytecodes_executed = 0
+        self.frames_elapsed = 0
+        self.run_start_time = 0
+        self.watchdog_check_at = WATCHDOG_CHECK_INTERVAL
+        # the watchdog checks also take the history snapshots,
+        # so they are more frequent while history is being recorded
+        self.check_interval = WATCHDOG_CHECK_INTERVAL
+        self.world_writes = 0  # number of stores to world variables this run
+        self.last_progress = None
+        self.last_progress_at = 0
+        self.runaway = False  # set when the watchdog stops a program
+        # limits on memory, output and recursion
+        self.quotas = ResourceQuotas()
+        # loops that can run as native python (see native_regions.py)
+        self.native_execution = NATIVE_EXECUTION
+        self.native_max_iterations = NATIVE_MAX_ITERATIONS
+        self.native_regions = []
+        # combine runs of simple instructions (see superinstructions.py)
+        self.fuse_instructions = FUSE_INSTRUCTIONS
+        # per-instruction caches for name lookups (see add_name_caches)
+        self.inline_name_caches = INLINE_NAME_CACHES
+        self.names_cacheable = True  # False for programs that use globals() etc
+        # changes whenever a name is added to or removed from a namespace
+        # (only kept up to date while the name caches are on)
+        self.names_generation = 0
 
     def load(self, source):
         # set the source code to interpret
@@ -162,8 +536,133 @@ class VirtualMachine:
 
     def halt(self):
         """halts execution immediately"""
+        # a stepped program is wound up on its next update()
         self.running = False
 
+    def check_watchdog(self):
+        """ stops the program if it has exceeded any of its limits,
+        or has stopped making progress (ie it is stuck in a loop)"""
+        self.watchdog_check_at = self.bytecodes_executed + self.check_interval
+        if self.history is not None:
+            self.history.record(self)
+        if self.max_bytecodes and self.bytecodes_executed > self.max_bytecodes:
+            self.stop_runaway("program stopped after "
+                              + str(self.max_bytecodes) + " instructions.")
+        elif (self.max_seconds and
+              time.perf_counter() - self.run_start_time > self.max_seconds):
+            self.stop_runaway("program stopped after running for "
+                              + str(self.max_seconds) + " seconds.")
+        elif self.max_frames and self.frames_elapsed > self.max_frames:
+            self.stop_runaway("program stopped after "
+                              + str(self.max_frames) + " frames.")
+        else:
+            try:
+                self.quotas.check_memory()
+            except QuotaExceeded as e:
+                self.stop_runaway(str(e))
+                return
+            # progress means printing something or changing the world
+            progress = (len(self.robot.output), self.world_writes)
+            if progress != self.last_progress:
+                self.last_progress = progress
+                self.last_progress_at = self.bytecodes_executed
+            elif (self.no_progress_limit and
+                  self.bytecodes_executed - self.last_progress_at
+                  > self.no_progress_limit):
+                self.stop_runaway("program stopped because it seems "
+                                  "to be stuck in a loop.")
+
+    def stop_runaway(self, msg):
+        console_msg("Watchdog: " + msg, 2)
+        self.run_time_error = msg
+        self.run_time_error_line = self.current_line()
+        self.runaway = True
+        self.halt()
+
+    def count_frame(self):
+        # frames are counted for the watchdog
+        self.frames_elapsed += 1
+        if self.max_frames and self.frames_elapsed > self.max_frames:
+            self.check_watchdog()
+
+    def finish(self, result):
+        """ wind up a stepped program and report its result """
+        on_finish = self.on_finish
+        self.reset_stepping()
+        self.on_finish = None
+        on_finish(*self.outcome(result))
+
+    def reset_stepping(self):
+        self.stepping = False
+        self.frames = []
+        self.frame = None
+        self.stack = []
+        self.pending_sync = []
+        self.waiting_for_input = False
+
+    def is_waiting(self):
+        """ True while a stepped program is waiting for
+        BIT to finish moving, or for the user to type an input"""
+        return bool(self.pending_sync) or self.waiting_for_input
+
+    def can_suspend(self):
+        """ stepped programs can only pause between bytecodes of their
+        own frames, not while a native function is calling back into them"""
+        return self.stepping and not self.synchronous_depth
+
+    def print(self, *t):
+        """ replacement for the built-in print function """
+        self.quotas.check_output(t)
+        if self.trace is not None:
+            self.trace.output(' '.join(str(x) for x in t))
+        self.robot.say(*t)
+
+    def input(self, msg=''):
+        """ replacement for the built-in input function """
+        if self.can_suspend():
+            # open the input window and carry on with the game loop
+            # the placeholder result is replaced when the user has finished
+            self.robot.begin_input(msg)
+            self.waiting_for_input = True
+            return ''
+        return self.robot.input(msg)
+
+    def yield_to_world(self):
+        """ hand control back to the game world for (at least) one frame
+        and reset the scheduler budget for the next batch of bytecodes"""
+        if self.profiler:
+            wait_start = time.perf_counter()
+        # we guarantee to update once per call,
+        # but if the world is busy (eg moving blocks, keep calling
+        # update until it isn't
+        self.world.update(self.robot)
+        while self.world.busy():
+            self.world.update(self.robot)
+        if self.profiler:
+            self.profiler.record_wait(time.perf_counter() - wait_start)
+        self.count_frame()
+        self.instructions_this_frame = 0
+        if self.time_slice:
+            self.slice_deadline = time.perf_counter() + self.time_slice
+
+    def frame_due(self):
+        """ returns True when the VM should stop and let the world render:
+        either the world is busy, or this frame's budget has been used up"""
+        if self.world.busy():
+            return True
+        self.instructions_this_frame += 1
+        if self.instructions_this_frame >= self.instruction_budget:
+            return True
+        if self.time_slice and time.perf_counter() >= self.slice_deadline:
+            return True
+        return False
+
+    # index into world_variables tuple
+    GET = 0
+    SET = 1
+    # TODO does this need to be as high as 100?
+    UPDATE_TIMEOUT = 50  # number of updates without change before we bail
+
     def sync_world_variables(self, frame):
         # request to set any game variables
         # that were changed by the running program
@@ -171,54 +670,137 @@ class VirtualMachine:
         # to request a change to the correct variable and then block
         # further program execution until the world variable matches the
         # program variable, or a timeout occurs (eg due to an obstacle)
-        GET = 0  # index into world_variables tuple
-        SET = 1
-        # TODO does this need to be as high as 100?
-        UPDATE_TIMEOUT = 50  # number of updates without change before we bail
-        for v in self.world_variables:
+        self.request_world_sync(frame)
+        while self.pending_sync:
+            # give world variables a chance to change
+            self.yield_to_world()
+            self.check_world_sync()
+
+    def request_world_sync(self, frame):
+        """ pass any changed variables to the world, and queue up the ones
+        that the program must wait for, without blocking"""
+        if self.track_world_writes:
+            # only the variables the program has written to need syncing
+            names = list(self.dirty_world_names)
+            self.dirty_world_names.clear()
+        else:
+            names = self.world_variables
+        for v in names:
             w = self.world_variables[v]  # for brevity
             target_value = frame.global_names[v]
-            current_value = w[GET]()
+            if self.trace is not None and (v == 'data' or
+                                           v in self.writable_names):
+                self.trace.store(v, target_value)
             if v=='data':
-                w[SET](self.robot, target_value)
+                w[self.SET](self.robot, target_value)
             elif v=='_secret_data':
-                w[SET](self.robot, target_value)
+                w[self.SET](self.robot, target_value)
             # the dog coords are the only variables that are read/write
             # so we only wait for these to sync up with the real world
             # Waiting for all variables causes the interpreter to stall
             # when the player is running around, because its internal
             # values for playerX and playerY are always lagging behind
             # the world values.
-            if (v in self.writable_names) and current_value != target_value:
-                # request a change to the word variable
-                w[SET](target_value)
-                # loop until the change is complete or timeout
-                done = False
-                timeout_counter = 0
-                while not done:
-                    previous_value = current_value
-                    # give world variables a chance to change
-                    # we guarantee to update once per bytecode,
-                    # but if the world is busy (eg moving blocks, keep calling
-                    # update until it isn't
-                    self.world.update(self.robot)
-                    while self.world.busy():
-                        self.world.update(self.robot)
-
-                    current_value = w[GET]()
-                    if current_value == target_value:
-                        done = True
-                    else:
-                        # check if movement is blocked
-                        if current_value == previous_value:
-                            timeout_counter += 1
-                        if timeout_counter > UPDATE_TIMEOUT:
-                            # error message suppressed for now
-                            # self.BIT.error("can't complete this instruction")
-                            console_msg("world var timeout", 3)
-                            # correct the program variable to match the world
-                            frame.global_names[v] = current_value
-                            done = True
+            elif (v in self.writable_names and
+                  w[self.GET]() != target_value):
+                self.pending_sync.append((v, frame))
+        if self.pending_sync:
+            self.start_next_sync()
+
+    def start_next_sync(self):
+        # request a change to the world variable at the head of the queue
+        v, frame = self.pending_sync[0]
+        w = self.world_variables[v]
+        w[self.SET](frame.global_names[v])
+        self.sync_timeout = 0
+        self.sync_previous_value = w[self.GET]()
+
+    def check_world_sync(self):
+        """ called after the world has updated, to see whether the
+        variable at the head of the queue has reached its target yet"""
+        if not self.pending_sync or self.world.busy():
+            return
+        v, frame = self.pending_sync[0]
+        target_value = frame.global_names[v]
+        current_value = self.world_variables[v][self.GET]()
+        done = False
+        if current_value == target_value:
+            done = True
+        else:
+            # check if movement is blocked
+            if current_value == self.sync_previous_value:
+                self.sync_timeout += 1
+            if self.sync_timeout > self.UPDATE_TIMEOUT:
+                # error message suppressed for now
+                # self.BIT.error("can't complete this instruction")
+                console_msg("world var timeout", 3)
+                # correct the program variable to match the world
+                self.store_name(frame.global_names, v, current_value)
+                done = True
+        self.sync_previous_value = current_value
+        if done:
+            self.pending_sync.pop(0)
+            if self.pending_sync:
+                self.start_next_sync()
+
+    def is_world_independent(self):
+        """ True if the compiled program never writes to a world variable
+        that has to be animated, so it can run without rendering any frames"""
+        return not referenced_names(self.byte_code) & set(self.writable_names)
+
+    def refresh_world_variable(self, frame, name):
+        """ copy the current value of a read-only world variable
+        into the program, just before the program reads it"""
+        GET = 0  # index into world_variables tuple
+        self.store_name(frame.global_names, name,
+                        self.world_variables[name][GET]())
+
+    def store_name(self, names, name, value):
+        """ store a value in one of the program's namespaces, from outside
+        the STORE_ instructions, keeping the name caches up to date"""
+        if self.inline_name_caches and name not in names:
+            self.names_generation += 1
+        names[name] = value
+
+    def prepare_to_run(self):
+        """ reset the per-run state, ready for a new program """
+        if self.stepping:
+            # a new program replaces one that is still being stepped
+            self.finish(None)
+        console_msg('Executing...', 5)
+        self.running = True
+        self.render_frames = not (self.headless and
+                                  self.is_world_independent())
+        self.dirty_world_names.clear()
+        self.pending_sync = []
+        self.waiting_for_input = False
+        self.instructions_this_frame = 0
+        self.slice_deadline = time.perf_counter() + (self.time_slice or 0)
+        if self.profiler:
+            self.profiler.reset()
+        # reset the watchdog
+        self.runaway = False
+        self.run_time_error = None
+        self.run_time_error_line = None
+        self.last_exception = None
+        self.exception_line = None
+        self.bytecodes_executed = 0
+        self.frames_elapsed = 0
+        self.run_start_time = time.perf_counter()
+        if self.record_trace:
+            self.trace = LineTrace()
+        if self.record_history:
+            self.history = ExecutionHistory()
+            self.check_interval = min(WATCHDOG_CHECK_INTERVAL,
+                                      self.history.interval)
+        else:
+            self.history = None
+            self.check_interval = WATCHDOG_CHECK_INTERVAL
+        self.watchdog_check_at = self.check_interval
+        self.world_writes = 0
+        self.last_progress = None
+        self.last_progress_at = 0
+        self.quotas.start()
 
     def run(self, global_names=None, local_names=None):
         """ creates an entry point for code execution on the vm"""
@@ -227,50 +809,90 @@ class VirtualMachine:
         if self.run_enabled:
             self.run_enabled = False
             if self.byte_code:
-                console_msg('Executing...', 5)
-                self.running = True
+                self.prepare_to_run()
                 frame = self.make_frame(self.byte_code, global_names=global_names,
                                         local_names=local_names)
                 result = self.run_frame(frame)
-                if result in ('exception', 'quit'):
-                    self.running = False
-                    console_msg("COMPILE ERRORS="
-                                + str(self.compile_time_error), 4)
-                    console_msg("RUN ERRORS=" + str(self.run_time_error), 4)
-                    errors = []
-                    if self.compile_time_error:
-                        msg = str(self.compile_time_error)
-                        errors.append(msg)
-                        self.robot.error(msg, type="Syntax error:")
-                    if self.run_time_error:
-                        msg = str(self.run_time_error)
-                        errors.append(msg)
-                        self.robot.error(msg, type="Run-time error:")
-                    if self.last_exception:
-                        msg = str(self.last_exception[1])
-                        errors.append(msg)
-                        self.robot.error(msg, type="Run-time error:")
-                    return False, errors
-                else:
-                    self.running = False
-                    return True, result  # no errors
+                if self.runaway:
+                    result = 'quit'
+                return self.outcome(result)
             else:
                 self.running = False  # no bytecode to execute
         else:
             self.running = False  # execution is disabled
 
+    def start(self, on_finish, global_names=None, local_names=None):
+        """ begin executing the program, without waiting for it to finish.
+        The program is then advanced by calls to update() from the game loop
+        and on_finish is called with the same (success, result) pair that
+        run() would have returned."""
+        if not self.stepped_execution:
+            on_finish(*self.run(global_names, local_names))
+        elif self.run_enabled:
+            self.run_enabled = False
+            if self.byte_code:
+                self.prepare_to_run()
+                self.stepping = True
+                self.on_finish = on_finish
+                self.stack = []
+                frame = self.make_frame(self.byte_code, global_names=global_names,
+                                        local_names=local_names)
+                self.push_frame(frame)
+            else:
+                self.running = False  # no bytecode to execute
+
+    def outcome(self, result):
+        """ converts the value returned from the top-level frame into the
+        (success, result/errors) pair returned by run, and displays
+        any error messages"""
+        self.running = False
+        self.quotas.stop()
+        if self.history is not None:
+            self.history.record(self)  # the state the program finished in
+        if self.profiler:
+            self.profiler.dump(PROFILE_OUTPUT_FILE)
+        if result in ('exception', 'quit'):
+            console_msg("COMPILE ERRORS="
+                        + str(self.compile_time_error), 4)
+            console_msg("RUN ERRORS=" + str(self.run_time_error), 4)
+            errors = []
+            if self.compile_time_error:
+                msg = str(self.compile_time_error)
+                errors.append(msg)
+                self.robot.error(msg, type="Syntax error:")
+            if self.run_time_error:
+                msg = on_line(str(self.run_time_error),
+                              self.run_time_error_line)
+                errors.append(msg)
+                self.robot.error(msg, type="Run-time error:")
+            if self.last_exception:
+                exception = self.last_exception[1]
+                line = None
+                if self.exception_line and \
+                        self.exception_line[0] is exception:
+                    line = self.exception_line[1]
+                msg = on_line(str(exception), line)
+                errors.append(msg)
+                self.robot.error(msg, type="Run-time error:")
+            return False, errors
+        else:
+            return True, result  # no errors
+
     def make_frame(self, code, callargs=None,
                    global_names=None, local_names=None):
         if callargs is None:
             callargs = {}
-        if global_names is not None and local_names is not None:
-            local_names = global_names
+        if global_names is not None:
+            # a function call has its own local variables, but a program
+            # run with just a set of globals uses them as its locals too
+            if local_names is None:
+                local_names = global_names
         elif self.frames:
             global_names = self.frame.global_names
             local_names = {}
         else:
             global_names = local_names = {
-                '__builtins__': __builtins__,
+                '__builtins__': BUILTIN_NAMES,
                 '__name__': '__main__',
                 '__doc__': None,
                 '__package__': None,
@@ -281,18 +903,119 @@ class VirtualMachine:
                 'data': self.world.data,
                 '_secret_data': self.world._secret_data,
             }
-        local_names.update(callargs)
-        frame = Frame(code, global_names, local_names, self.frame)
+        if callargs:
+            local_names.update(callargs)
+        if not self.frames:
+            # the name caches refer to the previous run's namespaces
+            self.names_generation += 1
+        if self.frame_pool:
+            frame = self.frame_pool.pop()
+            frame.reset(code, global_names, local_names, self.frame)
+        else:
+            frame = Frame(code, global_names, local_names, self.frame)
+        frame.instructions = self.decode(code)
         return frame
 
+    def decode(self, code_obj):
+        """ return the instruction table for this code object,
+        decoding it the first time it is seen"""
+        instructions = self.decoded_instructions.get(code_obj)
+        if instructions is None:
+            instructions = decode_instructions(code_obj)
+            # the line table is built at the same time, so the editor and
+            # error messages never have to decode the line numbers
+            lines = self.line_table(code_obj)
+            # the lines are traced from their first real instruction
+            # (RESUME only marks the start of a function)
+            starts = [offset for offset, line in dis.findlinestarts(code_obj)
+                      if instructions[offset >> 1] and
+                      instructions[offset >> 1][1] != 'RESUME']
+            if self.inline_name_caches and self.names_cacheable:
+                instructions = add_name_caches(instructions, self.live_names)
+            if self.fuse_instructions and not self.profiler:
+                instructions = fuse_instructions(
+                    instructions, self.dispatch_table,
+                    self.world_variables, HAS_JUMP)
+            if self.record_trace and not self.profiler:
+                instructions = add_trace_points(
+                    instructions, lines, starts, self.dispatch_table,
+                    HAS_JUMP)
+            self.decoded_instructions[code_obj] = instructions
+        return instructions
+
+    def line_table(self, code_obj):
+        """ return the source line of each instruction in this code object
+        (see decode_lines), working them out the first time it is seen"""
+        lines = self.line_tables.get(code_obj)
+        if lines is None:
+            lines = decode_lines(code_obj)
+            self.line_tables[code_obj] = lines
+        return lines
+
+    def line_at(self, code_obj, offset):
+        """ the source line of the instruction at offset, or None if it
+        isn't part of any line """
+        lines = self.line_table(code_obj)
+        if not lines:
+            return None
+        return lines[min(offset >> 1, len(lines) - 1)] or None
+
+    def current_line(self):
+        """ the line the program has got to, or None if it isn't running.
+        This is the line of the next instruction, unless the program is
+        waiting for the one it has just run (eg for BIT to move after a
+        store to bit_x). It is only a lookup in the line table, so the
+        editor can call it every frame without slowing the program down"""
+        frame = self.frame
+        if frame is None or frame.code_obj is None:
+            return None
+        if self.is_waiting():
+            return self.executed_line()
+        return self.line_at(frame.code_obj, frame.last_instruction)
+
+    def executed_line(self):
+        """ the line of the instruction that has just run. The frame has
+        already moved on to the next one, so this is the line of the slot
+        just before that, which belongs to the instruction that ran (or its
+        inline cache), unless it jumped. Instructions that fail never jump,
+        so this is where errors are reported"""
+        frame = self.frame
+        if frame is None or frame.code_obj is None:
+            return None
+        return self.line_at(frame.code_obj,
+                            max(0, frame.last_instruction - 2))
+
+    def note_exception_line(self):
+        """ remember where the last exception was raised. An exception
+        from one of the program's own functions is caught again by each
+        of the calls it passes through, but it is reported on the line
+        where it first happened. An exception from a native region is
+        reported on the line of the loop where it happened, rather than
+        on the loop's header"""
+        exception = self.last_exception[1]
+        if self.exception_line is None or \
+                self.exception_line[0] is not exception:
+            line = region_error_line(exception)
+            if line is None:
+                line = self.executed_line()
+            self.exception_line = (exception, line)
+
     def push_frame(self, frame):
+        self.quotas.check_call_depth(len(self.frames))
         self.frames.append(frame)
         self.frame = frame
 
     def pop_frame(self):
-        self.frames.pop()
+        frame = self.frames.pop()
         if self.frames:
             self.frame = self.frames[-1]
+            # a finished function call - keep its frame for the next one.
+            # The program's top level frame is left alone, since the
+            # caller may still want to look at it
+            if self.frame_pool_size and \
+                    len(self.frame_pool) < self.frame_pool_size:
+                frame.release()
+                self.frame_pool.append(frame)
         else:
             self.frame = None
 
@@ -319,7 +1042,7 @@ class VirtualMachine:
 
     # Block stack manipulation
     def push_block(self, b_type, handler=None):
-        stack_height = len(self.frame.stack)
+        stack_height = len(self.stack)
         self.frame.block_stack.append(Block(b_type, handler, stack_height))
 
     def pop_block(self):
@@ -334,7 +1057,7 @@ class VirtualMachine:
         else:
             offset = 0
 
-        while len(self.frame.stack) > block.level + offset:
+        while len(self.stack) > block.stack_height + offset:
             self.pop()
 
         if block.type == 'except-handler':
@@ -376,45 +1099,72 @@ class VirtualMachine:
         return stack_unwind_reason
 
     def parse_byte_and_args(self):
-        """ parse the bytecode instruction
-        if the instruction has no arguments, it is a single byte long
-        instructions with arguments are 3 bytes long - argument = 2 bytes """
+        """ fetch the next instruction from the pre-decoded table
+        for the current frame and move on to the following one"""
         f = self.frame  # for brevity
-        op_offset = f.last_instruction
-        byte_code = f.code_obj.co_code[op_offset]
-        byte_name = dis.opname[byte_code]
-
-        # this uses the lists included in the dis module to check the meaning
-        # of the arguments for each instruction. There are only a few
-        # different possibilities and this approach is much more concise
-        # than exhaustively testing for each individual instruction
-        if byte_code >= dis.HAVE_ARGUMENT:
-            # index into the byte code
-            # +1, so we access the argument, not the op_code
-            arg_val = f.code_obj.co_code[f.last_instruction + 1]
-            if byte_code in dis.hasconst:  # look up a constant
-                arg = f.code_obj.co_consts[arg_val]
-            elif byte_code in dis.hasname:  # look up a name
-                arg = f.code_obj.co_names[arg_val]
-            elif byte_code in dis.haslocal:  # look up a local name
-                arg = f.code_obj.co_varnames[arg_val]
-            elif byte_code in dis.hasjrel:  # calculate relative jump
-                # +2 so the jump does not include the current instruction
-                arg = f.last_instruction + arg_val + 2
-            else:
-                arg = arg_val
-            argument = [arg]
-        else:
-            argument = []
-
-        # move to next instruction
-        # all byte codes are exactly 2 bytes, since Python 3.6
-        f.last_instruction += 2
-        return byte_name, argument
-
-    def dispatch(self, byte_name, argument):
+        byte_code, byte_name, argument, next_offset = \
+            f.instructions[f.last_instruction >> 1]
+        # move to next instruction, skipping any inline cache entries
+        f.last_instruction = next_offset
+        return byte_code, argument
+
+    @classmethod
+    def get_dispatch_table(cls):
+        """ returns a list, indexed by opcode, of the function that
+        implements each bytecode (or None if it is not supported).
+        The table is built once per class, the first time it is needed."""
+        if '_dispatch_table' not in cls.__dict__:
+            # from 3.12 opname also lists the pseudo-instructions (>255)
+            # and the superinstruction and trace points come after them
+            table = [None] * (LOOP_OPCODE + 1)
+            for byte_code, byte_name in enumerate(dis.opname):
+                bytecode_fn = getattr(cls, 'byte_%s' % byte_name, None)
+                if bytecode_fn is None:
+                    # the operator instructions share generic handlers,
+                    # so we bind the actual operator function in here
+                    if byte_name.startswith('UNARY_'):
+                        op = cls.UNARY_OPERATORS.get(byte_name[6:])
+                        if op is not None:
+                            bytecode_fn = unary_handler(op)
+                    elif byte_name.startswith('BINARY_'):
+                        op_name = byte_name[7:]
+                        op = cls.BINARY_OPERATORS.get(op_name)
+                        if op is not None and op_name in GUARDED_OPERATORS:
+                            bytecode_fn = guarded_binary_handler(op_name, op)
+                        elif op is not None:
+                            bytecode_fn = binary_handler(op)
+                    elif byte_name.startswith('INPLACE_'):
+                        op_name = byte_name[8:]
+                        op = cls.INPLACE_OPERATORS.get(op_name)
+                        if op is not None and op_name in GUARDED_OPERATORS:
+                            bytecode_fn = guarded_binary_handler(op_name, op)
+                        elif op is not None:
+                            bytecode_fn = binary_handler(op)
+                table[byte_code] = bytecode_fn
+            table[FUSED_OPCODE] = run_fused
+            table[LINE_OPCODE] = trace_line
+            table[LOOP_OPCODE] = trace_loop
+            cls._dispatch_table = table
+            # from 3.11 all the binary operators share one instruction,
+            # BINARY_OP, whose argument is an index into this table
+            cls._binary_op_table = [cls.binary_op_entry(nb_name)
+                                    for nb_name, symbol
+                                    in getattr(dis, '_nb_ops', [])]
+        return cls._dispatch_table
+
+    @classmethod
+    def binary_op_entry(cls, nb_name):
+        """ returns (op_name, operator function) for one of the BINARY_OP
+        arguments, eg NB_INPLACE_ADD -> ('ADD', operator.iadd)"""
+        op_name = nb_name[3:].replace('REMAINDER', 'MODULO')
+        if op_name.startswith('INPLACE_'):
+            op_name = op_name[8:]
+            return op_name, cls.INPLACE_OPERATORS.get(op_name)
+        return op_name, cls.BINARY_OPERATORS.get(op_name)
+
+    def dispatch(self, byte_code, argument):
         """ the python equivalent of CPython's 1500-line switch statement
-        each byte name is assigned to its corresponding method.
+        each opcode is looked up in the dispatch table to find its method.
         Exceptions are caught and set on the VM"""
 
         # this state variable keeps track of what the interpreter was doing
@@ -423,45 +1173,67 @@ class VirtualMachine:
         # the possible values are None, continue, break, return and exception
         stack_unwind_reason = None  # the normal case
         try:
-            bytecode_fn = getattr(self, 'byte_%s' % byte_name, None)
+            bytecode_fn = self.dispatch_table[byte_code]
             if bytecode_fn is None:
-                if byte_name.startswith('UNARY_'):
-                    self.unaryOperator(byte_name[6:])
-                elif byte_name.startswith('BINARY_'):
-                    self.binaryOperator(byte_name[7:])
-                elif byte_name.startswith('INPLACE_'):
-                    self.inplaceOperator(byte_name[8:])
-                else:
-                    # raise VirtualMachineError(
-                    #    "unsupported bytecode type: %s" % byte_name
-                    # )
-                    console_msg("BZZT! Cannot recognise the bytecode" + byte_name, 0)
-                    stack_unwind_reason = 'quit'
-            else:
-                stack_unwind_reason = bytecode_fn(*argument)
+                # compile() checks every code object, so this is a bug
+                console_msg("BZZT! Cannot recognise the bytecode "
+                            + dis.opname[byte_code], 0)
+                raise VirtualMachineError(
+                    "unsupported bytecode: " + dis.opname[byte_code])
+            stack_unwind_reason = bytecode_fn(self, *argument)
         except:
             # handles run-time errors while executing the code
             self.last_exception = sys.exc_info()[:2] + (None,)
+            self.note_exception_line()
             stack_unwind_reason = 'exception'
 
         return stack_unwind_reason
 
+    def profiled_step(self):
+        """ fetch and dispatch the next instruction, while recording the
+        time taken for the profiler """
+        frame = self.frame  # the call may push a new frame
+        # a return releases the frame, so find the line first
+        line = self.line_table(frame.code_obj)[frame.last_instruction >> 1]
+        byte_code, argument = self.parse_byte_and_args()
+        start = time.perf_counter()
+        stack_unwind_reason = self.dispatch(byte_code, argument)
+        self.profiler.record_instruction(line, byte_code,
+                                         time.perf_counter() - start)
+        return stack_unwind_reason
+
+    def enable_profiling(self, enabled=True):
+        """ turn the profiler on or off for subsequent runs """
+        if enabled:
+            self.profiler = Profiler(self.robot.name)
+        else:
+            self.profiler = None
+        # the profiler records the original instructions, not superinstructions
+        self.decoded_instructions = {}
+
     def run_frame(self, frame):
         """ frames run until they return a value or raise an exception"""
         self.push_frame(frame)
+        self.synchronous_depth += 1
         while self.running:
             # let the game world update to reflect keyboard input and physics
-            # we guarantee to update once per bytecode,
-            # but if the world is busy (eg moving blocks, keep calling
-            # update until it isn't
-            self.world.update(self.robot)
-            while self.world.busy():
-                self.world.update(self.robot)
+            # this only happens once the scheduler budget for the current
+            # frame is used up, or something in the world needs to finish
+            # (eg moving blocks), so pure computation runs at full speed
+            if self.render_frames and self.frame_due():
+                self.yield_to_world()
             # makes sure game variables in the program affect the world
-            self.sync_world_variables(frame)
+            if self.dirty_world_names or not self.track_world_writes:
+                self.sync_world_variables(frame)
 
-            byte_name, arguments = self.parse_byte_and_args()
-            stack_unwind_reason = self.dispatch(byte_name, arguments)
+            if self.profiler:
+                stack_unwind_reason = self.profiled_step()
+            else:
+                byte_code, arguments = self.parse_byte_and_args()
+                stack_unwind_reason = self.dispatch(byte_code, arguments)
+            self.bytecodes_executed += 1
+            if self.bytecodes_executed >= self.watchdog_check_at:
+                self.check_watchdog()
 
             # block management
             while stack_unwind_reason and frame.block_stack:
@@ -471,6 +1243,7 @@ class VirtualMachine:
             if stack_unwind_reason:
                 break
 
+        self.synchronous_depth -= 1
         self.pop_frame()
 
         if stack_unwind_reason == 'exception':
@@ -489,7 +1262,152 @@ class VirtualMachine:
         return self.return_value
 
     def update(self):
-        """ continue executing the current program"""
+        """ continue executing the current program
+        this is called once per frame from the main game loop, and runs
+        a budget of bytecodes, unless the program is waiting for the world"""
+        if not self.stepping:
+            return
+        if not self.running:
+            # the program has been halted, either by the user
+            # or by the watchdog
+            self.finish('quit' if self.runaway else None)
+            return
+        self.count_frame()
+        if self.pending_sync:
+            self.check_world_sync()
+        if self.waiting_for_input:
+            if self.world.input.is_active():
+                return
+            # swap the placeholder for what the user actually typed
+            self.stack[-1] = self.robot.end_input()
+            self.waiting_for_input = False
+        if self.is_waiting() or self.world.busy():
+            if self.profiler:
+                self.profiler.record_frame_waited()
+            return
+        deadline = None
+        if self.time_slice:
+            deadline = time.perf_counter() + self.time_slice
+        self.step(self.instruction_budget, deadline)
+
+    def step(self, n=1, deadline=None):
+        """ execute up to n bytecodes of a stepped program.
+        Stops early if the program finishes, needs to wait for the world,
+        or the deadline (from time.perf_counter) passes.
+        Returns the number of bytecodes executed"""
+        executed = 0
+        while (executed < n and self.stepping and self.running
+               and not self.is_waiting()):
+            frame = self.frame
+            if self.profiler:
+                stack_unwind_reason = self.profiled_step()
+            else:
+                byte_code, arguments = self.parse_byte_and_args()
+                stack_unwind_reason = self.dispatch(byte_code, arguments)
+            executed += 1
+            self.bytecodes_executed += 1
+            if self.bytecodes_executed >= self.watchdog_check_at:
+                self.check_watchdog()
+            # makes sure game variables in the program affect the world
+            if self.dirty_world_names or not self.track_world_writes:
+                self.request_world_sync(frame)
+            if stack_unwind_reason:
+                self.unwind_stepped_frames(stack_unwind_reason)
+            if deadline and time.perf_counter() >= deadline:
+                break
+        return executed
+
+    def unwind_stepped_frames(self, stack_unwind_reason):
+        """ the stepped equivalent of the end of run_frame: handles
+        returns and exceptions, which may finish the current frame"""
+        while stack_unwind_reason:
+            # block management
+            while stack_unwind_reason and self.frame.block_stack:
+                stack_unwind_reason = \
+                    self.manage_block_stack(stack_unwind_reason)
+            if not stack_unwind_reason:
+                return
+            self.pop_frame()
+            if stack_unwind_reason == 'return':
+                result = self.return_value
+            else:
+                result = stack_unwind_reason
+            if not self.frames:
+                # the whole program has finished
+                self.finish(result)
+                return
+            if stack_unwind_reason == 'return':
+                # pass the return value back to the calling frame
+                self.push(result)
+                stack_unwind_reason = None
+            # exceptions and quits carry on unwinding in the caller
+
+    def call_function(self, func, args):
+        """ call func, or if it is one of this program's own functions
+        and we are stepping, just push its frame so it runs next """
+        if isinstance(func, Function) and func._vm is self \
+                and self.can_suspend():
+            self.push_frame(func.make_call_frame(*args))
+        else:
+            self.quotas.check_call(func, args)
+            self.push(func(*args))
+
+    def run_native(self, index, iterable):
+        """ run one of the program's native regions (a for loop) over
+        iterable. Returns an empty tuple if the loop ran natively, or the
+        iterable itself if the interpreter should run the loop instead """
+        region = self.native_regions[index]
+        if not self.native_execution:
+            return iterable
+        try:
+            length = len(iterable)
+        except (TypeError, OverflowError):
+            # generators etc could run forever, out of sight of the watchdog
+            return iterable
+        if length > self.native_max_iterations:
+            return iterable
+        global_names = self.frame.global_names
+        # the region was checked when it was compiled, but a name could
+        # since have been bound to one of the program's functions, or to
+        # print or list etc, eg p = print. Calling any of them natively
+        # could reach the world (or grow a container out of sight of the
+        # quotas), so the loop is interpreted instead
+        if not is_plain_value(iterable, self.native_max_iterations):
+            return iterable
+        builtin_names = self.frame.builtin_names
+        for name in region.names:
+            if name in global_names:
+                value = global_names[name]
+            else:
+                value = builtin_names.get(name)
+            if not is_plain_value(value, self.native_max_iterations):
+                return iterable
+
+        def tick():
+            for name in region.names:
+                self.quotas.check_container(global_names.get(name))
+
+        global_names[ITERABLE_NAME] = iterable
+        global_names[GUARD_NAME] = self.native_guard
+        global_names[TICK_NAME] = tick
+        try:
+            exec(region.code, global_names)
+        finally:
+            for name in (ITERABLE_NAME, GUARD_NAME, TICK_NAME):
+                global_names.pop(name, None)
+            # the region can create new variables
+            self.names_generation += 1
+        # count each iteration as an instruction, so long programs made of
+        # many native loops are still stopped by the watchdog
+        self.bytecodes_executed += length
+        return ()
+
+    def native_guard(self, op_name, a, b, in_place):
+        """ a [op] b, for native regions, checked against the quotas """
+        self.quotas.check_operation(op_name, a, b)
+        if in_place:
+            return self.INPLACE_OPERATORS[op_name](a, b)
+        return self.BINARY_OPERATORS[op_name](a, b)
 
     def jump(self, target):
         """Set bytecode pointer to "target", so this instruction is next"""
@@ -499,20 +1417,49 @@ class VirtualMachine:
         # converts all the source into a single string with carriage returns
         return chr(13).join(self.source)
 
-    def compile(self):
+    # compiled & verified code objects, keyed by their source code
+    # this is shared by all VMs, so each sentry program only needs to be
+    # compiled once per level, however many times it is run
+    code_cache = {}
+
+    def precompile(self, source):
+        """ compile a program in advance and keep it in the code cache,
+        so that running it later does not need the compiler"""
+        self.load(source)
+        return self.compile(cache=True)
+
+    def compile(self, cache=False):
         # build bytecode from the source using compile
         # and display the dissassembled instructions using dis
+        # if cache is True, the result is stored in (or fetched from)
+        # the code cache, instead of compiling the same source again
 
         console_msg("Lexing...", 6)
+        self.trace = None  # the last run's trace isn't this program's
         success = True
         token_list = []
         unrecognised = []
         source = self.get_code()
         if not source:  # bail immediately if source is empty
             return False, ''
+        if cache and source in self.code_cache:
+            self.byte_code, self.native_regions = self.code_cache[source]
+            self.names_cacheable = not (referenced_names(self.byte_code) &
+                                        UNCACHEABLE_NAMES)
+            return True, "compilation successful"
         try:
-            code_object = compile(source, '', 'exec')
-            token_list = dis.get_instructions(code_object)
+            if self.native_execution:
+                # find the loops that can run natively, and rewrite them
+                # to call run_native, before compiling the rest as normal
+                tree = ast.parse(source)
+                excluded = (set(self.world_variables) |
+                            set(self.overridden_builtins))
+                native_regions = extract_native_regions(tree, excluded)
+                code_object = compile(tree, '', 'exec')
+            else:
+                native_regions = []
+                code_object = compile(source, '', 'exec')
+            token_list = all_instructions(code_object)
         except Exception as e:
             # handle lexing errors
             console_msg("Compiler error!",3)
@@ -534,22 +1481,7 @@ class VirtualMachine:
                 console_msg("\t" + instruction.opname
                             + str(instruction.argval), 4)
                 # check that the instructions are all defined
-                defined = False
-                bytecode_fn = getattr(self,
-                                      'byte_%s' % instruction.opname, None)
-                if bytecode_fn is not None:
-                    defined = True
-                elif (instruction.opname.startswith('BINARY_') and
-                      instruction.opname[7:] in self.BINARY_OPERATORS.keys()):
-                    defined = True
-                elif (instruction.opname.startswith('INPLACE_') and
-                    instruction.opname[8:] in self.INPLACE_OPERATORS.keys()):
-                    defined = True
-                elif (instruction.opname.startswith('UNARY_') and
-                      instruction.opname[6:] in self.UNARY_OPERATORS.keys()):
-                    defined = True
-
-                if not defined:
+                if self.dispatch_table[instruction.opcode] is None:
                     unrecognised.append(instruction.opname)
         if unrecognised:
             for i in unrecognised:
@@ -558,6 +1490,16 @@ class VirtualMachine:
 
         if success:
             self.byte_code = code_object
+            self.native_regions = native_regions
+            self.names_cacheable = not (referenced_names(code_object) &
+                                        UNCACHEABLE_NAMES)
+            if cache:
+                self.code_cache[source] = (code_object, native_regions)
+            else:
+                # instruction tables from the previous program
+                # are no longer needed
+                self.decoded_instructions = {}
+                self.line_tables = {}
             print('Compiling:')  # actually it was compiled earlier, but nvm
             print('\t', end='')
             for c in code_object.co_code:
@@ -645,15 +1587,14 @@ class VirtualMachine:
         posargs = self.popn(lenPos)
 
         func = self.pop()
-        # frame = self.frame
-        retval = func(*posargs)
-        self.push(retval)
+        self.call_function(func, posargs)
 
     def byte_CALL_METHOD(self, arg_count):
         args = self.popn(arg_count)
         obj, method = self.popn(2)
-        result = method(*args)
-        self.push(result)
+        self.call_function(method, args)
+        # methods like append & extend grow their object in place
+        self.quotas.check_container(obj)
 
     COMPARE_OPERATORS = [
         operator.lt,
@@ -683,7 +1624,11 @@ class VirtualMachine:
             v = next(iter_object)  # v is the current value of the loop var
             self.push(v)
         except StopIteration:
-            self.pop()
+            if FOR_ITER_KEEPS_ITERATOR:
+                # END_FOR (and POP_TOP in 3.13) tidy up the stack
+                self.push(None)
+            else:
+                self.pop()
             self.jump(jump)
 
     def byte_GET_ITER(self):
@@ -706,23 +1651,20 @@ class VirtualMachine:
     }
 
     def byte_IMPORT_NAME(self, name):
+        # modules come from the registry, not python's import system
         level, fromlist = self.popn(2)
-        frame = self.frame
-        self.push(
-            __import__(name, frame.global_names,
-                       frame.local_names, fromlist, level)
-        )
+        self.push(import_module(name, None, None, fromlist, level))
 
     def byte_IMPORT_STAR(self):
-        # TODO: this doesn't use __all__ properly.
         mod = self.pop()
-        for attr in dir(mod):
-            if attr[0] != '_':
-                self.frame.local_names[attr] = getattr(mod, attr)
+        local_names = self.frame.local_names
+        for attr in star_names(mod):
+            local_names[attr] = getattr(mod, attr)
+        self.names_generation += 1
 
     def byte_IMPORT_FROM(self, name):
         mod = self.top()
-        self.push(getattr(mod, name))
+        self.push(module_attribute(mod, name))
 
     def byte_JUMP_FORWARD(self, target):
         self.jump(target)
@@ -730,27 +1672,32 @@ class VirtualMachine:
     def byte_JUMP_ABSOLUTE(self, target):
         self.jump(target)
 
-    def byte_LOAD_ATTR(self, attr):
+    def byte_LOAD_ATTR(self, attr, method=False):
         obj = self.pop()
         val = getattr(obj, attr)
-        self.push(val)
+        if method:
+            # 3.12 loads methods with LOAD_ATTR, ready for CALL
+            self.push_callable(val)
+        else:
+            self.push(val)
 
     def byte_LIST_APPEND(self, count):
         # Calls list.append(TOS[-i], TOS).
         # Used to implement list comprehensions.
         val = self.pop()
-        list = self.frame.stack[-count]  # peek without popping
+        list = self.stack[-count]  # peek without popping
         list.append(val)
+        self.quotas.check_container(list)
 
     def byte_LIST_EXTEND(self, count):
         # added LPV v0.4
         # Calls list.extend(TOS1[-i], TOS). Used to build lists.
-        #TODO figure out why LIST_EXTEND needs self.stack
-        # but LIST_APPEND uses self.frame.stack
-        # I don't think I'm implementing frames properly
+        # like LIST_APPEND, this uses the VM's data stack,
+        # which is shared by all frames
         val = self.pop()
         list = self.stack[-count]  # peek without popping
         list.extend(val)
+        self.quotas.check_container(list)
 
     def byte_LOAD_CONST(self, const):
         # add a literal to the stack
@@ -763,27 +1710,50 @@ class VirtualMachine:
         else:
             self.run_time_error = "NAME ERROR: '" + name \
                                   + "' referenced before assignment."
+            self.run_time_error_line = self.executed_line()
             print(self.run_time_error)
 
-    def byte_LOAD_GLOBAL(self, name):
+    def byte_LOAD_GLOBAL(self, name, push_null=False, cache=None):
+        if cache is not None and cache[0] == self.names_generation:
+            val = cache[1][name]
+            if push_null:
+                self.push_callable(val)
+            else:
+                self.push(val)
+            return
         frame = self.frame
         found = True
         val = None
+        if name in self.live_names:
+            self.refresh_world_variable(frame, name)
         if name in frame.global_names:
-            val = frame.global_names[name]
+            names = frame.global_names
         elif name in self.overridden_builtins:
-            val = self.overridden_builtins[name]
+            names = self.overridden_builtins
         elif name in frame.builtin_names:
-            val = frame.builtin_names[name]
+            names = frame.builtin_names
         else:
             self.run_time_error = "global '" + name \
                                   + "' is not defined."
+            self.run_time_error_line = self.executed_line()
             print("NAME ERROR: " + self.run_time_error)
             found = False
         if found:
-            self.push(val)
+            val = names[name]
+            if cache is not None:
+                cache[0] = self.names_generation
+                cache[1] = names
+            if push_null:
+                # from 3.11, a global that is about to be called
+                self.push_callable(val)
+            else:
+                self.push(val)
 
     def byte_LOAD_METHOD(self, name):
+        if METHODS_USE_CALL:
+            # the bound method is called like any other function
+            self.byte_LOAD_ATTR(name, method=True)
+            return
         object = self.pop()
         method = getattr(object, name, None)
         # make sure the object actually has a method with this name
@@ -793,36 +1763,62 @@ class VirtualMachine:
         else:
             # push NULL and the object returned by the attribute lookup
             self.run_time_error = "'{0}' is unrecognised.".format(name)
+            self.run_time_error_line = self.executed_line()
             print("ERROR: " + self.run_time_error)
             self.push(None)
             self.push(method)
 
-    def byte_LOAD_NAME(self, name):
+    def byte_LOAD_NAME(self, name, cache=None):
         # the LOAD_ and STORE_NAME functions directly manipulate the
         # live variables of the program
         # this will eventually switch to accessing the variables of the
         # current frame
+        if cache is not None and cache[0] == self.names_generation:
+            self.push(cache[1][name])
+            return
         frame = self.frame
         found = True
+        if name in self.live_names:
+            self.refresh_world_variable(frame, name)
         if name in frame.local_names:
-            val = frame.local_names[name]
+            names = frame.local_names
         elif name in frame.global_names:
-            val = frame.globals[name]
+            names = frame.global_names
         elif name in self.overridden_builtins:
-            val = self.overridden_builtins[name]
+            names = self.overridden_builtins
         elif name in frame.builtin_names:
-            val = frame.builtin_names[name]
+            names = frame.builtin_names
         else:
             self.run_time_error = "'" + name + "' is not defined."
+            self.run_time_error_line = self.executed_line()
             print("NAME ERROR: " + self.run_time_error)
             found = False
         if found:
-            self.push(val)
-
-    def byte_MAKE_FUNCTION(self, arg_count):
-        name = self.pop()
+            self.push(names[name])
+            # local namespaces other than the module's are created afresh
+            # for each frame, so a lookup that found one can't be reused
+            if cache is not None and (names is not frame.local_names or
+                                      names is frame.global_names):
+                cache[0] = self.names_generation
+                cache[1] = names
+
+    def byte_MAKE_FUNCTION(self, flags=0):
+        if MAKE_FUNCTION_POPS_NAME:
+            name = self.pop()
+        else:
+            name = None  # Function uses the name from the code object
         code = self.pop()
-        defaults = self.popn(arg_count)
+        # the flags say which extra values are on the stack, in this order
+        if flags & 0x08:
+            self.pop()  # closures are not supported, so ignore the cells
+        if flags & 0x04:
+            self.pop()  # annotations
+        if flags & 0x02:
+            self.pop()  # keyword-only defaults are not supported
+        if flags & 0x01:
+            defaults = self.pop()
+        else:
+            defaults = ()
         globs = self.frame.global_names
         new_function = Function(name, code, globs, defaults, None, self)
         self.push(new_function)
@@ -861,10 +1857,38 @@ class VirtualMachine:
         self.push(map)
 
     def byte_STORE_NAME(self, name):
-        self.frame.local_names[name] = self.pop()
+        names = self.frame.local_names
+        if self.inline_name_caches and name not in names:
+            self.names_generation += 1  # a new variable
+        names[name] = self.pop()
+        if name in self.world_variables:
+            # the world needs to catch up with this change
+            self.dirty_world_names.add(name)
+            self.world_writes += 1
+
+    def byte_STORE_GLOBAL(self, name):
+        names = self.frame.global_names
+        if self.inline_name_caches and name not in names:
+            self.names_generation += 1
+        names[name] = self.pop()
+        if name in self.world_variables:
+            self.dirty_world_names.add(name)
+            self.world_writes += 1
 
     def byte_STORE_FAST(self, name):
-        self.frame.local_names[name] = self.pop()
+        val = self.pop()
+        frame = self.frame
+        if self.inline_name_caches and \
+                frame.local_names is frame.global_names and \
+                (val is NULL or name not in frame.local_names):
+            # a comprehension at the top level of the program (3.12+) is
+            # adding or removing a global
+            self.names_generation += 1
+        if val is NULL:
+            # restoring a name that was unset before a comprehension (3.12+)
+            frame.local_names.pop(name, None)
+        else:
+            frame.local_names[name] = val
 
     UNARY_OPERATORS = {
         'POSITIVE': operator.pos,
@@ -877,4 +1901,139 @@ class VirtualMachine:
         # Unpacks TOS into count individual values, which are put onto the stack right-to-left
         values = self.pop()
         for v in reversed(values):
-            self.push(v)
\ No newline at end of file
+            self.push(v)
+
+    def byte_IS_OP(self, invert):
+        a, b = self.popn(2)
+        self.push((a is not b) if invert else (a is b))
+
+    def byte_CONTAINS_OP(self, invert):
+        a, b = self.popn(2)
+        self.push((a not in b) if invert else (a in b))
+
+    ##############################################
+    # instructions added in Python 3.11 and later
+
+    def byte_NOP(self):
+        pass
+
+    def byte_EXTENDED_ARG(self, arg):
+        # the argument is already part of the following instruction
+        pass
+
+    def byte_RESUME(self, arg):
+        pass
+
+    def byte_PRECALL(self, arg_count):
+        # 3.11 only: the call itself is done by CALL
+        pass
+
+    def byte_PUSH_NULL(self):
+        self.push(NULL)
+
+    def push_callable(self, func):
+        """ push a function along with the NULL that CALL expects.
+        Methods are pushed already bound to their object, so the VM
+        never needs CPython's unbound method + self form"""
+        if NULL_ABOVE_CALLABLE:
+            self.push(func, NULL)
+        else:
+            self.push(NULL, func)
+
+    def byte_CALL(self, arg_count):
+        args = self.popn(arg_count)
+        # the function, plus either NULL or a first argument (eg the
+        # iterator passed to a 3.11 comprehension)
+        func, first_arg = self.popn(2)
+        if func is NULL and not NULL_ABOVE_CALLABLE:
+            func, first_arg = first_arg, NULL
+        if first_arg is not NULL:
+            args.insert(0, first_arg)
+        self.call_function(func, args)
+        # methods like append & extend grow their object in place
+        self.quotas.check_container(getattr(func, '__self__', None))
+
+    def byte_BINARY_OP(self, op_index):
+        op_name, op = self._binary_op_table[op_index]
+        a, b = self.popn(2)
+        if op_name in GUARDED_OPERATORS:
+            self.quotas.check_operation(op_name, a, b)
+        self.push(op(a, b))
+
+    def byte_RETURN_CONST(self, const):
+        if CONSOLE_VERBOSE:
+            print("\t Returning:", const)
+        self.return_value = const
+        return 'return'
+
+    def byte_JUMP_BACKWARD(self, target):
+        self.jump(target)
+
+    byte_JUMP_BACKWARD_NO_INTERRUPT = byte_JUMP_BACKWARD
+
+    def byte_POP_JUMP_IF_NONE(self, target):
+        if self.pop() is None:
+            self.jump(target)
+
+    def byte_POP_JUMP_IF_NOT_NONE(self, target):
+        if self.pop() is not None:
+            self.jump(target)
+
+    # 3.11 has separate forward and backward conditional jumps
+    byte_POP_JUMP_FORWARD_IF_FALSE = byte_POP_JUMP_IF_FALSE
+    byte_POP_JUMP_BACKWARD_IF_FALSE = byte_POP_JUMP_IF_FALSE
+    byte_POP_JUMP_FORWARD_IF_TRUE = byte_POP_JUMP_IF_TRUE
+    byte_POP_JUMP_BACKWARD_IF_TRUE = byte_POP_JUMP_IF_TRUE
+    byte_POP_JUMP_FORWARD_IF_NONE = byte_POP_JUMP_IF_NONE
+    byte_POP_JUMP_BACKWARD_IF_NONE = byte_POP_JUMP_IF_NONE
+    byte_POP_JUMP_FORWARD_IF_NOT_NONE = byte_POP_JUMP_IF_NOT_NONE
+    byte_POP_JUMP_BACKWARD_IF_NOT_NONE = byte_POP_JUMP_IF_NOT_NONE
+
+    def byte_TO_BOOL(self):
+        self.stack[-1] = bool(self.stack[-1])
+
+    def byte_END_FOR(self):
+        self.popn(END_FOR_POPS)
+
+    def byte_COPY(self, i):
+        self.push(self.stack[-i])
+
+    def byte_SWAP(self, i):
+        self.stack[-i], self.stack[-1] = self.stack[-1], self.stack[-i]
+
+    byte_LOAD_FAST_CHECK = byte_LOAD_FAST
+
+    def byte_LOAD_FAST_AND_CLEAR(self, name):
+        # 3.12 comprehensions save the value of their loop variable (or NULL)
+        # before they run, and restore it afterwards with STORE_FAST
+        frame = self.frame
+        if self.inline_name_caches and \
+                frame.local_names is frame.global_names:
+            self.names_generation += 1
+        self.push(frame.local_names.pop(name, NULL))
+
+    def byte_LOAD_FAST_LOAD_FAST(self, first, second):
+        self.byte_LOAD_FAST(first)
+        self.byte_LOAD_FAST(second)
+
+    def byte_STORE_FAST_LOAD_FAST(self, store, load):
+        self.byte_STORE_FAST(store)
+        self.byte_LOAD_FAST(load)
+
+    def byte_STORE_FAST_STORE_FAST(self, first, second):
+        self.byte_STORE_FAST(first)
+        self.byte_STORE_FAST(second)
+
+    def byte_SET_FUNCTION_ATTRIBUTE(self, flag):
+        func = self.pop()
+        value = self.pop()
+        if flag == 0x01:
+            func.set_defaults(value)
+        # other attributes (closures, annotations etc) are not supported
+        self.push(func)
+
+    if PY_VERSION >= (3, 11):
+        def byte_RERAISE(self, oparg):
+            # this is only reached through an exception table, which the VM
+            # does not use yet, but 3.12 comprehensions always include one
+            raise self.pop()
\ No newline at end of file
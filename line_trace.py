@@ -0,0 +1,217 @@
+""" a compact trace of the lines a program ran, saved in the session log
+with each attempt (see Session.save_run), so a teacher can see what a
+student's program actually did without running it again.
+
+The VM doesn't check the line of every instruction. Instead add_trace_points
+marks a few instructions in the instruction table (see decode_instructions):
+the first instruction of each line, and each jump back to the start of a
+loop. Only those go through LineTrace, so the trace costs nothing while the
+program carries on along a line, and the table is left alone when traces
+aren't being recorded.
+
+The trace is a list of short strings, one per entry:
+    5          line 5 ran
+    5*20       line 5 ran 20 times in a row (eg a one line loop)
+    bit_x=7    the program set a world variable
+    > 'hi'     the program printed something
+    (2 3)*20   entries that repeated 20 times in a row (eg a loop body)
+A span of up to TRACE_MAX_SPAN entries is merged as soon as it has run twice
+in a row. After that, each repeat costs a single comparison.
+If the program runs for a long time, only the start and the end of the trace
+are kept, with a note of how many entries were left out in between.
+"""
+import collections
+
+from constants import TRACE_MAX_ENTRIES, TRACE_MAX_SPAN
+from snapshots import SHORT_REPR
+from superinstructions import FUSED_OPCODE
+
+# the trace point instructions, after the superinstruction
+LINE_OPCODE = FUSED_OPCODE + 1
+LOOP_OPCODE = FUSED_OPCODE + 2
+
+
+class LineTrace:
+    def __init__(self, max_entries=TRACE_MAX_ENTRIES,
+                 max_span=TRACE_MAX_SPAN):
+        self.head_size = max_entries // 2  # entries kept from the start
+        self.head = []
+        # the most recent entries, once the head is full
+        self.tail = collections.deque(maxlen=max_entries - self.head_size)
+        self.added = 0  # entries so far, including any left out
+        # the line that is running, and how many times in a row it has run
+        self.line = None
+        self.count = 0
+        self.stores = {}  # the last value written to each world variable
+        self.max_span = max_span
+        # the latest entries, which might yet turn out to repeat
+        self.recent = []
+        # the span of entries that is repeating, how many times it has
+        # repeated so far, and the position in the span of the next entry
+        self.span = None
+        self.repeats = 0
+        self.position = 0
+
+    def record(self, line, repeat=False):
+        """ note that a line has started. The same line carries on the
+        current run if it has started again (eg round a loop), and is
+        otherwise part of the line that is already running """
+        if line != self.line:
+            if self.line is not None:
+                self.push((self.line, self.count))
+            self.line = line
+            self.count = 1
+        elif repeat:
+            self.count += 1
+
+    def store(self, name, value):
+        """ note a write to a world variable, if its value has changed """
+        text = SHORT_REPR.repr(value)
+        if self.stores.get(name) != text:
+            self.stores[name] = text
+            self.end_run()
+            self.push(name + '=' + text)
+
+    def output(self, text):
+        self.end_run()
+        self.push('> ' + SHORT_REPR.repr(text))
+
+    def end_run(self):
+        if self.line is not None:
+            self.push((self.line, self.count))
+            self.line = None
+
+    def push(self, entry):
+        """ entries are (line, count) runs, which are only turned into
+        text at the end, or already text. A span that repeats is kept as
+        (entries, repeats) """
+        if self.span is not None:
+            if entry == self.span[self.position]:
+                self.position += 1
+                if self.position == len(self.span):
+                    self.repeats += 1
+                    self.position = 0
+                return
+            self.end_span()
+        recent = self.recent
+        recent.append(entry)
+        # do the latest entries repeat the ones just before them?
+        for length in range(1, min(self.max_span, len(recent) // 2) + 1):
+            if (recent[-1] == recent[-1 - length] and
+                    recent[-length:] == recent[-2 * length:-length]):
+                for earlier in recent[:-2 * length]:
+                    self.add(earlier)
+                self.span = tuple(recent[-length:])
+                self.repeats = 2
+                self.position = 0
+                recent.clear()
+                return
+        if len(recent) > 2 * self.max_span:
+            self.add(recent.pop(0))
+
+    def end_span(self):
+        """ the span has stopped repeating. The entries of an unfinished
+        repeat might still start a new span """
+        self.add((self.span, self.repeats))
+        self.recent = list(self.span[:self.position])
+        self.span = None
+
+    def add(self, entry):
+        self.added += 1
+        if self.added <= self.head_size:
+            self.head.append(entry)
+        else:
+            self.tail.append(entry)
+
+    def entries(self):
+        """ the whole trace, as a list of strings """
+        self.end_run()
+        if self.span is not None:
+            self.end_span()
+        for entry in self.recent:
+            self.add(entry)
+        self.recent = []
+        entries = [entry_text(entry) for entry in self.head]
+        dropped = self.added - len(self.head) - len(self.tail)
+        if dropped:
+            entries.append('... ' + str(dropped) + ' more ...')
+        entries.extend(entry_text(entry) for entry in self.tail)
+        return entries
+
+
+def entry_text(entry):
+    if isinstance(entry, str):
+        return entry
+    first, count = entry
+    if isinstance(first, tuple):  # a span of entries that repeated
+        return ('(' + ' '.join(entry_text(e) for e in first) + ')*'
+                + str(count))
+    if count == 1:
+        return str(first)
+    return str(first) + '*' + str(count)
+
+
+def trace_line(vm, line, repeat, bytecode_fn, argument):
+    """ the handler for the first instruction of a line """
+    trace = vm.trace
+    if trace is not None and (line != trace.line or repeat):
+        trace.record(line, repeat)
+    return bytecode_fn(vm, *argument)
+
+
+def trace_loop(vm, line, target, bytecode_fn, argument):
+    """ the handler for a jump back to the start of a loop, which only
+    counts as running the line again if the jump is taken """
+    result = bytecode_fn(vm, *argument)
+    if vm.frame.last_instruction == target and vm.trace is not None:
+        vm.trace.record(line, True)
+    return result
+
+
+def add_trace_points(table, lines, line_starts, dispatch_table,
+                     jump_opcodes):
+    """ returns a copy of an instruction table with its trace points
+    replaced by LINE_OPCODE and LOOP_OPCODE instructions, which record the
+    line and then run the original. lines is the table's line table (see
+    decode_lines) and line_starts the offsets where each line begins.
+    Trace points inside a superinstruction have their step wrapped instead,
+    and there are never any loop jumps inside one."""
+    starts = {offset: lines[offset >> 1] for offset in line_starts
+              if lines[offset >> 1]}
+    # a new call of a function always starts its first line afresh,
+    # even if it is the same line as the one that called it
+    first_start = min(starts, default=None)
+    table = list(table)
+    for i, entry in enumerate(table):
+        if not entry:
+            continue
+        byte_code, byte_name, argument, next_offset = entry
+        offset = i * 2
+        if byte_code == FUSED_OPCODE:
+            steps, extra_instructions = argument
+            wrapped = []
+            for bytecode_fn, step_argument, step_next, is_call in steps:
+                if offset in starts:
+                    step_argument = (starts[offset], offset == first_start,
+                                     bytecode_fn, step_argument)
+                    bytecode_fn = trace_line
+                wrapped.append((bytecode_fn, step_argument, step_next,
+                                is_call))
+                offset = step_next  # where the next step starts
+            table[i] = (byte_code, byte_name,
+                        (tuple(wrapped), extra_instructions), next_offset)
+            continue
+        bytecode_fn = dispatch_table[byte_code]
+        if bytecode_fn is None:
+            continue  # the VM will report it when it gets there
+        if (byte_code in jump_opcodes and argument[0] <= offset and
+                lines[argument[0] >> 1]):
+            target = argument[0]
+            argument = (lines[target >> 1], target, bytecode_fn, argument)
+            byte_code, bytecode_fn = LOOP_OPCODE, trace_loop
+        if offset in starts:
+            argument = (starts[offset], offset == first_start, bytecode_fn,
+                        argument)
+            byte_code = LINE_OPCODE
+        table[i] = (byte_code, byte_name, argument, next_offset)
+    return table
@@ -0,0 +1,64 @@
+""" the modules that players' programs are allowed to import.
+They are all imported once, when the game starts, and every import statement
+is served from the registry rather than going through python's import
+system again (sentries import random each time the world is made, for
+example). Anything that isn't registered can't be imported by name, so a
+program can't stall the game loading a large module.
+
+This only controls which modules an import statement loads. It doesn't
+sandbox the program: a registered module's own imports can still be
+reached through its attributes (eg random._os), and builtins such as open
+and eval are still available.
+
+The engines use import_module in place of __import__ (see their
+overridden_builtins), so programs that call __import__ get the same.
+"""
+import importlib
+import types
+
+from constants import ALLOWED_MODULES
+
+# {name: module}, read only, so a program can't add to it
+MODULES = types.MappingProxyType(
+    {name: importlib.import_module(name) for name in ALLOWED_MODULES})
+
+
+def public_names(module):
+    """ the names that from module import * brings in """
+    public = getattr(module, '__all__', None)
+    if public is None:
+        public = [name for name in vars(module) if name[0] != '_']
+    return tuple(public)
+
+
+# worked out now, so import * doesn't search the module every time
+STAR_NAMES = types.MappingProxyType(
+    {name: public_names(module) for name, module in MODULES.items()})
+
+
+def import_module(name, global_names=None, local_names=None, fromlist=None,
+                  level=0):
+    """ a replacement for __import__ that returns registered modules """
+    if level:
+        raise ImportError("relative imports aren't allowed.")
+    try:
+        return MODULES[name]
+    except KeyError:
+        raise ImportError("module '" + name + "' can't be imported.") \
+            from None
+
+
+def module_attribute(module, name):
+    """ one name from from module import name """
+    try:
+        return getattr(module, name)
+    except AttributeError:
+        raise ImportError("cannot import name '" + name + "' from '"
+                          + module.__name__ + "'") from None
+
+
+def star_names(module):
+    """ public_names, from the registry if the module is registered """
+    if MODULES.get(module.__name__) is module:
+        return STAR_NAMES[module.__name__]
+    return public_names(module)
@@ -0,0 +1,235 @@
+""" finds parts of a student program that can safely run as native Python
+instead of one bytecode at a time on the in-game interpreter.
+
+A native region is a module-level for loop that never touches a world
+variable (bit_x, data etc) or an overridden builtin (print, input), and has
+no nested loops, functions, comprehensions, imports or else clause. Each region's loop
+header is rewritten from
+    for i in range(10):
+to
+    for i in __native__(0, range(10)):
+so the interpreter still evaluates the iterable, then hands it to the
+native version of the loop. If that runs, it returns an empty tuple and
+the interpreted loop does nothing; if it declines, it returns the
+iterable and the interpreter runs the loop as normal.
+
+A region never touches the world, so it declines to run if any of its
+names (or the items it loops over) could run the program's own code, eg a
+function that moves BIT. Only the builtins in NATIVE_BUILTINS and plain
+data can be used (see is_plain_value).
+"""
+import ast
+import builtins
+import copy
+import types
+
+NATIVE_CALL = '__native__'  # name the interpreter binds to run a region
+ITERABLE_NAME = '__native_iterable__'  # the iterable, inside the region
+GUARD_NAME = '__native_guard__'  # checks big arithmetic against the quotas
+TICK_NAME = '__native_tick__'  # called on each iteration of a region
+NATIVE_FILENAME = '<native>'  # the file name the regions are compiled with
+
+# operators that are checked against the resource quotas before they run
+GUARDED_OPERATORS = {
+    ast.Add: 'ADD',
+    ast.Mult: 'MULTIPLY',
+    ast.Pow: 'POWER',
+    ast.LShift: 'LSHIFT',
+}
+
+# builtins that can create huge containers in a single call
+CONTAINER_BUILDER_NAMES = frozenset(['list', 'tuple', 'set', 'frozenset',
+                                     'sorted', 'bytearray', 'dict'])
+
+# the builtins a region can call. None of them can reach the world, or
+# call back into the program except through values that are checked first
+NATIVE_BUILTINS = frozenset(getattr(builtins, name) for name in [
+    'abs', 'all', 'any', 'ascii', 'bin', 'bool', 'chr', 'complex', 'divmod',
+    'enumerate', 'filter', 'float', 'format', 'hash', 'hex', 'int',
+    'isinstance', 'iter', 'len', 'map', 'max', 'min', 'next', 'oct', 'ord',
+    'pow', 'range', 'repr', 'reversed', 'round', 'str', 'sum', 'type', 'zip',
+])
+# values of these types can't hold any of the program's own code
+PLAIN_TYPES = (bool, int, float, complex, str, bytes, type(None), range,
+               types.ModuleType)
+# and these can, in their items, so the items are checked too
+CONTAINER_TYPES = (list, tuple, set, frozenset, dict)
+
+# statements and expressions that are never allowed inside a region
+FORBIDDEN_NODES = (ast.For, ast.AsyncFor, ast.While, ast.FunctionDef,
+                   ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda,
+                   ast.Import, ast.ImportFrom, ast.Global, ast.Nonlocal,
+                   ast.Yield, ast.YieldFrom, ast.Await, ast.Return,
+                   ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp,
+                   ast.With, ast.AsyncWith, ast.Try)
+
+
+class NativeRegion:
+    """ a compiled loop that runs natively, plus the global names it uses,
+    which are checked before and during each run """
+    def __init__(self, code, names, line):
+        self.code = code
+        self.names = names
+        self.line = line
+
+
+def is_native_loop(loop, excluded_names):
+    """ True if this for loop can run natively """
+    # the else clause would run twice: once natively, and again when
+    # the interpreter finishes its (empty) loop
+    if not isinstance(loop, ast.For) or loop.orelse:
+        return False
+    for statement in loop.body:
+        for node in ast.walk(statement):
+            if isinstance(node, FORBIDDEN_NODES):
+                return False
+            if isinstance(node, ast.Name) and (
+                    node.id in excluded_names or node.id.startswith('__')):
+                return False
+            if (isinstance(node, ast.Call) and
+                    isinstance(node.func, ast.Name) and
+                    node.func.id in CONTAINER_BUILDER_NAMES):
+                return False
+            # augmented assignment can only be guarded for plain names
+            # eg total += 1, but not a[i] += 1
+            if (isinstance(node, ast.AugAssign) and
+                    type(node.op) in GUARDED_OPERATORS and
+                    not isinstance(node.target, ast.Name)):
+                return False
+    for node in ast.walk(loop.target):
+        if isinstance(node, ast.Name) and (node.id in excluded_names or
+                                           node.id.startswith('__')):
+            return False
+    return True
+
+
+def is_plain_value(value, max_items):
+    """ True if a region can use this value without running the program's
+    own code: plain data, containers of it, and the builtins above. The
+    program's functions and classes, and instances of its classes (whose
+    operators might be its own functions), all count as code. Containers
+    with more than max_items items in all are too big to check """
+    pending = [value]
+    seen = set()
+    while pending:
+        value = pending.pop()
+        if isinstance(value, PLAIN_TYPES):
+            continue
+        if isinstance(value, CONTAINER_TYPES):
+            if id(value) in seen:
+                continue
+            seen.add(id(value))
+            max_items -= len(value)
+            if max_items < 0:
+                return False
+            if isinstance(value, dict):
+                pending.extend(value.keys())
+                pending.extend(value.values())
+            else:
+                pending.extend(value)
+            continue
+        try:
+            if value in NATIVE_BUILTINS:
+                continue
+        except TypeError:  # unhashable, so not a builtin
+            pass
+        return False
+    return True
+
+
+class GuardOperators(ast.NodeTransformer):
+    """ rewrites a + b as __native_guard__('ADD', a, b) (and the same for
+    the other guarded operators) so the native loop is subject to the same
+    size limits as the interpreter """
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        op_name = GUARDED_OPERATORS.get(type(node.op))
+        if op_name is None:
+            return node
+        call = ast.Call(func=ast.Name(id=GUARD_NAME, ctx=ast.Load()),
+                        args=[ast.Constant(value=op_name), node.left,
+                              node.right, ast.Constant(value=False)],
+                        keywords=[])
+        return ast.copy_location(call, node)
+
+    def visit_AugAssign(self, node):
+        self.generic_visit(node)
+        op_name = GUARDED_OPERATORS.get(type(node.op))
+        if op_name is None:
+            return node
+        # only plain names reach here (see is_native_loop)
+        value = ast.Name(id=node.target.id, ctx=ast.Load())
+        call = ast.Call(func=ast.Name(id=GUARD_NAME, ctx=ast.Load()),
+                        args=[ast.Constant(value=op_name), value, node.value,
+                              ast.Constant(value=True)],
+                        keywords=[])
+        assign = ast.Assign(targets=[node.target], value=call)
+        return ast.copy_location(assign, node)
+
+
+def compile_region(loop):
+    """ build the native code object for a loop """
+    # the interpreter still compiles the original loop, in case the region
+    # declines to run, so the native version is built from a copy
+    loop = copy.deepcopy(loop)
+    names = set()
+    for statement in [loop.target] + loop.body:
+        for node in ast.walk(statement):
+            if isinstance(node, ast.Name):
+                names.add(node.id)
+    # call the tick function at the start of every iteration
+    tick = ast.Expr(value=ast.Call(func=ast.Name(id=TICK_NAME,
+                                                 ctx=ast.Load()),
+                                   args=[], keywords=[]))
+    native_loop = ast.For(target=loop.target,
+                          iter=ast.Name(id=ITERABLE_NAME, ctx=ast.Load()),
+                          body=[tick] + loop.body,
+                          orelse=[])
+    ast.copy_location(native_loop, loop)
+    ast.copy_location(tick, loop)
+    native_loop = GuardOperators().visit(native_loop)
+    module = ast.Module(body=[native_loop], type_ignores=[])
+    ast.fix_missing_locations(module)
+    code = compile(module, NATIVE_FILENAME, 'exec')
+    return NativeRegion(code, frozenset(names), loop.lineno)
+
+
+def region_error_line(exception):
+    """ the line of the program where an exception was raised, if it was
+    raised inside a native region, otherwise None. The regions keep the
+    line numbers of the loops they were compiled from """
+    line = None
+    traceback = exception.__traceback__
+    while traceback is not None:
+        if traceback.tb_frame.f_code.co_filename == NATIVE_FILENAME:
+            line = traceback.tb_lineno
+        traceback = traceback.tb_next
+    return line
+
+
+def extract_native_regions(tree, excluded_names):
+    """ find all the native regions in a module, rewriting their loop
+    headers to call __native__. Returns the list of regions, indexed by
+    the number passed to __native__"""
+    regions = []
+
+    def visit(statements):
+        for statement in statements:
+            # only statements at module scope are considered, so we
+            # look inside if/for/while blocks, but not functions or classes
+            if is_native_loop(statement, excluded_names):
+                # the region is compiled before its header is rewritten
+                regions.append(compile_region(statement))
+                header = ast.Call(func=ast.Name(id=NATIVE_CALL,
+                                                ctx=ast.Load()),
+                                  args=[ast.Constant(value=len(regions) - 1),
+                                        statement.iter],
+                                  keywords=[])
+                statement.iter = ast.copy_location(header, statement.iter)
+            elif isinstance(statement, (ast.If, ast.For, ast.While)):
+                visit(statement.body)
+                visit(statement.orelse)
+
+    visit(tree.body)
+    ast.fix_missing_locations(tree)
+    return regions
@@ -15,6 +15,7 @@ class Mote:
         self.velocity = self.initial_velocity.copy()
         self.type = type
         self.age = randint(0, 20)  # start some particles older, for variety
+        self.hidden = False  # True while inside a block
         self.colour_table = {
             0: (218, 238, 239),
             1: (255, 255, 255),
@@ -85,6 +86,12 @@ class Jet:
 
 
     def update(self, surface, scroll):
+        # move on by one tick, and draw the result
+        self.step()
+        self.draw(surface, scroll)
+
+    def step(self):
+        """ move the particles on by one tick of the simulation """
         if self.active:
             for p in self.particles:
                 # update position and age
@@ -97,17 +104,27 @@ class Jet:
                     p.offset[Y] += p.velocity[Y] * 2  # move out of collision
                     # turn this particle from a spark into dust
                     p.turn_to_dust()
+                    p.hidden = True  # not drawn until it has bounced clear
                 else:
-                    # draw
-                    pygame.draw.circle(surface, p.get_colour(),
-                                       (x - scroll[X],
-                                       y - scroll[Y]),
-                                       1)
-
+                    p.hidden = False
                     # remove any that are too old - should this be in its own loop?
                     if p.age > self.MOTE_LIFETIME:
                         p.reset()
 
+    def draw(self, surface, scroll):
+        """ returns a rect around all the particles that were drawn """
+        rect = pygame.Rect(self.nozzle[X] - scroll[X],
+                           self.nozzle[Y] - scroll[Y], 0, 0)
+        if self.active:
+            for p in self.particles:
+                if not p.hidden:
+                    rect.union_ip(pygame.draw.circle(
+                        surface, p.get_colour(),
+                        (int(self.nozzle[X] + p.offset[X]) - scroll[X],
+                         int(self.nozzle[Y] + p.offset[Y]) - scroll[Y]),
+                        1))
+        return rect
+
     def turn_off(self):
         self.power = 0.0
         self.active = False
@@ -0,0 +1,386 @@
+""" runs programs on the bytecode VM in a separate worker process, so a
+program that crashes or hangs can't take the game with it, and the VM has
+a core of its own instead of sharing the game loop's.
+
+ProcessEngine has the same interface as VirtualMachine, so a Robot can use
+either (see Robot.set_engine). The program runs in the worker exactly as it
+would in the game, except that the world it sees is a WorkerWorld, which
+passes everything the program does to the world back to the game as a
+message, and is kept up to date by a message from the game every frame.
+
+The messages are tuples, starting with one of the tags below.
+From the game to the worker:
+    (RUN, source lines, world values)  start a program
+    (WORLD, world values, busy)        the world after the latest frame
+    (INPUT, text)                      what the player typed
+From the worker to the game:
+    (READY,)                           the worker has started
+    (STORE, name, value)               change a world variable
+    (SAY, text)                        BIT says something
+    (ASK, prompt)                      the program is waiting for input
+    (ERROR, message, type)             show an error above BIT
+    (LINE, line)                       the program is still going, on line
+    (DONE, success, errors)            the program has finished
+World values are {name: value} for each of the VM's world variables.
+
+Stopping a program doesn't need its cooperation: the worker is killed
+and a new one is started, ready for the next program.
+"""
+import contextlib
+import io
+import multiprocessing
+import sys
+import time
+import weakref
+
+from console_messages import console_msg
+from constants import WATCHDOG_MAX_FRAMES, WORKER_TIMEOUT
+from headless import StubWorld
+from interpreter import VirtualMachine
+
+RUN = 'run'
+WORLD = 'world'
+INPUT = 'input'
+READY = 'ready'
+STORE = 'store'
+SAY = 'say'
+ASK = 'ask'
+ERROR = 'error'
+LINE = 'line'
+DONE = 'done'
+
+# spawn works on every platform, and starts the worker without any of
+# the game's state (eg the pygame window)
+WORKER_CONTEXT = multiprocessing.get_context('spawn')
+
+
+class WorkerWorld(StubWorld):
+    """ the game world, as seen from inside the worker """
+    def __init__(self, connection):
+        super().__init__()
+        self.connection = connection
+        self.world_busy = False
+        self.input_text = None
+        self.vm = None  # the VM running in the worker
+
+    def apply(self, values, busy):
+        """ copy the world values sent by the game """
+        self.bit_x = values['bit_x']
+        self.bit_y = values['bit_y']
+        self.player_x = values['me_x']
+        self.player_y = values['me_y']
+        self.data = values['data']
+        self._secret_data = values['_secret_data']
+        self.world_busy = busy
+
+    def set_bit_x(self, value):
+        self.connection.send((STORE, 'bit_x', value))
+
+    def set_bit_y(self, value):
+        self.connection.send((STORE, 'bit_y', value))
+
+    def set_data(self, robot, value):
+        self.connection.send((STORE, 'data', value))
+
+    def set_secret_data(self, robot, value):
+        self.connection.send((STORE, '_secret_data', value))
+
+    def busy(self):
+        return self.world_busy
+
+    def update(self, focus):
+        """ called by the VM when it is ready for the world to move on.
+        If the program is waiting for the world (eg for BIT to move) this
+        waits for the game's next frame, otherwise the program carries on
+        with whatever the game has sent since last time"""
+        self.updates += 1
+        self.connection.send((LINE, self.vm.current_line()))
+        if self.vm.pending_sync or self.world_busy:
+            self.receive(WORLD)
+        else:
+            while self.connection.poll():
+                self.handle(self.connection.recv())
+
+    def receive(self, tag):
+        """ wait for a message with this tag, handling any others that
+        arrive first. A WORLD message that is already waiting will do,
+        since it was sent after the program last heard from the game"""
+        if tag == WORLD:
+            received = False
+            while self.connection.poll():
+                received = self.handle(self.connection.recv()) == WORLD \
+                    or received
+            if received:
+                return
+        while self.handle(self.connection.recv()) != tag:
+            pass
+
+    def handle(self, message):
+        if message[0] == WORLD:
+            self.apply(message[1], message[2])
+        elif message[0] == INPUT:
+            self.input_text = message[1]
+        return message[0]
+
+
+class WorkerRobot:
+    """ BIT, as seen from inside the worker """
+    def __init__(self, connection):
+        self.name = 'worker'
+        self.connection = connection
+        self.world = WorkerWorld(connection)
+        self.output = []
+        vm = VirtualMachine(self)
+        # the worker has nothing else to do, so the program runs straight
+        # through, only stopping for the world every time slice. Frames are
+        # counted by the game, and nobody can replay the history or read the
+        # trace
+        vm.stepped_execution = False
+        vm.instruction_budget = sys.maxsize
+        vm.max_frames = 0
+        vm.record_history = False
+        vm.record_trace = False
+        self.world.vm = vm
+        self.python_interpreter = vm
+
+    def say(self, *t):
+        f = io.StringIO()
+        with contextlib.redirect_stdout(f):
+            print(*t, end='')
+        speech = f.getvalue()
+        self.output.append(speech)
+        self.connection.send((SAY, speech))
+
+    def input(self, msg=''):
+        self.connection.send((ASK, msg))
+        self.world.receive(INPUT)
+        return self.world.input_text
+
+    def error(self, msg, type="Syntax error!"):
+        self.connection.send((ERROR, msg, type))
+
+
+def worker_main(connection):
+    """ the worker process: runs each program it is sent until killed """
+    robot = WorkerRobot(connection)
+    vm = robot.python_interpreter
+    connection.send((READY,))
+    while True:
+        message = connection.recv()
+        if message[0] != RUN:
+            continue  # left over from the last program
+        source, values = message[1], message[2]
+        robot.world.apply(values, False)
+        robot.output = []
+        vm.load(source)
+        # the game has already compiled it and shown the bytecode
+        with contextlib.redirect_stdout(io.StringIO()):
+            success, result = vm.compile()
+        if success:
+            vm.run_enabled = True
+            success, result = vm.run()
+        else:
+            result = [result]
+        # a successful program's result is never used, and may not pickle
+        connection.send((DONE, success, None if success else
+                         [str(error) for error in result]))
+
+
+def kill_worker(worker):
+    if worker.is_alive():
+        worker.kill()
+        worker.join()
+
+
+class ProcessEngine:
+    GET = 0  # index into world_variables tuple
+    SET = 1
+
+    def __init__(self, robot):
+        self.world = robot.world  # link back to the state of the game world
+        self.run_enabled = True
+        self.robot = robot  # the Robot instance that is running this program
+        self.source = []
+        # programs are compiled in the game as well as the worker, so that
+        # syntax errors are reported straight away
+        self.compiler = VirtualMachine(robot)
+        self.world_variables = self.compiler.world_variables
+        self.compile_time_error = None
+        self.running = False
+        self.stepping = False
+        self.on_finish = None  # called with the result of the program
+        self.line = None  # the line the worker last said it was on
+        self.waiting_for_input = False
+        # watchdog limits for the worker. The worker's VM has its own
+        # watchdog, but can't stop itself if it hangs or crashes
+        self.max_frames = WATCHDOG_MAX_FRAMES
+        self.timeout = WORKER_TIMEOUT
+        self.frames_elapsed = 0
+        self.last_heard = 0  # when the worker last sent a message
+        self.last_update = 0  # when update() was last called
+        self.worker = None
+        self.connection = None
+        self.worker_ready = False
+        self.finalizer = None
+        self.start_worker()
+
+    def start_worker(self):
+        """ start a worker process in the background, ready for the next
+        program. It takes a moment to start, so it is started early"""
+        self.connection, worker_connection = WORKER_CONTEXT.Pipe()
+        self.worker = WORKER_CONTEXT.Process(target=worker_main,
+                                             args=(worker_connection,),
+                                             daemon=True)
+        self.worker.start()
+        worker_connection.close()  # the worker has its own copy
+        self.worker_ready = False
+        # make sure the worker goes when the engine does
+        self.finalizer = weakref.finalize(self, kill_worker, self.worker)
+
+    def stop_worker(self):
+        self.finalizer()
+        self.connection.close()
+
+    def load(self, source):
+        # set the source code to interpret
+        self.source = source
+
+    def is_running(self):
+        return self.running
+
+    def halt(self):
+        """ halts execution immediately, by killing the worker.
+        on_finish is called from the next update(), as it is for the VM"""
+        if self.stepping and self.running:
+            self.stop_worker()
+            self.start_worker()
+        self.running = False
+
+    def precompile(self, source):
+        self.load(source)
+        return self.compile(cache=True)
+
+    def compile(self, cache=False):
+        """ check that the program compiles, returning (success, message)
+        in the same way as VirtualMachine.compile """
+        self.compiler.load(self.source)
+        result = self.compiler.compile(cache=cache)
+        self.compile_time_error = self.compiler.compile_time_error
+        return result
+
+    def world_values(self):
+        return {name: accessors[self.GET]()
+                for name, accessors in self.world_variables.items()}
+
+    def start(self, on_finish, global_names=None, local_names=None):
+        """ send the program to the worker, without waiting for it to
+        finish. on_finish is called with (success, result) from update()
+        when it does (see VirtualMachine.start)"""
+        if not self.run_enabled:
+            return
+        self.run_enabled = False
+        if not self.compiler.byte_code:
+            self.running = False  # no bytecode to execute
+            return
+        console_msg('Executing in worker...', 5)
+        self.connection.send((RUN, self.source, self.world_values()))
+        self.running = True
+        self.stepping = True
+        self.on_finish = on_finish
+        self.line = None
+        self.waiting_for_input = False
+        self.frames_elapsed = 0
+        self.last_heard = self.last_update = time.perf_counter()
+
+    def run(self, global_names=None, local_names=None):
+        """ run the program to completion, keeping the world going while
+        it runs. Returns (success, result) like VirtualMachine.run"""
+        results = []
+        self.start(lambda *result: results.append(result))
+        while self.stepping:
+            self.world.update(self.robot)
+            self.update()
+        if results:
+            return results[0]
+        return None
+
+    def update(self):
+        """ called once per frame from the main game loop: passes the
+        world to the worker, and carries out whatever it has asked for"""
+        if not self.stepping:
+            return
+        if not self.running:
+            self.finish(True, None)  # halted by the player
+            return
+        if not self.worker.is_alive():
+            self.stop_runaway("program crashed.")
+            return
+        self.frames_elapsed += 1
+        if self.max_frames and self.frames_elapsed > self.max_frames:
+            self.stop_runaway("program stopped after "
+                              + str(self.max_frames) + " frames.")
+            return
+        if self.waiting_for_input and not self.world.input.is_active():
+            self.connection.send((INPUT, self.robot.end_input()))
+            self.waiting_for_input = False
+        self.connection.send((WORLD, self.world_values(), self.world.busy()))
+        now = time.perf_counter()
+        if (self.waiting_for_input or not self.worker_ready or
+                now - self.last_update > self.timeout):
+            # the worker isn't expected to say anything (or the game has
+            # been paused, eg for the menu), so the silence doesn't count
+            self.last_heard = now
+        self.last_update = now
+        while self.stepping and self.connection.poll():
+            self.last_heard = now
+            self.handle(self.connection.recv())
+        if self.stepping and now - self.last_heard > self.timeout:
+            self.stop_runaway("program stopped because it "
+                              "stopped responding.")
+
+    def handle(self, message):
+        """ carry out one of the worker's requests """
+        tag = message[0]
+        if tag == STORE:
+            name, value = message[1], message[2]
+            if name in ('data', '_secret_data'):
+                self.world_variables[name][self.SET](self.robot, value)
+            else:
+                self.world_variables[name][self.SET](value)
+        elif tag == SAY:
+            self.robot.say(message[1])
+        elif tag == LINE:
+            self.line = message[1]
+        elif tag == ASK:
+            self.robot.begin_input(message[1])
+            self.waiting_for_input = True
+        elif tag == ERROR:
+            self.robot.error(message[1], type=message[2])
+        elif tag == DONE:
+            self.finish(message[1], message[2])
+        elif tag == READY:
+            self.worker_ready = True
+
+    def current_line(self):
+        """ the line the program was on when the worker last reported,
+        or None if it isn't running (see VirtualMachine.current_line)"""
+        if not self.running:
+            return None
+        return self.line
+
+    def stop_runaway(self, msg):
+        """ kill a worker that has hung, crashed or run for too long """
+        console_msg("Watchdog: " + msg, 2)
+        self.stop_worker()
+        self.start_worker()
+        self.robot.error(msg, type="Run-time error:")
+        self.finish(False, [msg])
+
+    def finish(self, success, result):
+        """ wind up the program and report its result """
+        on_finish = self.on_finish
+        self.running = False
+        self.stepping = False
+        self.on_finish = None
+        self.waiting_for_input = False
+        on_finish(success, result)
@@ -0,0 +1,69 @@
+""" optional profiling for the in-game Python interpreter
+records how often each opcode and source line is executed, how long they
+take, and how long the program spends waiting for the game world """
+import collections
+import dis
+
+from console_messages import console_msg
+
+
+class Profiler:
+    def __init__(self, robot_name=''):
+        self.robot_name = robot_name  # used to label the report
+        self.reset()
+
+    def reset(self):
+        """ clear all the statistics, ready for a new run """
+        self.opcode_counts = collections.Counter()
+        self.opcode_times = collections.Counter()
+        self.line_counts = collections.Counter()
+        self.line_times = collections.Counter()
+        self.execute_time = 0.0  # seconds spent running bytecodes
+        self.wait_time = 0.0  # seconds spent in World.update/busy waits
+        self.frames_waited = 0  # frames a stepped program spent waiting
+
+    def record_instruction(self, line, byte_code, elapsed):
+        """ line comes from the VM's line table (see decode_lines) """
+        self.opcode_counts[byte_code] += 1
+        self.opcode_times[byte_code] += elapsed
+        self.line_counts[line] += 1
+        self.line_times[line] += elapsed
+        self.execute_time += elapsed
+
+    def record_wait(self, elapsed):
+        self.wait_time += elapsed
+
+    def record_frame_waited(self):
+        self.frames_waited += 1
+
+    def report(self):
+        """ returns the profile as a list of lines of text """
+        lines = ['Interpreter profile: ' + self.robot_name,
+                 'executing: {0:.3f}s  waiting for world: {1:.3f}s'
+                 '  frames waited: {2}'.format(self.execute_time,
+                                               self.wait_time,
+                                               self.frames_waited),
+                 '',
+                 '{0:<24}{1:>10}{2:>12}'.format('opcode', 'count', 'time (ms)')]
+        for byte_code, count in self.opcode_counts.most_common():
+            lines.append('{0:<24}{1:>10}{2:>12.3f}'.format(
+                dis.opname[byte_code], count,
+                self.opcode_times[byte_code] * 1000))
+        lines.append('')
+        lines.append('{0:<24}{1:>10}{2:>12}'.format('line', 'count', 'time (ms)'))
+        for line in sorted(self.line_counts):
+            lines.append('{0:<24}{1:>10}{2:>12.3f}'.format(
+                line, self.line_counts[line], self.line_times[line] * 1000))
+        return lines
+
+    def dump(self, file_name=None):
+        """ write the profile to a file, or to the console if no
+        file name is given """
+        if file_name:
+            with open(file_name, 'a') as file:
+                for line in self.report():
+                    file.write(line + '\n')
+                file.write('\n')
+        else:
+            for line in self.report():
+                console_msg(line, 1)
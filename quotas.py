@@ -0,0 +1,125 @@
+""" resource limits for programs running on the in-game interpreter
+These stop student programs from using so much memory that the game
+(or the whole lab PC) freezes, eg print(2**10**8) or unbounded lists """
+import tracemalloc
+
+from constants import *
+
+
+class QuotaExceeded(Exception):
+    """ raised inside the VM when a program goes over one of its limits.
+    It is handled like any other run-time error, so the program stops
+    and the message is shown in a speech bubble """
+    pass
+
+
+# sequence types whose size we can predict before an operation creates them
+SEQUENCE_TYPES = (str, bytes, list, tuple)
+# containers that can keep growing in place, eg via append or extend
+GROWABLE_TYPES = (list, dict, set, bytearray)
+# builtins that build a new container from an iterable of known length
+CONTAINER_BUILDERS = frozenset([list, tuple, set, frozenset, sorted,
+                                bytearray, dict])
+
+
+class ResourceQuotas:
+    def __init__(self):
+        self.max_call_depth = QUOTA_MAX_CALL_DEPTH
+        self.max_output_lines = QUOTA_MAX_OUTPUT_LINES
+        self.max_output_chars = QUOTA_MAX_OUTPUT_CHARS
+        self.max_int_bits = QUOTA_MAX_INT_BITS
+        self.max_length = QUOTA_MAX_CONTAINER_LENGTH
+        self.max_memory = QUOTA_MAX_MEMORY
+        self.trace_memory = QUOTA_TRACE_MEMORY
+        self.output_lines = 0
+        self.output_chars = 0
+        self.tracing = False
+
+    def start(self):
+        """ reset the counters at the start of a run """
+        self.output_lines = 0
+        self.output_chars = 0
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+
+    def stop(self):
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def check_call_depth(self, depth):
+        if self.max_call_depth and depth >= self.max_call_depth:
+            raise QuotaExceeded("too many nested function calls (more than "
+                                + str(self.max_call_depth) + ")")
+
+    def check_output(self, values):
+        """ called before anything is printed """
+        self.output_lines += 1
+        if self.max_output_lines and self.output_lines > self.max_output_lines:
+            raise QuotaExceeded("too much output (more than "
+                                + str(self.max_output_lines) + " lines)")
+        self.output_chars += sum(len(str(v)) for v in values)
+        if self.max_output_chars and self.output_chars > self.max_output_chars:
+            raise QuotaExceeded("too much output (more than "
+                                + str(self.max_output_chars) + " characters)")
+
+    def check_operation(self, op, a, b):
+        """ estimate the size of the result of a [op] b, before it is
+        calculated, since the calculation itself is what would freeze """
+        if isinstance(a, int) and isinstance(b, int):
+            bits = 0
+            if op == 'POWER':
+                if b > 0 and abs(a) > 1:
+                    bits = a.bit_length() * b
+            elif op == 'MULTIPLY':
+                bits = a.bit_length() + b.bit_length()
+            elif op == 'LSHIFT':
+                if b > 0:
+                    bits = a.bit_length() + b
+            if self.max_int_bits and bits > self.max_int_bits:
+                raise QuotaExceeded("number is too large to calculate")
+        elif op == 'MULTIPLY':
+            # sequence repetition, eg 'a' * 1000000000
+            if isinstance(a, SEQUENCE_TYPES) and isinstance(b, int):
+                self.check_length(len(a) * b)
+            elif isinstance(b, SEQUENCE_TYPES) and isinstance(a, int):
+                self.check_length(len(b) * a)
+        elif op == 'ADD':
+            if (isinstance(a, SEQUENCE_TYPES) and
+                    isinstance(b, SEQUENCE_TYPES)):
+                self.check_length(len(a) + len(b))
+
+    def check_length(self, length):
+        if self.max_length and length > self.max_length:
+            raise QuotaExceeded("too much data (more than "
+                                + str(self.max_length) + " items)")
+
+    def check_container(self, obj):
+        """ called after a container might have grown in place """
+        if isinstance(obj, GROWABLE_TYPES):
+            self.check_length(len(obj))
+
+    def check_call(self, func, args):
+        """ called before a builtin function that would build a new container,
+        eg list(range(10**10)) """
+        try:
+            builds_container = func in CONTAINER_BUILDERS
+        except TypeError:  # unhashable callable
+            return
+        if builds_container and args:
+            try:
+                length = len(args[0])
+            except (TypeError, OverflowError):
+                # generators have no length, and huge ranges can't report it
+                if isinstance(args[0], range):
+                    raise QuotaExceeded("too much data")
+                return
+            self.check_length(length)
+
+    def check_memory(self):
+        """ called periodically (by the watchdog) when memory tracing is on """
+        if self.tracing and self.max_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if current > self.max_memory:
+                raise QuotaExceeded("program is using too much memory")
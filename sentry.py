@@ -11,6 +11,8 @@ from utility_functions import screen_to_grid
 
 class Sentry(Robot):
     # robot sentries used to present more complex puzzles
+    HEADLESS_PROGRAMS = ('init', 'validate')
+
     def __init__(self, world,
                  name,
                  location,
@@ -25,6 +27,16 @@ class Sentry(Robot):
         self.programs = {}
         self.programs = programs
         self.active_program = self.programs['init']  # default to this one
+        # compile all the programs when the level loads, so that running
+        # them later (eg every time the level is rewound) skips the compiler
+        self.cache_programs = True
+        # only BIT's programs can be replayed in the editor, or have their
+        # trace saved in the session log
+        self.python_interpreter.record_history = False
+        self.python_interpreter.record_trace = False
+        for program in self.programs.values():
+            if program:
+                self.python_interpreter.precompile(program)
         self.output = []
         #        self.standing_left_frame = self.move_left_frames[0]
         #        self.standing_right_frame = self.move_left_frames[1]
@@ -46,12 +58,23 @@ class Sentry(Robot):
             # force the enabled flag because sentries can run their code
             # at any time, not just once per puzzle attempt
             self.python_interpreter.run_enabled = True
+            # the output of init & validate is never seen, so those programs
+            # can run without waiting for the screen to redraw
+            self.python_interpreter.headless = \
+                program_name in self.HEADLESS_PROGRAMS
             #        self.clear_speech_bubble()
             #        self.output = []
-            super().run_program()
-            print("Sentry finished executing", program_name)
-            self.executing = False;
-            print(self.output)
+            if program_name in self.HEADLESS_PROGRAMS:
+                # the results are needed straight away
+                super().run_program()
+                self.program_finished()
+            else:
+                super().run_program(on_finish=self.program_finished)
+
+    def program_finished(self, success=True, errors=None):
+        print("Sentry finished executing", self.name)
+        self.executing = False;
+        print(self.output)
 
     def get_source_code(self):
         # override method from Robot, to allow code to stay as a list of strings
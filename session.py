@@ -70,7 +70,7 @@ class Session:
             file.write(self.section_delimiter)
 
 
-    def save_run(self, code_lines = None, errors = None):
+    def save_run(self, code_lines = None, errors = None, trace = None):
         """ Save details of the current attempt to run a program """
         with open(self.save_file, 'a') as file:  # add to the file if it exists
             file.write(self.open_tag + "SECTION=ATTEMPT" + self.close_tag)
@@ -91,6 +91,11 @@ class Session:
                     file.write(errors)
                 file.write(NEW_LINE)
                 file.write(self.open_tag + "/ERROR" + self.close_tag)
+            if trace:
+                file.write(self.open_tag + "TRACE" + self.close_tag)
+                for entry in trace:
+                    file.write(entry + NEW_LINE)
+                file.write(self.open_tag + "/TRACE" + self.close_tag)
             file.write(self.section_delimiter)
 
     def save_checkpoint_reached(self, checkpoint_name):
@@ -103,3 +108,36 @@ class Session:
                        + self.close_tag)
             # TODO add info about bonus goals achieved eg coins collected
             file.write(self.section_delimiter)
+
+
+def read_log(file_name):
+    """ read back a log file written by Session, as a list of sections.
+    Each section is a dict of its values, eg
+        {'SECTION': 'ATTEMPT', 'DATE/TIME': '01-02-2020 10:15:00',
+         'LEVEL': 'Password', 'USER_PROGRAM': ['print(42)']}
+    with multi-line entries (programs and errors) as lists of lines"""
+    sections = []
+    section = {}
+    block_name = None  # the multi-line entry being read, if any
+    with open(file_name, 'r') as file:
+        for line in file:
+            line = line.rstrip(NEW_LINE)
+            if block_name:
+                if line == '</' + block_name + '>':
+                    block_name = None
+                else:
+                    section[block_name].append(line)
+            elif line == '</SECTION>':
+                sections.append(section)
+                section = {}
+            elif line.startswith('<') and line.endswith('>'):
+                tag = line[1:-1]
+                if '=' in tag:
+                    name, value = tag.split('=', 1)
+                    section[name] = value
+                else:
+                    block_name = tag
+                    section[block_name] = []
+    if section:
+        sections.append(section)  # the game stopped part way through
+    return sections
@@ -77,9 +77,12 @@ class Signposts:
     def update_open_signs(self, surface, scroll, offset):
         # render any open info panels
         # and update their on-screen coords
+        # returns the rects of the panels that were drawn
+        rects = []
         for p in [p for p in self.all_posts if p.open]:
             top_left = grid_to_screen(p.grid_positions[0], scroll, offset)
             p.info_position = (top_left[X],
                                top_left[Y] - p.text_panel.get_rendered_text_height())
-            surface.blit(p.text_panel.rendered(), p.info_position)
+            rects.append(surface.blit(p.text_panel.rendered(), p.info_position))
+        return rects
 
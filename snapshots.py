@@ -0,0 +1,151 @@
+""" records what a program did as it ran, so that the player can scrub
+backwards and forwards through it afterwards (see CodeWindow) without
+running it again.
+Every few instructions the VM hands itself to ExecutionHistory.record,
+which stores a snapshot of just the things that changed since the previous
+one: variables (as short reprs), the depth of the data and call stacks,
+the world variables and any new lines of output. Snapshots go into a ring
+buffer of fixed size. When it is full, the oldest snapshot is folded into
+a base state, so the memory used stays bounded however long the program
+runs, and the most recent part of the run can always be replayed.
+"""
+import collections
+import itertools
+import reprlib
+import types
+
+from constants import HISTORY_INTERVAL, HISTORY_CAPACITY, \
+    HISTORY_MAX_OUTPUT_LINES
+
+# values of these types can't change without being replaced, so if a name
+# still refers to the same object, its repr doesn't need working out again
+IMMUTABLE_TYPES = (int, float, bool, str, type(None), complex, range)
+# keeps variable values short, eg long lists are shown as [1, 2, 3, ...]
+SHORT_REPR = reprlib.Repr()
+SHORT_REPR.maxstring = 40
+SHORT_REPR.maxother = 40
+# prefix for the world's own values, so they don't clash with the program's
+WORLD_PREFIX = 'world.'
+
+
+class Snapshot:
+    __slots__ = ['instruction', 'code_obj', 'offset', 'stack_depth',
+                 'call_depth', 'changed', 'output']
+
+    def __init__(self, instruction, code_obj, offset, stack_depth,
+                 call_depth, changed, output):
+        self.instruction = instruction  # bytecodes executed so far
+        # where the program had got to
+        self.code_obj = code_obj
+        self.offset = offset
+        self.stack_depth = stack_depth
+        self.call_depth = call_depth
+        # {name: repr} for each changed value, or {name: None} if removed
+        self.changed = changed
+        self.output = output  # tuple of lines printed since the last one
+
+
+class ExecutionHistory:
+    def __init__(self, interval=HISTORY_INTERVAL, capacity=HISTORY_CAPACITY):
+        self.interval = interval  # instructions between snapshots
+        self.capacity = capacity  # snapshots kept
+        self.snapshots = collections.deque()
+        # the state before the oldest snapshot that is still kept
+        self.base_names = {}
+        self.base_output = collections.deque(maxlen=HISTORY_MAX_OUTPUT_LINES)
+        self.dropped = 0  # snapshots folded into the base state
+        # the state at the newest snapshot, to work out what has changed
+        self.names = {}
+        self.values = {}  # the immutable values those reprs were made from
+        self.output_seen = 0
+        self.global_names = None  # still readable once the program ends
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def record(self, vm):
+        """ take a snapshot of the VM, storing only what has changed """
+        frame = vm.frame
+        if frame is not None:
+            self.global_names = frame.global_names
+        changed = {}
+        seen = set()
+        if self.global_names is not None:
+            self.compare(self.global_names, '', changed, seen)
+        if frame is not None and frame.local_names is not frame.global_names:
+            # local variables are labelled with their function, eg f.x
+            self.compare(frame.local_names, frame.code_obj.co_name + '.',
+                         changed, seen)
+        GET = 0  # index into world_variables tuple
+        for name, accessors in vm.world_variables.items():
+            if name[0] != '_':  # secret data stays secret
+                self.compare_value(WORLD_PREFIX + name, accessors[GET](),
+                                   changed, seen)
+        if len(seen) != len(self.names):
+            for name in list(self.names):
+                if name not in seen:
+                    changed[name] = None
+                    del self.names[name]
+                    self.values.pop(name, None)
+
+        output = vm.robot.output
+        if len(output) < self.output_seen:
+            self.output_seen = 0  # the output was cleared
+        new_output = tuple(output[self.output_seen:])
+        self.output_seen = len(output)
+
+        self.snapshots.append(Snapshot(
+            vm.bytecodes_executed,
+            frame.code_obj if frame else None,
+            frame.last_instruction if frame else None,
+            len(vm.stack), len(vm.frames), changed, new_output))
+        if len(self.snapshots) > self.capacity:
+            self.fold(self.snapshots.popleft())
+
+    def compare(self, names, prefix, changed, seen):
+        """ compare_value for each of the variables in a namespace that
+        a player would recognise as their own """
+        for name, value in names.items():
+            if name[0] != '_' and not isinstance(value, types.ModuleType):
+                self.compare_value(prefix + name, value, changed, seen)
+
+    def compare_value(self, name, value, changed, seen):
+        """ add the value to changed if it is different from last time """
+        seen.add(name)
+        if self.values.get(name, self) is value:
+            return  # the same immutable object as last time
+        text = SHORT_REPR.repr(value)
+        if self.names.get(name) != text:
+            changed[name] = text
+            self.names[name] = text
+        if isinstance(value, IMMUTABLE_TYPES):
+            self.values[name] = value
+        else:
+            self.values.pop(name, None)
+
+    def fold(self, snapshot):
+        """ merge the oldest snapshot into the base state """
+        apply_changes(self.base_names, snapshot.changed)
+        self.base_output.extend(snapshot.output)
+        self.dropped += 1
+
+    def state_at(self, index):
+        """ returns (snapshot, names, output) for the index'th snapshot
+        still kept, where names is {name: repr} for every visible value
+        and output is the most recent lines printed """
+        names = dict(self.base_names)
+        output = collections.deque(self.base_output,
+                                   maxlen=HISTORY_MAX_OUTPUT_LINES)
+        snapshot = None
+        for snapshot in itertools.islice(self.snapshots, index + 1):
+            apply_changes(names, snapshot.changed)
+            output.extend(snapshot.output)
+        return snapshot, names, list(output)
+
+
+def apply_changes(names, changed):
+    for name, text in changed.items():
+        if text is None:
+            names.pop(name, None)
+        else:
+            names[name] = text
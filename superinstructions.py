@@ -0,0 +1,109 @@
+""" combines runs of simple instructions into superinstructions, so the VM
+dispatches them all at once. Student programs are mostly made of short
+runs like
+    LOAD_NAME x, LOAD_CONST 1, BINARY_ADD, STORE_NAME x
+or
+    LOAD_NAME print, LOAD_NAME x, CALL_FUNCTION 1, POP_TOP
+and each instruction normally goes through the whole of the VM's run loop
+(scheduling, the watchdog, world syncing etc). A fused run still calls the
+same handler for each of its instructions, so it behaves exactly like the
+original, but only goes round the run loop once.
+
+The first instruction of each run is replaced by the superinstruction,
+and the others are left in the table, in case the run has to stop part
+way through (see run_fused). Each instruction of a run still moves the
+frame on to the next one, so an error is reported on its own line, even
+if the run carries on over several lines. A run never contains a jump, or the target
+of one (except at its start), and it always ends after a store to a world
+variable, so the VM syncs with the world before the program reads it back.
+"""
+import dis
+
+# the superinstruction's opcode, just after the real instructions
+FUSED_OPCODE = max(256, len(dis.opname))
+FUSED_NAME = 'FUSED'
+
+# instructions that only move values between the stack and names or
+# constants, or operate on the stack, so they never change which
+# instruction runs next
+SIMPLE_NAMES = frozenset([
+    'NOP', 'EXTENDED_ARG', 'RESUME', 'POP_TOP', 'PUSH_NULL', 'PRECALL',
+    'LOAD_CONST', 'LOAD_NAME', 'LOAD_FAST', 'LOAD_GLOBAL', 'LOAD_ATTR',
+    'LOAD_METHOD', 'LOAD_FAST_CHECK', 'LOAD_FAST_LOAD_FAST',
+    'STORE_NAME', 'STORE_GLOBAL', 'STORE_FAST', 'STORE_FAST_LOAD_FAST',
+    'STORE_FAST_STORE_FAST', 'COMPARE_OP', 'IS_OP', 'CONTAINS_OP',
+    'BINARY_OP', 'BUILD_LIST', 'BUILD_TUPLE', 'TO_BOOL', 'COPY', 'SWAP',
+    'DUP_TOP', 'LIST_APPEND', 'LIST_EXTEND',
+])
+SIMPLE_PREFIXES = ('UNARY_', 'BINARY_', 'INPLACE_')
+# calls can start a new frame for one of the program's own functions,
+# so a run has to be able to stop straight after them
+CALL_NAMES = frozenset(['CALL', 'CALL_FUNCTION', 'CALL_METHOD'])
+# stores to these might need to wait for the world, eg for BIT to move
+GLOBAL_STORE_NAMES = frozenset(['STORE_NAME', 'STORE_GLOBAL'])
+
+
+def is_simple(byte_name):
+    return (byte_name in SIMPLE_NAMES or byte_name in CALL_NAMES or
+            byte_name.startswith(SIMPLE_PREFIXES))
+
+
+def jump_targets(table, jump_opcodes):
+    targets = set()
+    for entry in table:
+        if entry and entry[0] in jump_opcodes:
+            targets.add(entry[2][0])
+    return targets
+
+
+def fuse_instructions(table, dispatch_table, world_names, jump_opcodes):
+    """ returns a copy of an instruction table (see decode_instructions)
+    with runs of simple instructions replaced by superinstructions """
+    table = list(table)
+    targets = jump_targets(table, jump_opcodes)
+    offsets = [i * 2 for i, entry in enumerate(table) if entry]
+    run = []
+
+    def end_run():
+        if len(run) > 1:
+            first = run[0] >> 1
+            steps = []
+            for offset in run:
+                byte_code, byte_name, argument, next_offset = \
+                    table[offset >> 1]
+                steps.append((dispatch_table[byte_code], argument,
+                              next_offset, byte_name in CALL_NAMES))
+            last_entry = table[run[-1] >> 1]
+            table[first] = (FUSED_OPCODE, FUSED_NAME,
+                            (tuple(steps), len(steps) - 1), last_entry[3])
+        run.clear()
+
+    for offset in offsets:
+        byte_code, byte_name, argument, next_offset = table[offset >> 1]
+        if offset in targets:
+            end_run()
+        if dispatch_table[byte_code] is None or not is_simple(byte_name):
+            end_run()
+            continue
+        run.append(offset)
+        if byte_name in GLOBAL_STORE_NAMES and argument[0] in world_names:
+            end_run()
+    end_run()
+    return table
+
+
+def run_fused(vm, steps, extra_instructions):
+    """ the handler for superinstructions: runs each of the original
+    instructions in turn """
+    frame = vm.frame
+    for bytecode_fn, argument, next_offset, is_call in steps:
+        frame.last_instruction = next_offset
+        bytecode_fn(vm, *argument)
+        if is_call and (vm.frame is not frame or vm.waiting_for_input):
+            # a call has started one of the program's own functions, or
+            # is waiting for input, so the rest of the run is left until
+            # it has finished
+            return None
+    # the watchdog counts the instructions that were fused
+    vm.bytecodes_executed += extra_instructions
+    return None
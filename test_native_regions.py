@@ -0,0 +1,90 @@
+""" checks that native regions (see native_regions.py) only run loops that
+can't reach the world, and report errors on the line that failed.
+Run with: python -m pytest test_native_regions.py
+"""
+import contextlib
+import io
+import sys
+
+import interpreter
+from headless import StubRobot
+
+
+class RecordingVM(interpreter.VirtualMachine):
+    """ notes whether each native region ran natively or declined """
+    def __init__(self, robot):
+        super().__init__(robot)
+        self.native_runs = []
+
+    def run_native(self, index, iterable):
+        result = super().run_native(index, iterable)
+        self.native_runs.append(result == ())
+        return result
+
+
+def run(source):
+    robot = StubRobot(RecordingVM)
+    vm = robot.python_interpreter
+    vm.record_history = False
+    vm.record_trace = False
+    vm.instruction_budget = sys.maxsize
+    vm.time_slice = None
+    vm.load(source)
+    with contextlib.redirect_stdout(io.StringIO()):
+        success, message = vm.compile()
+        assert success, message
+        vm.run_enabled = True
+        result = vm.run()
+    return robot, vm, result
+
+
+def test_plain_loop_runs_natively():
+    robot, vm, result = run([
+        "total = 0",
+        "for i in range(10):",
+        "    total = total + i",
+        "bit_x = total",
+    ])
+    assert result == (True, None)
+    assert vm.native_runs == [True]
+    assert robot.world.bit_x == 45
+
+
+def test_loop_calling_a_function_that_moves_bit_is_interpreted():
+    robot, vm, result = run([
+        "def step():",
+        "    global bit_x",
+        "    bit_x = bit_x + 1",
+        "for i in range(3):",
+        "    step()",
+    ])
+    assert result == (True, None)
+    assert vm.native_runs == [False]
+    assert robot.world.bit_x == 3
+
+
+def test_function_inside_a_container_is_interpreted():
+    robot, vm, result = run([
+        "def step():",
+        "    global bit_x",
+        "    bit_x = bit_x + 1",
+        "moves = [step, step]",
+        "for i in range(2):",
+        "    moves[i]()",
+    ])
+    assert result == (True, None)
+    assert vm.native_runs == [False]
+    assert robot.world.bit_x == 2
+
+
+def test_error_is_reported_on_the_line_that_failed():
+    robot, vm, result = run([
+        "x = 0",
+        "for i in range(3):",
+        "    x = x + 1",
+        "    y = x / 0",
+    ])
+    # the region raises, so it never returns to say it ran
+    assert len(vm.native_regions) == 1 and vm.native_runs == []
+    assert result == (False, ['division by zero on line 4'])
+    assert vm.exception_line[1] == 4
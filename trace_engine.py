@@ -0,0 +1,484 @@
+""" an alternative to the bytecode VM (interpreter.py) that runs programs
+natively with exec(), and only steps in at the start of each source line.
+Lines that use a world variable (bit_x, me_x, data etc) sync the program
+with the world before they run, lines that change one sync again once they
+have run, and every so often the game world is given a chance to redraw. Line events come from sys.monitoring in Python 3.12+,
+or sys.settrace in earlier versions.
+
+It has the same interface as VirtualMachine, so a Robot can use either
+(see Robot.set_engine). Programs run to completion inside run(), so there is
+no stepping from the game loop, and the resource quotas only cover output,
+since the program's arithmetic is no longer visible to the engine.
+"""
+import ast
+import builtins
+import sys
+import time
+import types
+
+from console_messages import console_msg
+from constants import WATCHDOG_MAX_SECONDS, WATCHDOG_MAX_FRAMES, \
+    WATCHDOG_CHECK_INTERVAL, INSTRUCTION_TIME_SLICE, TRACE_MAX_LINES, \
+    TRACE_NO_PROGRESS_LINES
+from module_registry import import_module
+from quotas import ResourceQuotas, QuotaExceeded
+
+PROGRAM_FILE_NAME = '<program>'  # co_filename of the student's code
+HALTED_NAME = '__program_halted__'  # the builtin name for ProgramHalted
+
+
+class ProgramHalted(BaseException):
+    """ raised inside the running program to stop it. This is not an
+    Exception, so that a student's try/except can't catch it """
+    pass
+
+
+class ReraiseHalted(ast.NodeTransformer):
+    """ adds a handler to the front of every try statement that re-raises
+    ProgramHalted, so a bare except (or except BaseException) in the program
+    can't swallow it and keep running """
+    def visit_Try(self, node):
+        self.generic_visit(node)
+        if node.handlers:
+            handler = ast.ExceptHandler(
+                type=ast.Name(id=HALTED_NAME, ctx=ast.Load()), name=None,
+                body=[ast.copy_location(ast.Raise(exc=None, cause=None),
+                                        node)])
+            node.handlers.insert(0, ast.copy_location(handler, node))
+        return node
+
+    # except* handlers have the same form (Python 3.11+)
+    visit_TryStar = visit_Try
+
+
+def all_code_objects(code_obj):
+    """ returns a list of the code object and any functions or
+    comprehensions defined inside it """
+    code_objects = [code_obj]
+    for const in code_obj.co_consts:
+        if isinstance(const, types.CodeType):
+            code_objects += all_code_objects(const)
+    return code_objects
+
+
+def world_lines(tree, names):
+    """ returns the set of source lines that use any of the names """
+    lines = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id in names:
+            lines.add(node.lineno)
+        elif isinstance(node, ast.Global):
+            # the line event for a function's first line may be on its global
+            # statement, so those lines count too
+            if set(node.names) & set(names):
+                lines.add(node.lineno)
+    return lines
+
+
+def world_store_lines(tree, names):
+    """ returns the set of source lines that store to any of the names """
+    return {node.lineno for node in ast.walk(tree)
+            if isinstance(node, ast.Name) and node.id in names
+            and isinstance(node.ctx, ast.Store)}
+
+
+class TraceEngine:
+    GET = 0  # index into world_variables tuple
+    SET = 1
+    UPDATE_TIMEOUT = 50
+
+    # compiled code objects and their world (store) lines, keyed by source
+    # (see VirtualMachine.code_cache)
+    code_cache = {}
+
+    def __init__(self, robot):
+        self.world = robot.world  # link back to the state of the game world
+        self.run_enabled = True
+        self.robot = robot  # the Robot instance that is running this program
+        self.source = []
+        self.byte_code = None
+        self.world_lines = set()  # source lines that use world variables
+        self.store_lines = set()  # source lines that store to them
+        self.sync_pending = False  # a store line ran, and hasn't been synced
+        self.compile_time_error = None
+        self.run_time_error = None
+        self.last_exception = None
+        self.running = False
+        self.headless = False
+        self.render_frames = True
+        self.global_names = None
+        # functions that replace the standard python functions
+        self.overridden_builtins = {
+            'print': self.print,
+            'input': self.input,
+            '__import__': import_module,
+            HALTED_NAME: ProgramHalted,
+        }
+        # getters and setters for all the programmable world variables
+        self.world_variables = {
+            'bit_x': (self.world.get_bit_x, self.world.set_bit_x),
+            'bit_y': (self.world.get_bit_y, self.world.set_bit_y),
+            'me_x': (self.world.get_player_x, self.world.set_player_x),
+            'me_y': (self.world.get_player_y, self.world.set_player_y),
+            'data': (self.world.get_data, self.world.set_data),
+            '_secret_data': (self.world.get_secret_data,
+                             self.world.set_secret_data),
+        }
+        self.writable_names = ['bit_x', 'bit_y']
+        self.live_names = frozenset(['me_x', 'me_y'])
+        # the value of each world variable when it was last synced
+        self.synced_values = {}
+        # the program is given a fresh frame to draw in after this time
+        self.time_slice = INSTRUCTION_TIME_SLICE
+        self.slice_deadline = 0
+        # watchdog limits, counted in lines rather than bytecodes
+        self.max_lines = TRACE_MAX_LINES
+        self.max_seconds = WATCHDOG_MAX_SECONDS
+        self.max_frames = WATCHDOG_MAX_FRAMES
+        self.no_progress_limit = TRACE_NO_PROGRESS_LINES
+        self.lines_executed = 0
+        self.frames_elapsed = 0
+        self.run_start_time = 0
+        self.watchdog_check_at = WATCHDOG_CHECK_INTERVAL
+        self.world_writes = 0
+        self.last_progress = None
+        self.last_progress_at = 0
+        self.runaway = False
+        self.quotas = ResourceQuotas()
+
+    def load(self, source):
+        # set the source code to interpret
+        self.source = source
+
+    def is_running(self):
+        return self.running
+
+    def halt(self):
+        """ stops the program at the start of its next line """
+        self.running = False
+
+    def get_code(self):
+        # converts all the source into a single string with carriage returns
+        return chr(13).join(self.source)
+
+    def precompile(self, source):
+        """ compile a program in advance and keep it in the code cache """
+        self.load(source)
+        return self.compile(cache=True)
+
+    def compile(self, cache=False):
+        """ compile the source, returning (success, message) in the same
+        way as VirtualMachine.compile """
+        source = self.get_code()
+        if not source:  # bail immediately if source is empty
+            return False, ''
+        if cache and source in self.code_cache:
+            (self.byte_code, self.world_lines,
+             self.store_lines) = self.code_cache[source]
+            return True, "compilation successful"
+        try:
+            tree = ast.parse(source, PROGRAM_FILE_NAME)
+            ast.fix_missing_locations(ReraiseHalted().visit(tree))
+            code_object = compile(tree, PROGRAM_FILE_NAME, 'exec')
+        except Exception as e:
+            console_msg("Compiler error!", 3)
+            self.compile_time_error = {'error': e.args[0],
+                                       'line': e.args[1][1]
+                                       }
+            msg = (self.compile_time_error['error'] + " on line "
+                   + str(self.compile_time_error['line']))
+            self.robot.error(msg, type="Compiler error:")
+            return False, msg
+        self.compile_time_error = None
+        self.byte_code = code_object
+        self.world_lines = world_lines(tree, self.world_variables)
+        self.store_lines = world_store_lines(tree, self.world_variables)
+        if cache:
+            self.code_cache[source] = (self.byte_code, self.world_lines,
+                                       self.store_lines)
+        return True, "compilation successful"
+
+    def print(self, *t):
+        """ replacement for the built-in print function """
+        self.quotas.check_output(t)
+        self.robot.say(*t)
+
+    def input(self, msg=''):
+        """ replacement for the built-in input function """
+        return self.robot.input(msg)
+
+    def make_globals(self):
+        """ the namespace the program runs in, with its world variables
+        predefined and print/input replaced"""
+        program_builtins = dict(builtins.__dict__)
+        program_builtins.update(self.overridden_builtins)
+        global_names = {
+            '__builtins__': program_builtins,
+            '__name__': '__main__',
+            '__doc__': None,
+            '__package__': None,
+        }
+        for name, (get, set) in self.world_variables.items():
+            global_names[name] = get()
+        self.synced_values = dict(global_names)
+        return global_names
+
+    def prepare_to_run(self):
+        """ reset the per-run state, ready for a new program """
+        console_msg('Executing...', 5)
+        self.running = True
+        self.render_frames = not (self.headless and
+                                  not self.uses_names(self.writable_names))
+        self.last_exception = None
+        self.run_time_error = None
+        self.runaway = False
+        self.lines_executed = 0
+        self.frames_elapsed = 0
+        self.run_start_time = time.perf_counter()
+        self.slice_deadline = self.run_start_time + (self.time_slice or 0)
+        self.watchdog_check_at = WATCHDOG_CHECK_INTERVAL
+        self.world_writes = 0
+        self.sync_pending = False
+        self.last_progress = None
+        self.last_progress_at = 0
+        self.quotas.start()
+
+    def uses_names(self, names):
+        """ True if the compiled program uses any of the names """
+        program_names = set()
+        for code_obj in all_code_objects(self.byte_code):
+            program_names.update(code_obj.co_names)
+        return bool(program_names & set(names))
+
+    def run(self, global_names=None, local_names=None):
+        """ run the program to completion, returning (success, result)"""
+        # clear the enable flag, so that the puzzle must be reset before
+        # running again.
+        if not self.run_enabled:
+            self.running = False  # execution is disabled
+            return
+        self.run_enabled = False
+        if not self.byte_code:
+            self.running = False  # no bytecode to execute
+            return
+        self.prepare_to_run()
+        if global_names is None:
+            global_names = self.make_globals()
+        self.global_names = global_names
+        result = None
+        self.start_tracing()
+        try:
+            exec(self.byte_code, global_names)
+            # the last line may have changed a world variable
+            self.sync_world()
+            if self.runaway:
+                # settrace stops tracing once the trace function raises, so
+                # a program that still swallows ProgramHalted (eg in a with
+                # statement that suppresses errors) can run on to the end
+                result = 'quit'
+        except ProgramHalted:
+            result = 'quit'
+        except Exception as e:
+            self.last_exception = (type(e), e, None)
+            result = 'exception'
+        finally:
+            self.stop_tracing()
+        return self.outcome(result)
+
+    def start(self, on_finish, global_names=None, local_names=None):
+        """ programs can't be stepped by the game loop, so they run to
+        completion straight away (see VirtualMachine.start)"""
+        result = self.run(global_names, local_names)
+        if result is not None:
+            on_finish(*result)
+
+    def update(self):
+        """ called by the game loop every frame. Nothing to do here, since
+        programs run to completion in run() """
+        pass
+
+    def outcome(self, result):
+        """ converts the result into the (success, result/errors) pair
+        returned by run, and displays any error messages"""
+        self.running = False
+        self.quotas.stop()
+        if result in ('exception', 'quit'):
+            console_msg("RUN ERRORS=" + str(self.run_time_error), 4)
+            errors = []
+            if self.run_time_error:
+                msg = str(self.run_time_error)
+                errors.append(msg)
+                self.robot.error(msg, type="Run-time error:")
+            if self.last_exception:
+                msg = str(self.last_exception[1])
+                errors.append(msg)
+                self.robot.error(msg, type="Run-time error:")
+            return False, errors
+        else:
+            return True, result  # no errors
+
+    ##############################################
+    # line events
+
+    def start_tracing(self):
+        code_objects = all_code_objects(self.byte_code)
+        self.monitoring_tool = None
+        if hasattr(sys, 'monitoring'):
+            monitoring = sys.monitoring
+            for tool in (monitoring.DEBUGGER_ID, monitoring.PROFILER_ID):
+                if monitoring.get_tool(tool) is None:
+                    self.monitoring_tool = tool
+                    break
+        if self.monitoring_tool is not None:
+            monitoring = sys.monitoring
+            monitoring.use_tool_id(self.monitoring_tool, 'BitQuest')
+            monitoring.register_callback(self.monitoring_tool,
+                                         monitoring.events.LINE,
+                                         self.line_event)
+            monitoring.register_callback(
+                self.monitoring_tool, monitoring.events.PY_RETURN,
+                lambda code_obj, offset, value: self.return_event())
+            # events are only turned on for the program's own code, so
+            # library and game code runs at full speed
+            for code_obj in code_objects:
+                monitoring.set_local_events(
+                    self.monitoring_tool, code_obj,
+                    monitoring.events.LINE | monitoring.events.PY_RETURN)
+        else:
+            traced_code = set(code_objects)
+
+            def trace_call(frame, event, arg):
+                if frame.f_code in traced_code:
+                    return trace_line
+                return None
+
+            def trace_line(frame, event, arg):
+                if event == 'line':
+                    self.line_event(frame.f_code, frame.f_lineno)
+                elif event == 'return':
+                    self.return_event()
+                return trace_line
+
+            sys.settrace(trace_call)
+
+    def stop_tracing(self):
+        if self.monitoring_tool is not None:
+            monitoring = sys.monitoring
+            monitoring.register_callback(self.monitoring_tool,
+                                         monitoring.events.LINE, None)
+            monitoring.register_callback(self.monitoring_tool,
+                                         monitoring.events.PY_RETURN, None)
+            for code_obj in all_code_objects(self.byte_code):
+                monitoring.set_local_events(self.monitoring_tool, code_obj, 0)
+            monitoring.free_tool_id(self.monitoring_tool)
+            self.monitoring_tool = None
+        else:
+            sys.settrace(None)
+
+    def line_event(self, code_obj, line):
+        """ called at the start of every line of the program """
+        if not self.running:
+            raise ProgramHalted()
+        self.lines_executed += 1
+        if self.lines_executed >= self.watchdog_check_at:
+            self.check_watchdog()
+            if (self.render_frames and
+                    time.perf_counter() > self.slice_deadline):
+                self.yield_to_world()
+        if self.sync_pending or line in self.world_lines:
+            self.sync_pending = False
+            self.sync_world()
+        # a line that stores to a world variable is synced as soon as it has
+        # run, at the next line event or when its function returns
+        if line in self.store_lines:
+            self.sync_pending = True
+
+    def return_event(self):
+        """ called when any of the program's functions return """
+        if self.sync_pending:
+            self.sync_pending = False
+            self.sync_world()
+
+    def sync_world(self):
+        """ pass any world variables the program has changed to the world,
+        waiting for BIT to move, then refresh the ones it can read"""
+        global_names = self.global_names
+        for name, (get, set) in self.world_variables.items():
+            value = global_names.get(name)
+            if value == self.synced_values.get(name):
+                continue
+            self.world_writes += 1
+            if name in ('data', '_secret_data'):
+                set(self.robot, value)
+            elif name in self.writable_names:
+                self.move_to(name, value)
+        for name in self.writable_names + list(self.live_names):
+            global_names[name] = self.world_variables[name][self.GET]()
+            self.synced_values[name] = global_names[name]
+        self.synced_values['data'] = global_names.get('data')
+        self.synced_values['_secret_data'] = global_names.get('_secret_data')
+
+    def move_to(self, name, target_value):
+        """ set a writable world variable and wait for the world to catch
+        up, or give up if it gets stuck (eg BIT hits an obstacle) """
+        get, set = self.world_variables[name]
+        set(target_value)
+        timeout = 0
+        previous_value = get()
+        while self.running:
+            self.yield_to_world()
+            current_value = get()
+            if current_value == target_value:
+                break
+            if current_value == previous_value:
+                timeout += 1
+                if timeout > self.UPDATE_TIMEOUT:
+                    console_msg("world var timeout", 3)
+                    break
+            previous_value = current_value
+
+    def yield_to_world(self):
+        """ hand control back to the game world for (at least) one frame """
+        self.world.update(self.robot)
+        while self.world.busy():
+            self.world.update(self.robot)
+        self.frames_elapsed += 1
+        if self.time_slice:
+            self.slice_deadline = time.perf_counter() + self.time_slice
+
+    def check_watchdog(self):
+        """ stops the program if it has exceeded any of its limits,
+        or has stopped making progress (see VirtualMachine.check_watchdog)"""
+        self.watchdog_check_at = self.lines_executed + WATCHDOG_CHECK_INTERVAL
+        if self.max_lines and self.lines_executed > self.max_lines:
+            self.stop_runaway("program stopped after "
+                              + str(self.max_lines) + " lines.")
+        elif (self.max_seconds and
+              time.perf_counter() - self.run_start_time > self.max_seconds):
+            self.stop_runaway("program stopped after running for "
+                              + str(self.max_seconds) + " seconds.")
+        elif self.max_frames and self.frames_elapsed > self.max_frames:
+            self.stop_runaway("program stopped after "
+                              + str(self.max_frames) + " frames.")
+        else:
+            try:
+                self.quotas.check_memory()
+            except QuotaExceeded as e:
+                self.stop_runaway(str(e))
+                return
+            progress = (len(self.robot.output), self.world_writes)
+            if progress != self.last_progress:
+                self.last_progress = progress
+                self.last_progress_at = self.lines_executed
+            elif (self.no_progress_limit and
+                  self.lines_executed - self.last_progress_at
+                  > self.no_progress_limit):
+                self.stop_runaway("program stopped because it seems "
+                                  "to be stuck in a loop.")
+
+    def stop_runaway(self, msg):
+        console_msg("Watchdog: " + msg, 2)
+        self.run_time_error = msg
+        self.runaway = True
+        self.halt()
+        raise ProgramHalted()
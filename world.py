@@ -16,6 +16,7 @@ import scenery
 import sentry
 from camera import Camera
 from console_messages import console_msg
+from dirty_rects import DirtyRects
 from constants import *
 from signposts import Signposts
 
@@ -61,6 +62,9 @@ class World:
 
         self.camera = Camera()
 
+        # works out which parts of the window need presenting each frame
+        self.dirty_rects = DirtyRects(self.screen, self.display)
+
         # location of the game area on the window
         # used to scroll the game area out of the way of the code editor
         # this can't be done by the camera, because the editor is always just 'below' the visible part of the map
@@ -104,6 +108,9 @@ class World:
                                     DOG_SPRITE_FILE,
                                     (16, 16),
                                     )
+        if ISOLATED_EXECUTION:
+            # BIT's programs run in a worker process (see process_engine.py)
+            self.dog.set_engine('process')
         console_msg("BIT sprite initialised", 1)
         self.player.set_position(self.blocks.get_player_start(self.puzzle))
         self.dog.set_position(self.blocks.get_dog_start(self.puzzle))
@@ -128,6 +135,8 @@ class World:
         console_msg("Info panels initialised", 7)
 
         self.playing = True  # true when we are playing a level (not a menu)
+        # ticks of the simulation per frame, or INSTANT (see simulate)
+        self.simulation_speed = SIMULATION_SPEED
         self.frame_draw_time = 1
         self.frame_counter = 0
         self.clock = pygame.time.Clock()
@@ -207,6 +216,13 @@ class World:
         else:
             return None
 
+    def run_programs(self):
+        """ advance any programs that are running on BIT or the sentries
+        this is called once per frame from the main game loop"""
+        self.dog.get_interpreter().update()
+        for s in self.sentries:
+            s.get_interpreter().update()
+
     def busy(self):
         """ returns true if there is anything happening that must complete
         before the interpreter continues running the player's code.
@@ -223,6 +239,38 @@ class World:
         else:
             return False
 
+    def step(self, focus):
+        """ move everything on by one tick of the simulation """
+        # track the camera with the focus character, but with a bit of lag
+        self.camera.update(focus)
+        self.blocks.update_movers()
+        for s in self.sentries:
+            s.step()
+        self.player.step()
+        self.dog.step()
+
+    def simulate(self, focus):
+        """ move everything on by as many ticks as the simulation speed
+        calls for. At INSTANT speed, that is until BIT and the blocks
+        have stopped moving, so a program never waits for them """
+        if self.simulation_speed == INSTANT:
+            for tick in range(INSTANT_MAX_TICKS):
+                position = self.dog.location.topleft
+                self.step(focus)
+                # BIT stops for a tick at each grid position on his way,
+                # so he has only arrived (or got stuck) once he stays put
+                if not self.busy() and self.dog.location.topleft == position:
+                    break
+        else:
+            for tick in range(self.simulation_speed):
+                self.step(focus)
+
+    def cycle_simulation_speed(self):
+        i = SIMULATION_SPEEDS.index(self.simulation_speed)
+        self.simulation_speed = SIMULATION_SPEEDS[
+            (i + 1) % len(SIMULATION_SPEEDS)]
+        console_msg("Simulation speed: " + str(self.simulation_speed), 1)
+
     def update(self, focus):
         """update all the game world stuff
         focus is the character that the camera follows
@@ -233,8 +281,7 @@ class World:
         display = self.display  # for brevity
         frame_start_time = time.time_ns()  # used to calculate fps
 
-        # track the camera with the focus character, but with a bit of lag
-        self.camera.update(focus)
+        self.simulate(focus)
 
         # render the background
         # OLD RENDER METHOD: self.scenery.draw_background(display, self.camera.scroll())
@@ -245,13 +292,22 @@ class World:
         # draw all the robot sentries
         # they are drawn before the player/dog so that they will remain behind them
         for s in self.sentries:
-            s.update(display, self.camera.scroll())
+            self.dirty_rects.add_sprite(s.draw(display, self.camera.scroll()))
 
-        # move and render the player sprite
-        self.player.update(display, self.camera.scroll())
+        # render the player sprite
+        self.dirty_rects.add_sprite(
+            self.player.draw(display, self.camera.scroll()))
 
-        # move and render the dog
-        self.dog.update(display, self.camera.scroll())
+        # render the dog
+        self.dirty_rects.add_sprite(
+            self.dog.draw(display, self.camera.scroll()))
+
+        # moving blocks are drawn with the rest, but may have moved
+        for rect in self.blocks.mover_rects(self.camera.scroll()):
+            self.dirty_rects.add_sprite(rect)
+        # and trigger blocks change their image when they're activated
+        for rect in self.blocks.trigger_rects(self.camera.scroll()):
+            self.dirty_rects.add_sprite(rect)
 
         # draw the 'foreground' blocks in front of the characters
         # this is just foliage and other cosmetic stuff
@@ -297,14 +353,18 @@ class World:
             self.game_origin[Y] += EDITOR_POPUP_SPEED
 
         # scale the rendering area to the actual game window
-        self.screen.blit(pygame.transform.scale(display, WINDOW_SIZE),
-                         self.game_origin)
+        # the grid covers the whole game, so it is always presented in full
+        self.dirty_rects.present_game(self.camera.scroll(), self.game_origin,
+                                      full_frame=self.blocks.show_grid)
 
         # the input window and code editor sit below the game surface
         # ie at a higher Y value, not below in the sense of a different layer
-        editor_position = (self.game_origin[X],
-                           self.game_origin[Y] + WINDOW_SIZE[Y])
-        self.screen.blit(self.editor.surface, editor_position)
+        # the editor is off the bottom of the window until it scrolls in
+        if self.game_origin[Y] < 0:
+            editor_position = (self.game_origin[X],
+                               self.game_origin[Y] + WINDOW_SIZE[Y])
+            self.dirty_rects.add_overlay(
+                self.screen.blit(self.editor.surface, editor_position))
 
         # draw the input window, if it is currently active
         if self.input.is_active():
@@ -313,7 +373,8 @@ class World:
                                      self.game_origin[Y]
                                      + WINDOW_SIZE[Y]
                                      - self.input.height)
-            self.screen.blit(self.input.surface, input_dialog_position)
+            self.dirty_rects.add_overlay(
+                self.screen.blit(self.input.surface, input_dialog_position))
 
         # draw the grid overlay next so it is on top of all blocks
         if self.blocks.show_grid:
@@ -328,7 +389,8 @@ class World:
                 position[X] += BLOCK_SIZE  # to put the callout spike next to his mouth
             position[X] = (position[X] - self.camera.scroll_x()) * SCALING_FACTOR + self.game_origin[X]
             position[Y] = (position[Y] - self.camera.scroll_y()) * SCALING_FACTOR + self.game_origin[Y]
-            self.screen.blit(self.dog.get_speech_bubble(), position)
+            self.dirty_rects.add_overlay(
+                self.screen.blit(self.dog.get_speech_bubble(), position))
 
         # do the same for any sentries that are speaking
         for s in self.sentries:
@@ -336,9 +398,12 @@ class World:
                 position = s.speech_position()
                 position[X] = (position[X] - self.camera.scroll_x()) * SCALING_FACTOR + self.game_origin[X]
                 position[Y] = (position[Y] - self.camera.scroll_y()) * SCALING_FACTOR + self.game_origin[Y]
-                self.screen.blit(s.get_speech_bubble(), position)
+                self.dirty_rects.add_overlay(
+                    self.screen.blit(s.get_speech_bubble(), position))
 
-        self.blocks.signposts.update_open_signs(self.screen, self.camera.scroll(), self.game_origin)
+        for rect in self.blocks.signposts.update_open_signs(
+                self.screen, self.camera.scroll(), self.game_origin):
+            self.dirty_rects.add_overlay(rect)
 
         # draw the swirling dust - DEBUG disabled due to looking bad
         # self.dust_storm.update(self.screen, self.game_origin[Y], scroll)
@@ -360,10 +425,11 @@ class World:
                 self.rewind_rotation
             )
             icon_size = rewind_animation_icon.get_size()
-            self.screen.blit(rewind_animation_icon,
-                             (REWIND_ICON_POS[X] + 32 - icon_size[X] / 2,
-                              REWIND_ICON_POS[Y] + 32 - icon_size[Y] / 2)
-                             )
+            self.dirty_rects.add_overlay(
+                self.screen.blit(rewind_animation_icon,
+                                 (REWIND_ICON_POS[X] + 32 - icon_size[X] / 2,
+                                  REWIND_ICON_POS[Y] + 32 - icon_size[Y] / 2)
+                                 ))
         else:
             if self.rewind_button_rect.collidepoint(pygame.mouse.get_pos()):
                 self.screen.blit(self.rewind_hover_icon, REWIND_ICON_POS)
@@ -383,9 +449,24 @@ class World:
             self.screen.blit(self.play_disabled_icon, PLAY_ICON_POS,
                              special_flags=BLEND_RGB_MULT
                              )
+        # the buttons are blended with the game under them, which has to be
+        # presented again each frame, or they would get darker and darker
+        self.dirty_rects.add_overlay(self.rewind_button_rect)
+        self.dirty_rects.add_overlay(self.play_button_rect)
 
             # TODO self.end_of_level_display()
-        pygame.display.update()  # actually display
+        # show the simulation speed under the play button, unless it's normal
+        if self.simulation_speed != 1:
+            if self.simulation_speed == INSTANT:
+                label = 'instant'
+            else:
+                label = str(self.simulation_speed) + 'x'
+            label = self.code_font.render(label, True, (255, 255, 255))
+            self.dirty_rects.add_overlay(
+                self.screen.blit(label, (PLAY_ICON_POS[X] + 32
+                                         - label.get_width() / 2,
+                                         PLAY_ICON_POS[Y] + 64)))
+        self.dirty_rects.end_frame()  # actually display
 
         self.frame_draw_time = time.time_ns() - frame_start_time
         self.clock.tick(60)  # lock the framerate to 60fps
@@ -408,7 +489,8 @@ class World:
                 # to prevent glitch exploits that allow players to jump gaps
                 self.player.moving_left = False
                 self.player.moving_right = False
-                self.player.update(self.display, self.camera.scroll())
+                self.dirty_rects.add_sprite(
+                    self.player.update(self.display, self.camera.scroll()))
 
                 # run user program
                 success = self.editor.run_program()
@@ -630,6 +712,11 @@ class World:
                 if not self.show_fps:
                     self.frame_counter = 0
 
+        if pressed[K_F6]:
+            if not self.repeat_lock:
+                self.cycle_simulation_speed()
+                self.repeat_lock = True
+
         if pressed[K_g]:
             ctrl = pygame.key.get_mods() & KMOD_CTRL
             shift = pygame.key.get_mods() & KMOD_SHIFT